@@ -6,6 +6,8 @@ from flask_security import Security
 
 from utils import format_money
 from models import db, user_datastore
+from repositories.query_cache import query_cache
+from repositories.country_repository import country_registry
 from seed import (
     seed_countries,
     seed_data,
@@ -19,16 +21,17 @@ from views.customers_pages import customers_blueprint
 from views.search_pages import search_blueprint
 from views.transactions_pages import transactions_blueprint
 from views.api import api_blueprint
+from views.audit_pages import audit_blueprint
 
 
-def create_app():
+def create_app(config_object="config.Config"):
     try:
         locale.setlocale(locale.LC_ALL, "sv_SE.UTF-8")
     except locale.Error:
         print("Locale sv_SE.UTF-8 not supported, falling back to default.")
 
     app = Flask(__name__)
-    app.config.from_object('config.Config')
+    app.config.from_object(config_object)
 
     db.app = app
     db.init_app(app)
@@ -40,10 +43,13 @@ def create_app():
     app.register_blueprint(search_blueprint)
     app.register_blueprint(transactions_blueprint)
     app.register_blueprint(api_blueprint)
+    app.register_blueprint(audit_blueprint)
 
     security = Security(app, user_datastore)
 
     mail.init_app(app)
+    query_cache.init_app(app)
+    country_registry.init_app(app)
 
     app.template_filter("format_money")(format_money)
 
@@ -0,0 +1,126 @@
+import random
+import time
+from datetime import datetime, timedelta, date
+from decimal import Decimal
+from sqlalchemy import event, insert
+
+from config import Config
+from constants.constants import TelephoneCountryCodes, TransactionTypes, AccountTypes
+from models import db, Country, Customer, Account, Transaction
+from repositories.transaction_aggregate_repository import TransactionAggregateRepository
+from repositories.country_stats_repository import CountryStatsRepository
+
+INSERT_CHUNK_SIZE = 5000
+
+SYNTHETIC_COUNTRIES = {
+    TelephoneCountryCodes.fi_FI: ("FI", "Finland"),
+    TelephoneCountryCodes.no_NO: ("NO", "Norway"),
+    TelephoneCountryCodes.sv_SE: ("SE", "Sweden"),
+    TelephoneCountryCodes.de_DE: ("DE", "Germany"),
+}
+
+
+def benchmark_config(database_uri: str|None):
+    """Returns a config class for create_app using database_uri,
+    or an in-memory sqlite database if no uri is given"""
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_uri or "sqlite://"
+        MAIL_SUPPRESS_SEND = True
+    return BenchmarkConfig
+
+
+class QueryCounter():
+    """Context manager counting the statements sent to the database and the wall time spent"""
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute", self._count)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._started
+        event.remove(db.engine, "before_cursor_execute", self._count)
+
+
+def _insert_in_chunks(model, rows: list[dict]) -> None:
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(insert(model), rows[start:start + INSERT_CHUNK_SIZE])
+
+
+def seed_synthetic_bank(number_of_customers: int,
+                        transactions_per_account: int=10,
+                        days_of_history: int=5,
+                        max_amount: int=20000,
+                        random_seed: int=1) -> None:
+    """Bulk inserts deterministic synthetic customers, accounts and transactions spread
+    over the last days_of_history days. Much faster than seed.seed_data, and without Faker,
+    so benchmarks can build large data sets"""
+    rng = random.Random(random_seed)
+    now = datetime.now()
+    history_seconds = days_of_history * 24 * 60 * 60
+
+    db.session.execute(insert(Country), [
+        {"country_code": code, "name": name, "telephone_country_code": phone_code.value}
+        for phone_code, (code, name) in SYNTHETIC_COUNTRIES.items()
+    ])
+    country_codes = [code for code, _ in SYNTHETIC_COUNTRIES.values()]
+
+    customers, accounts, transactions = [], [], []
+    for customer_id in range(1, number_of_customers + 1):
+        customers.append({
+            "id": customer_id,
+            "first_name": f"First{customer_id}",
+            "last_name": f"Last{customer_id % 997}",
+            "address": f"{customer_id} Benchmark street",
+            "city": f"City{customer_id % 101}",
+            "postal_code": f"{customer_id % 99999:05}",
+            "birthday": date(1970, 1, 1) + timedelta(days=customer_id % 10000),
+            "national_id": f"{customer_id:012}",
+            "telephone": f"070{customer_id:07}",
+            "email": f"customer{customer_id}@example.com",
+            "country": rng.choice(country_codes),
+        })
+
+        for _ in range(rng.randint(1, 3)):
+            account_id = len(accounts) + 1
+            balance = Decimal(0)
+            timestamps = sorted(now - timedelta(seconds=rng.randint(0, history_seconds))
+                                for _ in range(transactions_per_account))
+            for timestamp in timestamps:
+                amount = Decimal(rng.randint(100, max_amount * 100)) / 100
+                if balance - amount < 0:
+                    transaction_type = TransactionTypes.DEPOSIT
+                    balance += amount
+                else:
+                    transaction_type = rng.choice(list(TransactionTypes))
+                    balance += amount if transaction_type == TransactionTypes.DEPOSIT else -amount
+                transactions.append({
+                    "id": len(transactions) + 1,
+                    "type": transaction_type.value,
+                    "timestamp": timestamp,
+                    "amount": amount,
+                    "new_balance": balance,
+                    "account_id": account_id,
+                })
+            accounts.append({
+                "id": account_id,
+                "account_type": rng.choice(list(AccountTypes)).value,
+                "created": (now - timedelta(days=days_of_history + 1)).date(),
+                "balance": balance,
+                "customer_id": customer_id,
+            })
+
+    _insert_in_chunks(Customer, customers)
+    _insert_in_chunks(Account, accounts)
+    _insert_in_chunks(Transaction, transactions)
+    db.session.commit()
+    # Bulk inserted transactions bypass execute_transaction, so build their hourly aggregates
+    # and country stats
+    TransactionAggregateRepository().backfill()
+    CountryStatsRepository().rebuild()
@@ -1,16 +1,27 @@
-from decimal import Decimal
-from datetime import datetime, timedelta
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta, time as time_of_day
+from flask import current_app
 from flask_mail import Message
-from prettytable import PrettyTable
+import argparse
+import multiprocessing
+import os
 import sched, time
+import socket
 
-from extensions import mail
+from extensions import mail, fraud_monitor, idempotency_service
 from app import create_app
-from models import Country, Transaction
-from services.country_services import CountryService, CountryRepository
+from config import Config
+from services.country_services import CountryService, CountryRepository, CountryRecord
 from services.customer_services import CustomerService, CustomerRepository
-from services.transaction_services import TransactionService, TransactionRepository
 from services.account_services import AccountService, AccountRepository
+from services.audit_services import AuditService, AuditRepository
+from services.audit_rules_engine import AuditRulesEngine
+from services.audit_report_services import AuditReportService
+from services.mail_services import MailDispatcher
+from services.balance_services import BalanceService, BalanceCheckpointRepository, next_month_start
+from services.archive_services import TransactionArchiveService, TransactionArchiveRepository
+from services.statement_services import StatementService, StatementRepository, STATEMENT_PARTITION_SIZE
+from repositories.transaction_aggregate_repository import TransactionAggregateRepository
 
 country_repo = CountryRepository()
 country_service = CountryService(country_repo)
@@ -21,121 +32,348 @@ account_service = AccountService(account_repo)
 customer_repo = CustomerRepository()
 customer_service = CustomerService(customer_repo, account_service)
 
-transaction_repo = TransactionRepository()
-transaction_service = TransactionService(transaction_repo, account_service)
-
-TIME_PERIOD = timedelta(hours=72)
-
-def audit_transactions(scheduler=None):
-    countries:list[Country] = country_service.get_all_countries()
-    yesterday = (datetime.now() - timedelta(days=1)).date()
-
-    for country in countries:
-        flagged_customers:list[dict] = []
-        customers = customer_service.get_all_customers_for_country(country)
-        
-        for customer in customers:
-            # Sets needed to deduplicate entries
-            flagged_transaction_ids = set()
-            flagged_account_ids = set()
-            
-            # Check first rule
-            transactions = transaction_service.get_transactions_for_customer_on_date(customer, yesterday)
-            for transaction in transactions:
-                if single_transaction_amount_exceeds_limit(transaction):
-                    flagged_transaction_ids.add(transaction.id)
-                    flagged_account_ids.add(transaction.account_id)
-
-            # Check second rule
-            if recent_transactions_exceeds_limit(customer):
-                summed_transactions = transaction_service.get_summed_transactions(customer, TIME_PERIOD)
-
-                for transaction in summed_transactions:
-                    flagged_transaction_ids.add(transaction.id)
-                    flagged_account_ids.add(transaction.account_id)
-
-            # Add customer only if they have any flagged transactions
-            if flagged_transaction_ids:
-                flagged_customers.append({customer.id:
-                                          {"transactions": flagged_transaction_ids,
-                                           "accounts": flagged_account_ids}}
-                                        )
-
-        if flagged_customers:
-            recipient = f"{country.name}@testbanken.se"
-
-            msg = Message("Suspicious transactions found at "
-                          + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-                          sender="bank@bank.com", recipients=[recipient])
-            
-            customers_table = compose_message_table(flagged_customers,"Flagged customers found: ")
-
-            msg.body = customers_table
-            mail.send(msg)
-
-    schedule_audit(scheduler)
-
-def single_transaction_amount_exceeds_limit(transaction:Transaction):
-    LIMIT = Decimal(15000)
-    if transaction.amount > LIMIT:
-        return True
-    return False
-
-def recent_transactions_exceeds_limit(customer):
-    LIMIT = Decimal(23000)
-
-    sum_recent_transactions = transaction_service.get_sum_transactions_of_customer(customer, TIME_PERIOD)
-    if sum_recent_transactions > LIMIT:
-        return True
-    return False
-
-def compose_message_table(flagged_entities:list[dict], message_header) -> None:
-    table_data = []
-    for flagged_entitiy in flagged_entities:
-        for customer_id, flagged_accounts_transactions in flagged_entitiy.items():
-            customer = customer_service.get_customer_accounts_country(customer_id)
-            customer_data = {
-                "account_holder_id": customer.id,
-                "account_holder_first_name": customer.first_name,
-                "account_holder_last_name": customer.last_name,
-                "account_numbers": [account_id for account_id
-                                    in flagged_accounts_transactions["accounts"]],
-                "transaction_numbers": [transaction_id 
-                                        for transaction_id
-                                        in flagged_accounts_transactions["transactions"]]
-            }
-            table_data.append(customer_data)
-    
-    table = PrettyTable()
-    table.field_names = ["Id", "Name", "Account number(s)", "Transaction number(s)"]    
-    for data in table_data:
-        message_row = [
-            data["account_holder_id"],
-            f"{data['account_holder_first_name']} {data['account_holder_last_name']}",
-            ", ".join(str(account_number) for account_number in data["account_numbers"]),
-            ", ".join(str(transaction_number) for transaction_number in data["transaction_numbers"])
-        ]
-        table.add_row(message_row)
-    table.align["Transaction number(s)"] = "l"
-
-    return message_header + "\n" + table.get_string() + "\n"
-
-def schedule_audit(scheduler=None):
-    """Schedules an audit for next midnight"""
-    if not scheduler:
-        s = sched.scheduler(time.time, time.sleep)
-
-    tomorrow = datetime.now() + timedelta(days=1)
-    next_midnight = tomorrow.replace(hour=0, minute=0, second=0, microsecond=0)
-    next_midnight_timestamp = next_midnight.timestamp()
-
-    # Pass the same scheduler into the function call so we are not making a new scheduler each time
-    s.enterabs(next_midnight_timestamp, priority=1, action=lambda: audit_transactions(scheduler))
-
-    s.run()
+audit_repo = AuditRepository()
+audit_service = AuditService(audit_repo)
+audit_rules_engine = AuditRulesEngine(audit_repo)
+
+audit_report_service = AuditReportService(customer_service)
+
+balance_service = BalanceService(BalanceCheckpointRepository())
+
+archive_service = TransactionArchiveService(TransactionArchiveRepository(), BalanceCheckpointRepository())
+
+statement_service = StatementService(StatementRepository(), BalanceCheckpointRepository())
+
+mail_dispatcher = MailDispatcher(mail)
+
+# Identifies this process as the owner of the audit lock and in audit runs
+NODE_NAME = f"{socket.gethostname()}:{os.getpid()}"
+
+class AuditWorkerConfig(Config):
+    """Config for audit worker processes, the database uri is set by the parent process"""
+
+worker_app_context = None
+
+def audit_country(country_code: str,
+                  country_name: str,
+                  audit_time: datetime,
+                  incremental: bool=False,
+                  verify: bool=False,
+                  vectorized: bool=False
+                  ) -> list[tuple]:
+    """Audits one country, returning (customer_id, account_id, transaction_id, rule) rows,
+    see run_audit"""
+    if incremental:
+        findings = audit_service.find_suspicious_transactions_incremental(country_code, audit_time)
+    elif vectorized:
+        findings = audit_rules_engine.find_suspicious_transactions(country_code, audit_time)
+    else:
+        findings = audit_service.find_suspicious_transactions(country_code, audit_time)
+
+    if incremental and verify:
+        full_findings = audit_service.find_suspicious_transactions(country_code, audit_time)
+        differences = audit_service.compare_audit_results(
+            audit_service.group_flagged_transactions(full_findings),
+            audit_service.group_flagged_transactions(findings))
+        for difference in differences:
+            print(f"{country_name} verification mismatch: {difference}")
+        if differences:
+            # Trust the full audit if the incremental audit went wrong
+            findings = full_findings
+
+    return findings
+
+def init_audit_worker(database_uri: str) -> None:
+    """Gives each worker process its own app context and database connection"""
+    global worker_app_context
+    AuditWorkerConfig.SQLALCHEMY_DATABASE_URI = database_uri
+    worker_app_context = create_app(AuditWorkerConfig).app_context()
+    worker_app_context.push()
+
+def run_audit(audit_time: datetime,
+              incremental: bool=False,
+              verify: bool=False,
+              workers: int=1,
+              from_flags: bool=False,
+              vectorized: bool=False
+              ) -> dict[str, dict]:
+    """Audits every country, saving the findings under a new audit run
+    and returning flagged customers per country name.
+    An incremental audit only reads transactions added since the last incremental audit,
+    verify runs a full audit as well and reports any difference between the two.
+    With more than one worker, countries are audited in parallel worker processes.
+    from_flags skips the audit and reads the flags raised by the fraud monitor during the last day.
+    vectorized evaluates the rules of the audit rules engine in memory instead of in the database"""
+    countries: tuple[CountryRecord, ...] = country_service.get_all_countries()
+    run = audit_service.start_run(audit_time, NODE_NAME)
+
+    if from_flags:
+        rows_scanned = 0
+    elif incremental:
+        # The audit window is shared by all countries, so it is refreshed once before fanning out
+        rows_scanned = audit_service.refresh_audit_window(audit_time)
+        print(f"Incremental audit read {rows_scanned} new transactions")
+    else:
+        rows_scanned = audit_service.count_audited_transactions(audit_time)
+
+    country_args = [(country.country_code, country.name, audit_time, incremental, verify, vectorized)
+                    for country in countries]
+
+    if from_flags:
+        flagged_since = audit_time - timedelta(days=1)
+        results = [fraud_monitor.get_flagged_transactions_for_country(country.country_code,
+                                                                      flagged_since,
+                                                                      audit_time)
+                   for country in countries]
+    elif workers > 1:
+        # spawn so workers do not inherit the connection pool of this process
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_audit_worker,
+                                 initargs=(current_app.config["SQLALCHEMY_DATABASE_URI"],)
+                                 ) as executor:
+            futures = [executor.submit(audit_country, *args) for args in country_args]
+            results = [future.result() for future in futures]
+    else:
+        results = [audit_country(*args) for args in country_args]
+
+    findings_count = audit_service.save_findings(run, {country.country_code: findings
+                                                       for country, findings in zip(countries, results)})
+    audit_service.finish_run(run, rows_scanned, findings_count)
+
+    return {country.name: audit_service.group_flagged_transactions(findings)
+            for country, findings in zip(countries, results)
+            if findings}
+
+def write_statement_partition(directory: str,
+                              month: datetime,
+                              first_account_id: int,
+                              last_account_id: int
+                              ) -> int|None:
+    return statement_service.write_partition(directory, month, first_account_id, last_account_id)
+
+def run_statements(month: datetime,
+                   directory: str,
+                   workers: int=1,
+                   partition_size: int=STATEMENT_PARTITION_SIZE
+                   ) -> dict:
+    """Writes the statements for a month that is over of every account, partitioned into ranges
+    of partition_size account ids, skipping the partitions an earlier run already wrote.
+    With more than one worker, partitions are written in parallel worker processes.
+    Returns the number of partitions, skipped partitions, statements and seconds taken"""
+    if next_month_start(month) > datetime.now():
+        raise ValueError(f"{month:%Y-%m} is not over yet")
+
+    started = time.perf_counter()
+    partition_args = [(directory, month, first_account_id, last_account_id)
+                      for first_account_id, last_account_id in statement_service.get_partitions(partition_size)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_audit_worker,
+                                 initargs=(current_app.config["SQLALCHEMY_DATABASE_URI"],)
+                                 ) as executor:
+            futures = [executor.submit(write_statement_partition, *args) for args in partition_args]
+            results = [future.result() for future in futures]
+    else:
+        results = [write_statement_partition(*args) for args in partition_args]
+
+    return {"partitions": len(results),
+            "skipped": results.count(None),
+            "statements": sum(result for result in results if result is not None),
+            "seconds": time.perf_counter() - started}
+
+def print_statement_report(report: dict) -> None:
+    accounts_per_second = report["statements"] / report["seconds"] if report["seconds"] else 0
+    print(f"Wrote {report['statements']} statements in {report['partitions'] - report['skipped']} "
+          f"partitions ({report['skipped']} already written) in {report['seconds']:.2f} seconds, "
+          f"{accounts_per_second:.0f} accounts per second")
+
+def print_country_stats_drift(drift: dict[str, dict]) -> None:
+    for country_code, stats in sorted(drift.items()):
+        print(f"{country_code}: stored customers, accounts, sum {stats['stored']}, "
+              f"counted {stats['counted']}")
+    print(f"Rebuilt the country stats, {len(drift)} countries had drifted")
+
+def mail_flagged_customers(flagged_customers_per_country: dict[str, dict],
+                           attachment_formats: list[str]=None) -> Future:
+    """Composes one mail per country and hands them all to the mail dispatcher,
+    returns a future for the delivery report instead of waiting for the mail server"""
+    messages = []
+    reports = audit_report_service.compose_reports(flagged_customers_per_country,
+                                                   "Flagged customers found: ",
+                                                   attachment_formats)
+    for country_name, report in reports.items():
+        recipient = f"{country_name}@testbanken.se"
+
+        msg = Message("Suspicious transactions found at "
+                      + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
+                      sender="bank@bank.com", recipients=[recipient])
+
+        msg.body = report["body"]
+        for filename, content_type, data in report["attachments"]:
+            msg.attach(filename, content_type, data)
+        messages.append(msg)
+
+    return mail_dispatcher.dispatch(current_app._get_current_object(), messages)
+
+def print_delivery_report(delivery: Future) -> None:
+    report = delivery.result()
+    print(f"Mailed {report['sent']} reports in {report['seconds']:.2f} seconds "
+          f"over {report['attempts']} connection(s), {report['failed']} failed")
+
+def run_locked_audits(audit_times: list[datetime],
+                      attachment_formats: list[str]=None,
+                      **audit_options) -> None:
+    """Audits and mails the results for each audit time, oldest first, while holding the audit
+    lock so no two nodes audit at once. Skips the audits if another node holds the lock,
+    and the audit times another node already audited, see run_audit for audit_options"""
+    try:
+        for audit_time in audit_times:
+            # Taking the lock again before each audit keeps it from expiring during a long catch-up
+            if not audit_service.acquire_lock(NODE_NAME):
+                print(f"Another node is auditing, skipping audit at {audit_time}")
+                return
+            if audit_service.has_finished_run(audit_time):
+                print(f"Audit at {audit_time} was already done, skipping it")
+                continue
+            delivery = mail_flagged_customers(run_audit(audit_time, **audit_options),
+                                              attachment_formats)
+            delivery.add_done_callback(print_delivery_report)
+    finally:
+        audit_service.release_lock(NODE_NAME)
+
+def run_locked_maintenance() -> None:
+    """Purges expired idempotency keys, creates the missing balance checkpoints and archives
+    the transactions older than the archive horizon, under the audit lock so only one node does it"""
+    if not audit_service.acquire_lock(NODE_NAME):
+        print("Another node holds the audit lock, skipping maintenance")
+        return
+    try:
+        print(f"Purged {idempotency_service.purge_expired_keys()} expired idempotency keys")
+        print(f"Created {balance_service.create_missing_checkpoints()} balance checkpoints")
+        print(f"Archived {archive_service.archive_cold_transactions()} transactions")
+    finally:
+        audit_service.release_lock(NODE_NAME)
+
+def next_audit_time(scheduled_time: time_of_day, now: datetime) -> datetime:
+    audit_time = datetime.combine(now.date(), scheduled_time)
+    if audit_time <= now:
+        audit_time += timedelta(days=1)
+    return audit_time
+
+def run_daemon(scheduled_time: time_of_day,
+               catch_up: bool=False,
+               attachment_formats: list[str]=None,
+               **audit_options) -> None:
+    """Audits now and then every day at scheduled_time, until the process is stopped,
+    purging expired idempotency keys, creating the balance checkpoints of a new month and
+    archiving cold transactions after each nightly audit. With catch_up, the scheduled audits missed since the last finished run are done first"""
+    scheduler = sched.scheduler(time.time, time.sleep)
+
+    def schedule_next_audit():
+        audit_time = next_audit_time(scheduled_time, datetime.now())
+        scheduler.enterabs(audit_time.timestamp(), 1, scheduled_audit, (audit_time,))
+
+    def scheduled_audit(audit_time: datetime):
+        try:
+            try:
+                run_locked_audits([audit_time], attachment_formats, **audit_options)
+            except Exception:
+                current_app.logger.exception("Audit at %s failed", audit_time)
+            try:
+                run_locked_maintenance()
+            except Exception:
+                current_app.logger.exception("Maintenance after the audit at %s failed", audit_time)
+        finally:
+            # Each audit queues the next one and returns, so the stack does not grow.
+            # Queued even if this night failed, so the daemon keeps running
+            schedule_next_audit()
+
+    now = datetime.now()
+    missed_audit_times = audit_service.get_missed_audit_times(scheduled_time, now) if catch_up else []
+    for audit_time in missed_audit_times:
+        print(f"Catching up on missed audit at {audit_time}")
+    run_locked_audits(missed_audit_times + [now], attachment_formats, **audit_options)
+
+    schedule_next_audit()
+    scheduler.run()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Audits transactions for suspicious activity now and then every day")
+    parser.add_argument("--once", action="store_true",
+                        help="audit once and exit instead of scheduling nightly audits")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only read transactions added since the last incremental audit")
+    parser.add_argument("--verify", action="store_true",
+                        help="with --incremental, also run a full audit and report any difference")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="audit countries, or write statement partitions, "
+                             "in parallel over N worker processes")
+    parser.add_argument("--from-flags", action="store_true",
+                        help="mail the flags raised by the real-time fraud monitor instead of auditing")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="evaluate the audit rules with NumPy over each country's transactions, "
+                             "not with --incremental")
+    parser.add_argument("--at", type=lambda value: datetime.strptime(value, "%H:%M").time(),
+                        default=time_of_day(0, 0), metavar="HH:MM",
+                        help="time of day to audit at, midnight by default")
+    parser.add_argument("--catch-up", action="store_true",
+                        help="first run the scheduled audits missed since the last finished run")
+    parser.add_argument("--backfill-aggregates", action="store_true",
+                        help="rebuild the hourly transaction aggregates of every customer and exit")
+    parser.add_argument("--purge-idempotency-keys", action="store_true",
+                        help="delete the idempotency keys older than a day and exit")
+    parser.add_argument("--backfill-checkpoints", action="store_true",
+                        help="create the missing monthly balance checkpoints of every account and exit")
+    parser.add_argument("--archive-transactions", action="store_true",
+                        help="move the transactions older than the archive horizon to the archive and exit")
+    parser.add_argument("--reconcile-country-stats", action="store_true",
+                        help="recount the country stats, report the countries that drifted and exit")
+    parser.add_argument("--statements", type=lambda value: datetime.strptime(value, "%Y-%m"),
+                        metavar="YYYY-MM",
+                        help="write the statements of every account for a month and exit, "
+                             "a stopped run continues where it left off")
+    parser.add_argument("--statements-dir", default="statements", metavar="DIR",
+                        help="directory to write statements to, statements by default")
+    parser.add_argument("--partition-size", type=int, default=STATEMENT_PARTITION_SIZE, metavar="N",
+                        help="number of account ids per statement file")
+    parser.add_argument("--attach", nargs="+", choices=["csv", "html"], default=[],
+                        help="attach the report to each mail in these formats")
+    args = parser.parse_args()
+    if args.vectorized and args.incremental:
+        parser.error("--vectorized reads each country's transactions in full and cannot be combined "
+                     "with --incremental")
+    audit_options = {
+        "incremental": args.incremental,
+        "verify": args.verify,
+        "workers": args.workers,
+        "from_flags": args.from_flags,
+        "vectorized": args.vectorized
+    }
+
     app = create_app()
     with app.app_context():
-        audit_transactions()
-        schedule_audit()
\ No newline at end of file
+        if args.backfill_aggregates:
+            rows = TransactionAggregateRepository().backfill()
+            print(f"Wrote {rows} hourly aggregates")
+        elif args.backfill_checkpoints:
+            print(f"Created {balance_service.create_missing_checkpoints()} balance checkpoints")
+        elif args.archive_transactions:
+            print(f"Archived {archive_service.archive_cold_transactions()} transactions")
+        elif args.reconcile_country_stats:
+            print_country_stats_drift(country_service.reconcile_country_stats())
+        elif args.statements:
+            try:
+                print_statement_report(run_statements(args.statements, args.statements_dir,
+                                                      args.workers, args.partition_size))
+            except ValueError as error:
+                parser.error(str(error))
+        elif args.purge_idempotency_keys:
+            print(f"Purged {idempotency_service.purge_expired_keys()} expired idempotency keys")
+        elif args.once:
+            run_locked_audits([datetime.now()], args.attach, **audit_options)
+            mail_dispatcher.shutdown()
+        else:
+            run_daemon(args.at, args.catch_up, args.attach, **audit_options)
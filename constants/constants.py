@@ -1,4 +1,5 @@
-from datetime import date
+from datetime import date, timedelta
+from decimal import Decimal
 from enum import Enum
 
 
@@ -28,6 +29,38 @@ class BusinessConstants:
     MINIMUM_AGE = 18
     MAXIMUM_AGE = 100
     BANK_ESTABLISHED_DATE = date(year=1905, month=12, day=5)
+    MAX_TRANSACTION_BATCH_SIZE = 50000
+    IDEMPOTENCY_KEY_LIFETIME = timedelta(days=1)
+    IDEMPOTENCY_KEY_CACHE_SIZE = 10000
+    MAX_IDEMPOTENCY_KEY_LENGTH = 64
+    MAX_BALANCE_LOOKUP_ACCOUNTS = 10000
+    TRANSACTION_ARCHIVE_HORIZON = timedelta(days=2 * 365)
+    TRANSACTION_ARCHIVE_BATCH_SIZE = 5000
+    TOP_CUSTOMERS_SHOWN = 10
+    TOP_CUSTOMERS_KEPT = 20
+    TOP_CUSTOMERS_REFRESH_INTERVAL = timedelta(minutes=5)
+    TOP_CUSTOMERS_MAX_CANDIDATES = 10000
+
+class AuditConstants:
+    """Limits used by the console app when auditing for suspicious transactions"""
+    SINGLE_TRANSACTION_LIMIT = Decimal(15000)
+    RECENT_TRANSACTIONS_LIMIT = Decimal(23000)
+    RECENT_TRANSACTIONS_PERIOD = timedelta(hours=72)
+    LOCK_TIMEOUT = timedelta(hours=6)
+    MAX_CATCH_UP_NIGHTS = 7
+    # Longest time from a transaction's timestamp to its commit, clock differences between
+    # nodes included. The incremental audit reads transactions this much older than the start
+    # of its last read again, as ones committing late can have ids below its watermark
+    MAX_COMMIT_LAG = timedelta(minutes=5)
+    # The fraud monitor reads a customer's window again once it is this old, to count
+    # transactions made by other processes, and keeps at most this many windows
+    FRAUD_WINDOW_RELOAD_INTERVAL = timedelta(minutes=1)
+    FRAUD_MAX_WINDOWS = 10000
+
+class AuditRules(Enum):
+    SINGLE_TRANSACTION = "single_transaction"
+    RECENT_TRANSACTIONS = "recent_transactions"
+    VELOCITY = "velocity"
 
 class AccountTypes(Enum):
     PERSONAL = "Personal"
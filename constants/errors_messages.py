@@ -11,4 +11,18 @@ class ErrorMessages(Enum):
     PW_DO_NOT_MATCH = "Passwords do not match"
     PW_WRONG_LENGTH = "Password must be between 8 and 32 characters"
     SAME_ACCOUNT = "You have entered the same account number for transfers"
-    ACCOUNT_ID_INT = "Only numbers allowed for account ID"
\ No newline at end of file
+    ACCOUNT_ID_INT = "Only numbers allowed for account ID"
+    UNKNOWN_TRANSACTION_TYPE = "Transaction type must be deposit, withdraw or transfer"
+    INVALID_AMOUNT = "Amount must be a number"
+    TOO_MANY_DECIMALS = "Amount can have at most 2 decimals"
+    INVALID_BATCH = "Expected a JSON object with a list of transactions"
+    INVALID_TRANSACTION = "Expected a JSON object with type, account_id and amount"
+    BATCH_TOO_LARGE = "Too many transactions in one batch"
+    INVALID_CURSOR = "Invalid cursor, use the next url of the previous page"
+    INVALID_IDEMPOTENCY_KEY = "Idempotency key must be 1 to 64 characters"
+    GROUP_COMMIT_TIMEOUT = "The transaction was not confirmed in time, check the account before posting it again"
+    IDEMPOTENCY_KEY_REUSED = "Idempotency key was already used for a different transaction"
+    INVALID_DATE = "Date must be given as YYYY-MM-DD"
+    INVALID_EXPORT_FORMAT = "Export format must be csv or ndjson"
+    INVALID_ACCOUNT_IDS = "Give one or more account_id parameters"
+    TOO_MANY_ACCOUNTS = "Too many accounts in one balance lookup"
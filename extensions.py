@@ -1,4 +1,17 @@
 from flask_mail import Mail
+from repositories.transaction_flag_repository import TransactionFlagRepository
+from repositories.idempotency_repository import IdempotencyRepository
+from repositories.customer_repository import CustomerRepository
+from services.fraud_services import FraudMonitor
+from services.idempotency_services import IdempotencyService
+from services.top_customers_services import TopCustomersService
 
 
-mail = Mail()
\ No newline at end of file
+mail = Mail()
+
+# Shared by every blueprint so all transactions in a process go through the same windows
+fraud_monitor = FraudMonitor(TransactionFlagRepository())
+# Shared so a retry is recognised from memory whichever blueprint it reaches
+idempotency_service = IdempotencyService(IdempotencyRepository())
+# Shared so every transaction in a process updates the leaderboards the country pages read
+top_customers_service = TopCustomersService(CustomerRepository())
@@ -9,7 +9,9 @@ from wtforms import (
     TelField,
     SelectField,
     DecimalField,
-    SearchField)
+    SearchField,
+    IntegerField,
+    HiddenField)
 from wtforms.validators import (
     InputRequired,
     Length,
@@ -79,6 +81,7 @@ class SearchCustomerForm(FlaskForm):
     For use with SearchResultsHandler, in order to add more fields to search by,
     add a field in this form and its fieldname to user_defined_fields. 
     Fields should of course only correspond to columns existing inside of the Customer model!!! 
+    Each needs a lowercased search column as well, see SEARCH_COLUMNS in customer_repository.py
     """
     class Meta:
         csrf = False
@@ -106,6 +109,35 @@ class SearchCustomerForm(FlaskForm):
     def validation_failed(self):
         return bool(self.errors)
 
+class AuditFindingsForm(FlaskForm):
+    """Filters for browsing audit findings, all fields are optional"""
+    class Meta:
+        csrf = False
+
+    run_id = IntegerField(
+        "Audit run",
+        validators=[Optional()],
+        render_kw={"placeholder": "Run id", "size": 10}
+    )
+
+    country = StringField(
+        "Country code",
+        validators=[Optional(), Length(min=2, max=2)],
+        render_kw={"placeholder": "SE", "size": 10}
+    )
+
+    customer_id = IntegerField(
+        "Customer ID",
+        validators=[Optional()],
+        render_kw={"placeholder": "Customer ID", "size": 10}
+    )
+
+    submit = SubmitField("Filter")
+
+    @property
+    def validation_failed(self):
+        return bool(self.errors)
+
 class RegisterCustomerForm(FlaskForm):
     user_defined_fields = [
         "first_name",
@@ -299,6 +331,10 @@ class TransactionForm(FlaskForm):
                    "step": "0.01"}
         )
 
+    idempotency_key = HiddenField(
+        validators=[Optional(),
+                    Length(max=64, message=ErrorMessages.INVALID_IDEMPOTENCY_KEY.value)])
+
     submit = SubmitField()
 
     @property
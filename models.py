@@ -1,8 +1,16 @@
 from flask_security import UserMixin, RoleMixin, SQLAlchemyUserDatastore
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 
 db = SQLAlchemy()
 
+
+def lowercased(column_name: str):
+    """Column default holding the lowercased value of another column of the inserted row,
+    for bulk inserts that do not set the attributes of a model"""
+    return lambda context: context.get_current_parameters()[column_name].lower()
+
+
 class Country(db.Model):
     __tablename__ = "Countries"
 
@@ -25,10 +33,21 @@ class Customer(db.Model):
     national_id = db.Column(db.String(20), unique=True, nullable=False)
     telephone = db.Column(db.String(20), unique=False, nullable=False)
     email = db.Column(db.String(50), unique=False, nullable=False)
-    country = db.Column(db.String(2), db.ForeignKey("Countries.country_code"), nullable=False)
+    country = db.Column(db.String(2), db.ForeignKey("Countries.country_code"), nullable=False,
+                        index=True)
+    # Lowercased copies of the columns customers are searched by, so a case-insensitive
+    # search compares an indexed column instead of lower() of every row
+    first_name_search = db.Column(db.String(50), nullable=False, index=True, default=lowercased("first_name"))
+    last_name_search = db.Column(db.String(50), nullable=False, index=True, default=lowercased("last_name"))
+    city_search = db.Column(db.String(50), nullable=False, index=True, default=lowercased("city"))
 
     accounts = db.relationship("Account", backref="customer", lazy=True)
 
+    @validates("first_name", "last_name", "city")
+    def _set_search_column(self, attribute_name: str, value: str) -> str:
+        setattr(self, f"{attribute_name}_search", None if value is None else value.lower())
+        return value
+
 class Account(db.Model):
     __tablename__ = "Accounts"
 
@@ -36,20 +55,144 @@ class Account(db.Model):
     account_type = db.Column(db.String(10), unique=False, nullable=False)
     created = db.Column(db.Date, unique=False, nullable=False)
     balance = db.Column(db.Numeric(15, 2), unique=False, nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey("Customers.id"), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey("Customers.id"), nullable=False, index=True)
 
     transactions = db.relationship("Transaction", backref="account", lazy=True)
 
 class Transaction(db.Model):
     __tablename__ = "Transactions"
+    # Account history pages by (timestamp, id) within an account, the audits by timestamp
+    __table_args__ = (db.Index("ix_Transactions_account_id_timestamp_id", "account_id", "timestamp", "id"),)
 
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(20), unique=False, nullable=False)
-    timestamp = db.Column(db.DateTime, unique=False, nullable=False)
+    timestamp = db.Column(db.DateTime, unique=False, nullable=False, index=True)
+    amount = db.Column(db.Numeric(15, 2), unique=False, nullable=False)
+    new_balance = db.Column(db.Numeric(15,2), unique=False, nullable=False)
+    account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"), nullable=False)
+
+class ArchivedTransaction(db.Model):
+    """Transactions older than the archive horizon, moved out of Transactions with their ids"""
+    __tablename__ = "ArchivedTransactions"
+    __table_args__ = (db.Index("ix_ArchivedTransactions_account_id_timestamp_id", "account_id", "timestamp", "id"),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    type = db.Column(db.String(20), unique=False, nullable=False)
+    timestamp = db.Column(db.DateTime, unique=False, nullable=False, index=True)
     amount = db.Column(db.Numeric(15, 2), unique=False, nullable=False)
     new_balance = db.Column(db.Numeric(15,2), unique=False, nullable=False)
     account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"), nullable=False)
 
+class CustomerHourlyTransactions(db.Model):
+    """Sum, count and largest amount of a customer's transactions per hour,
+    kept up to date by TransactionRepository.execute_transaction"""
+    __tablename__ = "CustomerHourlyTransactions"
+
+    customer_id = db.Column(db.Integer, db.ForeignKey("Customers.id"), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True, index=True)
+    amount_sum = db.Column(db.Numeric(17, 2), unique=False, nullable=False)
+    transaction_count = db.Column(db.Integer, unique=False, nullable=False)
+    max_amount = db.Column(db.Numeric(15, 2), unique=False, nullable=False)
+
+class CountryStats(db.Model):
+    """Running customer and account counts and balance sum of a country, split over a few slots
+    so concurrent writers seldom update the same row. A country's stats are the sum of its slots"""
+    __tablename__ = "CountryStats"
+
+    country_code = db.Column(db.String(2), db.ForeignKey("Countries.country_code"), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    number_of_customers = db.Column(db.Integer, unique=False, nullable=False)
+    number_of_accounts = db.Column(db.Integer, unique=False, nullable=False)
+    sum_of_accounts = db.Column(db.Numeric(17, 2), unique=False, nullable=False)
+
+class AccountBalanceCheckpoint(db.Model):
+    """An account's balance at the start of a month, after all transactions before as_of"""
+    __tablename__ = "AccountBalanceCheckpoints"
+
+    account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"), primary_key=True)
+    as_of = db.Column(db.DateTime, primary_key=True)
+    balance = db.Column(db.Numeric(15, 2), unique=False, nullable=False)
+
+class IdempotencyKey(db.Model):
+    """The transactions a submission made, so a retry with the same key gets them back
+    instead of posting them again"""
+    __tablename__ = "IdempotencyKeys"
+
+    key = db.Column(db.String(64), primary_key=True)
+    created = db.Column(db.DateTime, unique=False, nullable=False, index=True)
+    transaction_ids = db.Column(db.String(50), unique=False, nullable=False)
+    # What the submission asked for, see request_fingerprint. Null for keys stored before it
+    fingerprint = db.Column(db.String(100), unique=False, nullable=True)
+
+class AuditWatermark(db.Model):
+    __tablename__ = "AuditWatermarks"
+
+    name = db.Column(db.String(30), primary_key=True)
+    last_transaction_id = db.Column(db.Integer, unique=False, nullable=False)
+    updated = db.Column(db.DateTime, unique=False, nullable=False)
+
+class AuditWindowTransaction(db.Model):
+    """Copy of the transactions inside the audit period, kept by the incremental audit"""
+    __tablename__ = "AuditWindowTransactions"
+    __table_args__ = (db.Index("ix_AuditWindowTransactions_country_timestamp", "country", "timestamp"),)
+
+    transaction_id = db.Column(db.Integer, db.ForeignKey("Transactions.id"), primary_key=True)
+    timestamp = db.Column(db.DateTime, unique=False, nullable=False, index=True)
+    amount = db.Column(db.Numeric(15, 2), unique=False, nullable=False)
+    account_id = db.Column(db.Integer, unique=False, nullable=False)
+    customer_id = db.Column(db.Integer, unique=False, nullable=False)
+    country = db.Column(db.String(2), unique=False, nullable=False)
+
+class TransactionFlag(db.Model):
+    """A transaction flagged as suspicious when it was made"""
+    __tablename__ = "TransactionFlags"
+    __table_args__ = (db.UniqueConstraint("transaction_id", "rule"),
+                      db.Index("ix_TransactionFlags_country_flagged", "country", "flagged"))
+
+    id = db.Column(db.Integer, primary_key=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey("Transactions.id"), nullable=False)
+    account_id = db.Column(db.Integer, unique=False, nullable=False)
+    customer_id = db.Column(db.Integer, unique=False, nullable=False)
+    country = db.Column(db.String(2), unique=False, nullable=False)
+    rule = db.Column(db.String(30), unique=False, nullable=False)
+    flagged = db.Column(db.DateTime, unique=False, nullable=False)
+
+class AuditRun(db.Model):
+    __tablename__ = "AuditRuns"
+
+    id = db.Column(db.Integer, primary_key=True)
+    audit_time = db.Column(db.DateTime, unique=False, nullable=False)
+    started = db.Column(db.DateTime, unique=False, nullable=False)
+    finished = db.Column(db.DateTime, unique=False, nullable=True)
+    node = db.Column(db.String(100), unique=False, nullable=True)
+    rows_scanned = db.Column(db.Integer, unique=False, nullable=True)
+    findings_count = db.Column(db.Integer, unique=False, nullable=True)
+    duration_seconds = db.Column(db.Float, unique=False, nullable=True)
+
+    findings = db.relationship("AuditFinding", backref="run", lazy=True)
+
+class AuditLock(db.Model):
+    """A lock shared by every node, held by owner until released or expired"""
+    __tablename__ = "AuditLocks"
+
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), unique=False, nullable=True)
+    acquired = db.Column(db.DateTime, unique=False, nullable=True)
+    expires = db.Column(db.DateTime, unique=False, nullable=True)
+
+class AuditFinding(db.Model):
+    """A transaction flagged by an audit run"""
+    __tablename__ = "AuditFindings"
+    __table_args__ = (db.Index("ix_AuditFindings_country_run_id", "country", "run_id"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey("AuditRuns.id"), nullable=False, index=True)
+    customer_id = db.Column(db.Integer, unique=False, nullable=False, index=True)
+    account_id = db.Column(db.Integer, unique=False, nullable=False)
+    transaction_id = db.Column(db.Integer, unique=False, nullable=False)
+    country = db.Column(db.String(2), unique=False, nullable=False)
+    rule = db.Column(db.String(30), unique=False, nullable=False)
+
 roles_users = db.Table(
     'RolesUsers',
     db.Column('user_id', db.Integer(), db.ForeignKey('Users.id')),
@@ -1,6 +1,12 @@
+from decimal import Decimal
 from models import Account, db
+from repositories.country_stats_repository import CountryStatsRepository
+from repositories.query_cache import invalidate_on_commit
 
 class AccountRepository():
+    def __init__(self) -> None:
+        self.country_stats_repository = CountryStatsRepository()
+
     def get_account_from_id(self, account_id :int, raise_404 :bool=False):
         """get account from id, use raise_404 to show 404 if account doesn't exist"""
         query = Account.query.filter_by(id=account_id)
@@ -17,4 +23,7 @@ class AccountRepository():
             setattr(new_account, attribute_name, value)
 
         db.session.add(new_account)
+        self.country_stats_repository.add_customer_changes(
+            [(new_account.customer_id, 1, Decimal(new_account.balance))])
+        invalidate_on_commit(f"customer:{new_account.customer_id}")
         db.session.commit()
\ No newline at end of file
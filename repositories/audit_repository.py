@@ -0,0 +1,262 @@
+from decimal import Decimal
+from datetime import datetime
+from models import (
+    db,
+    Customer,
+    Account,
+    Transaction,
+    AuditWatermark,
+    AuditWindowTransaction,
+    AuditRun,
+    AuditFinding,
+    AuditLock
+)
+from sqlalchemy import select, func, between, insert, update, delete, desc, or_
+from sqlalchemy.exc import IntegrityError
+from repositories.transaction_aggregate_repository import TransactionAggregateRepository
+
+FINDINGS_INSERT_CHUNK_SIZE = 5000
+
+
+class AuditRepository():
+    def __init__(self) -> None:
+        self.aggregate_repository = TransactionAggregateRepository()
+
+    def get_transactions_exceeding_amount(self,
+                                          country_code: str,
+                                          from_date: datetime,
+                                          to_date: datetime,
+                                          limit: Decimal
+                                          ) -> list:
+        """Get customer id, account id and transaction id of every transaction in a country
+        from from_date (inclusive) to to_date (exclusive) with an amount above limit"""
+        return db.session.execute(
+            select(Account.customer_id, Transaction.account_id, Transaction.id)
+            .join(Account, Account.id==Transaction.account_id)
+            .join(Customer, Customer.id==Account.customer_id)
+            .where(Customer.country==country_code)
+            .where(Transaction.timestamp >= from_date)
+            .where(Transaction.timestamp < to_date)
+            .where(Transaction.amount > limit)
+        ).all()
+
+    def get_transactions_of_customers_exceeding_sum(self,
+                                                    country_code: str,
+                                                    from_date: datetime,
+                                                    to_date: datetime,
+                                                    limit: Decimal
+                                                    ) -> list:
+        """Get customer id, account id and transaction id of all transactions from from_date
+        to to_date, for every customer in a country whose summed transactions in that period
+        are above limit. The sums are read from the hourly aggregates"""
+        customer_sums = self.aggregate_repository.get_customer_sums(from_date, to_date,
+                                                                    country_code=country_code
+                                                                    ).subquery()
+        customers_exceeding_limit = (
+            select(customer_sums.c.customer_id)
+            .where(customer_sums.c.amount_sum > limit)
+        )
+
+        return db.session.execute(
+            select(Account.customer_id, Transaction.account_id, Transaction.id)
+            .join(Account, Account.id==Transaction.account_id)
+            .where(Account.customer_id.in_(customers_exceeding_limit))
+            .where(between(Transaction.timestamp, from_date, to_date))
+        ).all()
+
+    def get_transaction_columns(self,
+                                country_code: str,
+                                from_date: datetime,
+                                to_date: datetime
+                                ) -> list:
+        """Get customer id, account id, id, timestamp and amount of every transaction
+        in a country from from_date to to_date, both inclusive, in one query.
+        Executed on the connection to skip ORM row processing, which dominates for large periods"""
+        return db.session.connection().execute(
+            select(Account.customer_id,
+                   Transaction.account_id,
+                   Transaction.id,
+                   Transaction.timestamp,
+                   Transaction.amount)
+            .join(Account, Account.id==Transaction.account_id)
+            .join(Customer, Customer.id==Account.customer_id)
+            .where(Customer.country==country_code)
+            .where(between(Transaction.timestamp, from_date, to_date))
+        ).all()
+
+    def get_watermark(self, name: str) -> AuditWatermark|None:
+        return AuditWatermark.query.filter_by(name=name).one_or_none()
+
+    def save_watermark(self, name: str, last_transaction_id: int, read_started: datetime) -> None:
+        """Stores the id of the last audited transaction and when the read that found it
+        started, committing everything written to the audit window since the last commit"""
+        watermark = self.get_watermark(name) or AuditWatermark(name=name)
+        watermark.last_transaction_id = last_transaction_id
+        watermark.updated = read_started
+
+        db.session.add(watermark)
+        db.session.commit()
+
+    def get_new_transactions(self,
+                             after_transaction_id: int,
+                             committed_from: datetime,
+                             from_date: datetime
+                             ) -> list:
+        """Get transactions with ids after after_transaction_id or a timestamp from committed_from,
+        and a timestamp from from_date, together with their customer id and country"""
+        return db.session.execute(
+            select(Transaction.id.label("transaction_id"),
+                   Transaction.timestamp,
+                   Transaction.amount,
+                   Transaction.account_id,
+                   Account.customer_id,
+                   Customer.country)
+            .join(Account, Account.id==Transaction.account_id)
+            .join(Customer, Customer.id==Account.customer_id)
+            .where(or_(Transaction.id > after_transaction_id, Transaction.timestamp >= committed_from))
+            .where(Transaction.timestamp >= from_date)
+        ).all()
+
+    def get_window_transaction_ids(self, from_date: datetime) -> set[int]:
+        """Ids of the transactions in the audit window with a timestamp from from_date"""
+        return set(db.session.execute(
+            select(AuditWindowTransaction.transaction_id)
+            .where(AuditWindowTransaction.timestamp >= from_date)
+        ).scalars())
+
+    def add_window_transactions(self, window_transactions: list[dict]) -> None:
+        """Bulk inserts transactions into the audit window, without committing"""
+        if window_transactions:
+            db.session.execute(insert(AuditWindowTransaction), window_transactions)
+
+    def delete_window_transactions_before(self, from_date: datetime) -> None:
+        """Deletes transactions older than from_date from the audit window, without committing"""
+        db.session.execute(
+            delete(AuditWindowTransaction)
+            .where(AuditWindowTransaction.timestamp < from_date)
+        )
+
+    def get_window_transactions_exceeding_amount(self,
+                                                 country_code: str,
+                                                 from_date: datetime,
+                                                 to_date: datetime,
+                                                 limit: Decimal
+                                                 ) -> list:
+        """Same as get_transactions_exceeding_amount, reading from the audit window"""
+        return db.session.execute(
+            select(AuditWindowTransaction.customer_id,
+                   AuditWindowTransaction.account_id,
+                   AuditWindowTransaction.transaction_id)
+            .where(AuditWindowTransaction.country==country_code)
+            .where(AuditWindowTransaction.timestamp >= from_date)
+            .where(AuditWindowTransaction.timestamp < to_date)
+            .where(AuditWindowTransaction.amount > limit)
+        ).all()
+
+    def get_window_transactions_of_customers_exceeding_sum(self,
+                                                           country_code: str,
+                                                           from_date: datetime,
+                                                           to_date: datetime,
+                                                           limit: Decimal
+                                                           ) -> list:
+        """Same as get_transactions_of_customers_exceeding_sum, reading from the audit window"""
+        customers_exceeding_limit = (
+            select(AuditWindowTransaction.customer_id)
+            .where(AuditWindowTransaction.country==country_code)
+            .where(between(AuditWindowTransaction.timestamp, from_date, to_date))
+            .group_by(AuditWindowTransaction.customer_id)
+            .having(func.sum(AuditWindowTransaction.amount) > limit)
+        )
+
+        return db.session.execute(
+            select(AuditWindowTransaction.customer_id,
+                   AuditWindowTransaction.account_id,
+                   AuditWindowTransaction.transaction_id)
+            .where(AuditWindowTransaction.customer_id.in_(customers_exceeding_limit))
+            .where(between(AuditWindowTransaction.timestamp, from_date, to_date))
+        ).all()
+
+    def create_run(self, audit_time: datetime, node: str=None) -> AuditRun:
+        run = AuditRun(audit_time=audit_time, started=datetime.now(), node=node)
+        db.session.add(run)
+        db.session.commit()
+        return run
+
+    def finish_run(self, run: AuditRun, rows_scanned: int=None, findings_count: int=None) -> None:
+        run.finished = datetime.now()
+        run.duration_seconds = (run.finished - run.started).total_seconds()
+        run.rows_scanned = rows_scanned
+        run.findings_count = findings_count
+        db.session.commit()
+
+    def get_last_finished_run(self) -> AuditRun|None:
+        return (AuditRun.query
+                .filter(AuditRun.finished.is_not(None))
+                .order_by(desc(AuditRun.audit_time))
+                .first())
+
+    def has_finished_run(self, audit_time: datetime) -> bool:
+        return db.session.execute(
+            select(AuditRun.id)
+            .where(AuditRun.audit_time == audit_time)
+            .where(AuditRun.finished.is_not(None))
+            .limit(1)
+        ).first() is not None
+
+    def count_transactions(self, from_date: datetime, to_date: datetime) -> int:
+        """Count transactions from from_date (inclusive) to to_date (exclusive)"""
+        return db.session.execute(
+            select(func.count(Transaction.id))
+            .where(Transaction.timestamp >= from_date)
+            .where(Transaction.timestamp < to_date)
+        ).scalar()
+
+    def acquire_lock(self, name: str, owner: str, now: datetime, expires: datetime) -> bool:
+        """Takes the lock if it is free, expired or already held by owner, and commits.
+        The conditional update is atomic, so only one node can win the lock"""
+        if db.session.get(AuditLock, name) is None:
+            try:
+                db.session.add(AuditLock(name=name))
+                db.session.commit()
+            except IntegrityError:
+                # Another node created the lock row first
+                db.session.rollback()
+
+        result = db.session.execute(
+            update(AuditLock)
+            .where(AuditLock.name==name)
+            .where(or_(AuditLock.owner.is_(None),
+                       AuditLock.expires < now,
+                       AuditLock.owner==owner))
+            .values(owner=owner, acquired=now, expires=expires)
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def release_lock(self, name: str, owner: str) -> None:
+        db.session.execute(
+            update(AuditLock)
+            .where(AuditLock.name==name)
+            .where(AuditLock.owner==owner)
+            .values(owner=None, acquired=None, expires=None)
+        )
+        db.session.commit()
+
+    def add_findings(self, findings: list[dict]) -> None:
+        """Bulk inserts findings in chunks and commits"""
+        for start in range(0, len(findings), FINDINGS_INSERT_CHUNK_SIZE):
+            db.session.execute(insert(AuditFinding),
+                               findings[start:start + FINDINGS_INSERT_CHUNK_SIZE])
+        db.session.commit()
+
+    def get_paginated_findings(self, filters: dict, page: int, per_page: int):
+        """Findings matching all filters, newest first"""
+        return (AuditFinding.query
+                .filter_by(**filters)
+                .order_by(desc(AuditFinding.id))
+                .paginate(page=page, per_page=per_page, error_out=False))
+
+    def get_paginated_runs(self, page: int, per_page: int):
+        return (AuditRun.query
+                .order_by(desc(AuditRun.id))
+                .paginate(page=page, per_page=per_page, error_out=False))
@@ -0,0 +1,93 @@
+from decimal import Decimal
+from datetime import datetime
+from models import db, Account, Transaction, ArchivedTransaction, AccountBalanceCheckpoint
+from sqlalchemy import select, func, insert, and_, or_, case, exists, literal, type_coerce
+from sqlalchemy.orm import aliased
+from constants.constants import TransactionTypes
+from repositories.transaction_archive_repository import includes_archive
+
+IN_CLAUSE_CHUNK_SIZE = 1000
+
+
+class BalanceCheckpointRepository():
+    def _balances_as_of(self, as_of: datetime, *account_filters):
+        """Select of account_id and balance as of a time for the accounts matching account_filters:
+        each account's latest checkpoint at or before as_of, read from the primary key, plus the
+        signed amounts of its transactions since then, read from its (account_id, timestamp) index.
+        Accounts without a checkpoint sum their transactions from the start.
+        Transactions are only archived up to a month start that has checkpoints, so the archive
+        is only summed, from its own (account_id, timestamp) index, when as_of is older than the
+        archive horizon"""
+        latest = (select(AccountBalanceCheckpoint.account_id,
+                         func.max(AccountBalanceCheckpoint.as_of).label("as_of"))
+                  .join(Account, Account.id==AccountBalanceCheckpoint.account_id)
+                  .where(AccountBalanceCheckpoint.as_of <= as_of, *account_filters)
+                  .group_by(AccountBalanceCheckpoint.account_id)
+                  .subquery())
+
+        def since_checkpoint(model):
+            return and_(model.account_id==Account.id,
+                        model.timestamp < as_of,
+                        or_(latest.c.as_of.is_(None), model.timestamp >= latest.c.as_of))
+
+        def signed_amount(model):
+            return case((model.type==TransactionTypes.WITHDRAW.value, -model.amount), else_=model.amount)
+
+        balance = (func.coalesce(AccountBalanceCheckpoint.balance, 0)
+                   + func.coalesce(func.sum(signed_amount(Transaction)), 0))
+        if includes_archive(as_of):
+            balance += func.coalesce(
+                select(func.sum(signed_amount(ArchivedTransaction)))
+                .where(since_checkpoint(ArchivedTransaction))
+                .scalar_subquery(), 0)
+
+        return (select(Account.id.label("account_id"),
+                       type_coerce(balance, AccountBalanceCheckpoint.balance.type).label("balance"))
+                .outerjoin(latest, latest.c.account_id==Account.id)
+                .outerjoin(AccountBalanceCheckpoint,
+                           and_(AccountBalanceCheckpoint.account_id==Account.id,
+                                AccountBalanceCheckpoint.as_of==latest.c.as_of))
+                .outerjoin(Transaction, since_checkpoint(Transaction))
+                .where(*account_filters)
+                .group_by(Account.id, AccountBalanceCheckpoint.balance, latest.c.as_of))
+
+    def get_balances_as_of(self, account_ids: list[int], as_of: datetime) -> dict[int, Decimal]:
+        """Returns the balance after all transactions before as_of of each existing account in
+        account_ids, in chunks to keep the IN lists short"""
+        account_ids = sorted(set(account_ids))
+        balances = {}
+        for start in range(0, len(account_ids), IN_CLAUSE_CHUNK_SIZE):
+            balances.update(db.session.execute(self._balances_as_of(
+                as_of,
+                Account.id.in_(account_ids[start:start + IN_CLAUSE_CHUNK_SIZE]))).all())
+        return balances
+
+    def create_checkpoints(self, as_of: datetime, first_account_id: int, last_account_id: int) -> int:
+        """Inserts checkpoints at as_of for the accounts with ids in a range that were created
+        before it and do not have one yet, then commits. Returns the number inserted"""
+        existing = aliased(AccountBalanceCheckpoint)
+        balances = self._balances_as_of(
+            as_of,
+            Account.id.between(first_account_id, last_account_id),
+            Account.created < as_of.date(),
+            ~exists().where(existing.account_id==Account.id, existing.as_of==as_of)
+        ).subquery()
+        result = db.session.execute(
+            insert(AccountBalanceCheckpoint).from_select(
+                ["account_id", "as_of", "balance"],
+                select(balances.c.account_id,
+                       literal(as_of, AccountBalanceCheckpoint.as_of.type),
+                       balances.c.balance)))
+        db.session.commit()
+        return result.rowcount
+
+    def get_latest_checkpoint_time(self) -> datetime|None:
+        return db.session.execute(select(func.max(AccountBalanceCheckpoint.as_of))).scalar()
+
+    def get_first_transaction_time(self) -> datetime|None:
+        first_times = [db.session.execute(select(func.min(model.timestamp))).scalar()
+                       for model in (Transaction, ArchivedTransaction)]
+        return min((time for time in first_times if time is not None), default=None)
+
+    def get_account_id_range(self) -> tuple[int|None, int|None]:
+        return db.session.execute(select(func.min(Account.id), func.max(Account.id))).one()
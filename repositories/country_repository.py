@@ -1,24 +1,81 @@
-from models import Country, Customer, db, Account
-from sqlalchemy import func, select, desc
+from collections import namedtuple
+from threading import Lock
+from types import MappingProxyType
+from flask import Flask, abort
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Country
+
+# Session.info key set when a flush wrote to the Countries table
+COUNTRIES_CHANGED_KEY = "countries_changed"
+
+CountryRecord = namedtuple("CountryRecord", ["country_code", "name", "telephone_country_code"])
+
+
+class CountrySnapshot():
+    """The rows of the Countries table, indexed by country code and by lowercased name"""
+    def __init__(self, countries: list[Country]) -> None:
+        self.countries = tuple(CountryRecord(country.country_code, country.name, country.telephone_country_code)
+                               for country in countries)
+        self.by_code = MappingProxyType({country.country_code: country for country in self.countries})
+        self.by_name = MappingProxyType({country.name.lower(): country for country in self.countries})
+
+
+class CountryRegistry():
+    """Countries are reference data that only change when seeded, so they are read once per
+    process and served from memory. A commit that writes to the Countries table through
+    the ORM makes the next lookup read them again"""
+    def __init__(self) -> None:
+        self._snapshot: CountrySnapshot|None = None
+        self._lock = Lock()
+
+    def init_app(self, app: Flask) -> None:
+        """Forgets the countries of any previous app, they are read on the app's first lookup"""
+        self.reload()
+
+    def get_snapshot(self) -> CountrySnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = CountrySnapshot(Country.query.all())
+                snapshot = self._snapshot
+        return snapshot
+
+    def reload(self) -> None:
+        self._snapshot = None
+
+
+country_registry = CountryRegistry()
+
+
+@event.listens_for(Session, "after_flush")
+def _note_country_changes(session: Session, flush_context) -> None:
+    if any(isinstance(instance, Country)
+           for instance in (*session.new, *session.dirty, *session.deleted)):
+        session.info[COUNTRIES_CHANGED_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _reload_changed_countries(session: Session) -> None:
+    if session.info.pop(COUNTRIES_CHANGED_KEY, False):
+        country_registry.reload()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_country_changes(session: Session) -> None:
+    session.info.pop(COUNTRIES_CHANGED_KEY, None)
+
 
 class CountryRepository():
-    def get_country_or_404(self, country_name: str) -> Country:
-        return Country.query.filter(func.lower(Country.name)==country_name.lower()).one_or_404()
-
-    def get_all_countries(self) -> list[Country]:
-        return Country.query.all()
-
-    def get_country_stats(self):
-        """Get country-level stats for all countries in database:
-        country name, number of customers, number of accounts, sum of accounts"""
-        return db.session.execute(
-            select(
-                Country.name,
-                func.count(func.distinct(Customer.id)).label("number_of_customers"),
-                func.count(Account.id).label("number_of_accounts"),
-                func.sum(Account.balance).label("sum_of_accounts"))
-                .join(Customer, Customer.country==Country.country_code)
-                .join(Account, Account.customer_id==Customer.id)
-                .group_by(Customer.country)
-                .order_by(desc("sum_of_accounts"))
-            ).all()
+    def get_country_or_404(self, country_name: str) -> CountryRecord:
+        country = country_registry.get_snapshot().by_name.get(country_name.lower())
+        if country is None:
+            abort(404)
+        return country
+
+    def get_country_from_code(self, country_code: str) -> CountryRecord|None:
+        return country_registry.get_snapshot().by_code.get(country_code)
+
+    def get_all_countries(self) -> tuple[CountryRecord, ...]:
+        return country_registry.get_snapshot().countries
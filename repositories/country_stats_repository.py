@@ -0,0 +1,125 @@
+from decimal import Decimal
+from models import db, Country, Customer, Account, CountryStats
+from sqlalchemy import select, func, insert, delete, desc, cast, Integer
+from sqlalchemy.dialects import mysql, sqlite
+from repositories.query_cache import cached, invalidate_on_commit
+
+COUNTRY_STATS_SLOTS = 16
+IN_CLAUSE_CHUNK_SIZE = 1000
+
+
+class CountryStatsRepository():
+    def add_changes(self, changes: list[tuple[str, int, int, int, Decimal]]) -> None:
+        """Adds (country_code, customer_id, customers, accounts, balance) changes to the country
+        stats without committing, so they are committed with the write that made them.
+        A customer's changes always go to the same slot of its country. Changes are combined
+        per row and upserted in key order, so concurrent writers cannot deadlock on them"""
+        rows = {}
+        for country_code, customer_id, customers, accounts, balance in changes:
+            slot = customer_id % COUNTRY_STATS_SLOTS
+            row = rows.setdefault((country_code, slot),
+                                  {"country_code": country_code, "slot": slot, "number_of_customers": 0,
+                                   "number_of_accounts": 0, "sum_of_accounts": Decimal(0)})
+            row["number_of_customers"] += customers
+            row["number_of_accounts"] += accounts
+            row["sum_of_accounts"] += balance
+        if rows:
+            db.session.execute(self._upsert_statement(), [rows[key] for key in sorted(rows)])
+            invalidate_on_commit("country_stats")
+
+    def add_customer_changes(self, changes: list[tuple[int, int, Decimal]]) -> None:
+        """Adds (customer_id, accounts, balance) changes of customers' accounts to the stats of
+        their countries without committing"""
+        countries = self.get_customer_countries({customer_id for customer_id, _, _ in changes})
+        self.add_changes([(countries[customer_id], customer_id, 0, accounts, balance)
+                          for customer_id, accounts, balance in changes])
+
+    def get_customer_totals(self, customer_id: int) -> tuple[int, Decimal]:
+        """Returns the number of accounts of a customer and the sum of their balances, locking
+        the accounts until the next commit so no transaction changes the sum meanwhile"""
+        accounts, balance = db.session.execute(
+            select(func.count(Account.id), func.coalesce(func.sum(Account.balance), 0))
+            .where(Account.customer_id==customer_id)
+            .with_for_update()).one()
+        return accounts, Decimal(balance)
+
+    def get_customer_countries(self, customer_ids) -> dict[int, str]:
+        """Returns the country code of each customer, in chunks to keep the IN lists short"""
+        customer_ids = list(customer_ids)
+        countries = {}
+        for start in range(0, len(customer_ids), IN_CLAUSE_CHUNK_SIZE):
+            countries.update(db.session.execute(
+                select(Customer.id, Customer.country)
+                .where(Customer.id.in_(customer_ids[start:start + IN_CLAUSE_CHUNK_SIZE]))).all())
+        return countries
+
+    def _upsert_statement(self):
+        """Insert of a slot's changes that adds to the existing row if there is one"""
+        if db.engine.dialect.name == "mysql":
+            statement = mysql.insert(CountryStats)
+            return statement.on_duplicate_key_update(
+                number_of_customers=CountryStats.number_of_customers + statement.inserted.number_of_customers,
+                number_of_accounts=CountryStats.number_of_accounts + statement.inserted.number_of_accounts,
+                sum_of_accounts=CountryStats.sum_of_accounts + statement.inserted.sum_of_accounts)
+        statement = sqlite.insert(CountryStats)
+        return statement.on_conflict_do_update(
+            index_elements=[CountryStats.country_code, CountryStats.slot],
+            set_={"number_of_customers": CountryStats.number_of_customers + statement.excluded.number_of_customers,
+                  "number_of_accounts": CountryStats.number_of_accounts + statement.excluded.number_of_accounts,
+                  "sum_of_accounts": CountryStats.sum_of_accounts + statement.excluded.sum_of_accounts})
+
+    @cached(["country_stats"], shared_only=True)
+    def get_country_stats(self):
+        """Get country-level stats of the countries with accounts, read from their slots:
+        country name, number of customers, number of accounts, sum of accounts"""
+        number_of_accounts = func.sum(CountryStats.number_of_accounts)
+        return db.session.execute(
+            select(
+                Country.name,
+                cast(func.sum(CountryStats.number_of_customers), Integer).label("number_of_customers"),
+                cast(number_of_accounts, Integer).label("number_of_accounts"),
+                func.sum(CountryStats.sum_of_accounts).label("sum_of_accounts"))
+                .join(Country, Country.country_code==CountryStats.country_code)
+                .group_by(Country.country_code, Country.name)
+                .having(number_of_accounts > 0)
+                .order_by(desc("sum_of_accounts"))
+            ).all()
+
+    def _count_stats(self, *group_by):
+        """Select of country code, number of customers, number of accounts and sum of accounts
+        counted from the customers and accounts tables, grouped by country and group_by"""
+        return (select(Customer.country,
+                       *group_by,
+                       func.count(func.distinct(Customer.id)),
+                       func.count(Account.id),
+                       func.coalesce(func.sum(Account.balance), 0))
+                .outerjoin(Account, Account.customer_id==Customer.id)
+                .group_by(Customer.country, *group_by))
+
+    def count_country_stats(self) -> dict[str, tuple[int, int, Decimal]]:
+        """Counts the (number of customers, number of accounts, sum of accounts) of each country
+        from the customers and accounts tables, reading both in full"""
+        return {country_code: (customers, accounts, Decimal(balance))
+                for country_code, customers, accounts, balance
+                in db.session.execute(self._count_stats()).all()}
+
+    def get_stored_country_stats(self) -> dict[str, tuple[int, int, Decimal]]:
+        """The (number of customers, number of accounts, sum of accounts) of each country
+        summed from its slots"""
+        return {country_code: (int(customers), int(accounts), Decimal(balance))
+                for country_code, customers, accounts, balance in db.session.execute(
+                    select(CountryStats.country_code,
+                           func.sum(CountryStats.number_of_customers),
+                           func.sum(CountryStats.number_of_accounts),
+                           func.sum(CountryStats.sum_of_accounts))
+                    .group_by(CountryStats.country_code)).all()}
+
+    def rebuild(self) -> None:
+        """Replaces the country stats with counts from the customers and accounts tables and
+        commits. Writes made while this runs may be lost, so run it when the bank is quiet"""
+        db.session.execute(delete(CountryStats))
+        db.session.execute(insert(CountryStats).from_select(
+            ["country_code", "slot", "number_of_customers", "number_of_accounts", "sum_of_accounts"],
+            self._count_stats((Customer.id % COUNTRY_STATS_SLOTS).label("slot"))))
+        invalidate_on_commit("country_stats")
+        db.session.commit()
@@ -1,8 +1,22 @@
-from models import Customer, Account, db, Country
-from sqlalchemy import select, func, desc, asc
+from models import Customer, Account, db, Country, AuditWindowTransaction
+from sqlalchemy import select, func, desc, asc, update
 from sqlalchemy.orm import joinedload
+from repositories.country_stats_repository import CountryStatsRepository
+from repositories.query_cache import cached, invalidate_on_commit
+
+IN_CLAUSE_CHUNK_SIZE = 1000
+
+# The indexed, lowercased column searched for each searchable attribute
+SEARCH_COLUMNS = {
+    "first_name": Customer.first_name_search,
+    "last_name": Customer.last_name_search,
+    "city": Customer.city_search,
+}
 
 class CustomerRepository():
+    def __init__(self) -> None:
+        self.country_stats_repository = CountryStatsRepository()
+
     def get_customer_from_id(self, customer_id: int, raise_404: bool) -> Customer|None:
         """get customer from id, use raise_404 to show 404 if customer doesn't exist"""
         query = Customer.query.filter_by(id=customer_id)
@@ -10,35 +24,73 @@ class CustomerRepository():
             return query.one_or_404()
         return query.one_or_none()
 
+    @cached(lambda customer_id: [f"customer:{customer_id}"], shared_only=True)
     def get_customer_joined_accounts_country_or_404(self, customer_id: int) -> Customer:
         return Customer.query.filter_by(id=customer_id).options(
             joinedload(Customer.accounts),
             joinedload(Customer.country_details)
             ).one_or_404()
     
+    def get_customers_from_ids(self, customer_ids) -> list[Customer]:
+        """Get all customers with an id in customer_ids, in chunks to keep the IN lists short"""
+        customer_ids = list(customer_ids)
+        customers = []
+        for start in range(0, len(customer_ids), IN_CLAUSE_CHUNK_SIZE):
+            customers += Customer.query.filter(
+                Customer.id.in_(customer_ids[start:start + IN_CLAUSE_CHUNK_SIZE])).all()
+        return customers
+
     def get_customer_from_national_id(self, national_id: str) -> Customer|None:
         return Customer.query.filter_by(national_id=national_id).one_or_none()
     
     def get_all_customers_for_country(self, country: Country) -> list[Customer]:
         return Customer.query.filter_by(country=country.country_code).all()
     
-    def get_top_10_customers_for_country(self, country_name: str) -> list[Customer]:
-        return db.session.execute(
-                select(
-                Customer, 
+    def _customer_totals(self):
+        """Select of customers with their number of accounts and sum of balances"""
+        return (select(
+                Customer,
                 func.count(Account.id).label("number_of_accounts"),
                 func.sum(Account.balance).label("sum_of_accounts"))
                 .join(Account, Account.customer_id==Customer.id)
-                .join(Country, Country.country_code==Customer.country)
-                .where(Country.name==country_name)
-                .group_by(Customer.id)
+                .group_by(Customer.id))
+
+    def get_top_customers_for_country(self, country_code: str, limit: int) -> list:
+        """Get the customers of a country with the largest sum of balances, largest first"""
+        return db.session.execute(
+                self._customer_totals()
+                .where(Customer.country==country_code)
                 .order_by(desc("sum_of_accounts"))
-                .limit(10)
+                .limit(limit)
             ).all()
 
+    def get_customer_totals_in_country(self, customer_ids, country_code: str) -> list:
+        """Get the customers with an id in customer_ids that live in a country, with their
+        number of accounts and sum of balances, in chunks to keep the IN lists short"""
+        customer_ids = list(customer_ids)
+        rows = []
+        for start in range(0, len(customer_ids), IN_CLAUSE_CHUNK_SIZE):
+            rows += db.session.execute(
+                self._customer_totals()
+                .where(Customer.id.in_(customer_ids[start:start + IN_CLAUSE_CHUNK_SIZE]),
+                       Customer.country==country_code)).all()
+        return rows
+
     def edit_customer(self, customer: Customer, customer_details: dict) -> None:
+        """Edits a customer, moving its counts and balance to the stats of its new country
+        and its transactions in the audit window to that country if the country changed"""
+        old_country = customer.country
         for attribute_name, value in customer_details.items():
             setattr(customer, attribute_name, value)
+        if customer.country != old_country:
+            accounts, balance = self.country_stats_repository.get_customer_totals(customer.id)
+            self.country_stats_repository.add_changes(
+                [(old_country, customer.id, -1, -accounts, -balance),
+                 (customer.country, customer.id, 1, accounts, balance)])
+            db.session.execute(update(AuditWindowTransaction)
+                               .where(AuditWindowTransaction.customer_id==customer.id)
+                               .values(country=customer.country))
+        invalidate_on_commit(f"customer:{customer.id}")
         db.session.commit()
 
     def create_customer(self, customer_details: dict) -> Customer:
@@ -50,6 +102,8 @@ class CustomerRepository():
             setattr(new_customer, attribute_name, value)
         
         db.session.add(new_customer)
+        db.session.flush()
+        self.country_stats_repository.add_changes([(new_customer.country, new_customer.id, 1, 0, 0)])
         db.session.commit()
 
         return new_customer
@@ -62,14 +116,13 @@ class CustomerRepository():
             page,
             results_per_page
             ) -> list[Customer]:
-        """ Dynamically constructs a query based on supplied filters in query_criteria
-        and sort args """
+        """ Dynamically constructs a query based on supplied filters in query_criteria,
+        which should be lowercased, and sort args """
         query = Customer.query
         
         # apply filters
         for attribute_name, value in query_criteria.items():
-            query_col = getattr(Customer, attribute_name)
-            query = query.filter(func.lower(query_col) == value)
+            query = query.filter(SEARCH_COLUMNS[attribute_name] == value)
         
         # apply sorting
         order_by_col = getattr(Customer, sort_col)
@@ -0,0 +1,187 @@
+from concurrent.futures import Future
+from decimal import Decimal
+from queue import Empty, SimpleQueue
+from threading import Thread
+import time
+from flask import Flask
+from models import db
+from sqlalchemy.exc import IntegrityError
+from repositories.idempotency_repository import request_fingerprint
+from constants.constants import TransactionTypes
+from constants.errors_messages import ErrorMessages
+
+
+class TransactionIntent():
+    """A deposit or withdrawal waiting to be written, with the future its caller waits on"""
+    def __init__(self,
+                 account_id: int,
+                 amount: Decimal,
+                 transaction_type: TransactionTypes,
+                 idempotency_key: str=None
+                 ) -> None:
+        self.account_id = account_id
+        self.amount = amount
+        self.transaction_type = transaction_type
+        self.idempotency_key = idempotency_key
+        self.fingerprint = request_fingerprint(transaction_type.value, account_id, None, amount)
+        self.future = Future()
+
+    def follow(self, first: "TransactionIntent") -> None:
+        """Resolves this intent, a retry of first with the same key, the same way first is,
+        but as not written"""
+        def copy_outcome(future: Future) -> None:
+            if self.future.done():
+                return
+            if future.exception():
+                self.future.set_exception(future.exception())
+            else:
+                self.future.set_result((future.result()[0], False))
+        first.future.add_done_callback(copy_outcome)
+
+
+class GroupCommitWriter():
+    """Writes deposits and withdrawals submitted by concurrent requests from one background thread,
+    in batches of up to max_batch_size that are committed together, so a burst costs one commit
+    (and one fsync) per batch instead of one per transaction. A batch is written when it is full
+    or max_wait seconds after its first transaction arrived, whichever comes first"""
+    def __init__(self,
+                 app: Flask,
+                 transaction_repository,
+                 max_batch_size: int=100,
+                 max_wait: float=0.005,
+                 timeout: float=10
+                 ) -> None:
+        self.app = app
+        self.transaction_repository = transaction_repository
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # Seconds callers wait for their batch, in case the writer thread stalls or dies
+        self.timeout = timeout
+        self._queue = SimpleQueue()
+        self._thread = Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self,
+               account_id: int,
+               amount: Decimal,
+               transaction_type: TransactionTypes,
+               idempotency_key: str=None
+               ) -> Future:
+        """Queues a transaction and returns at once. The future's result is the committed
+        Transaction and True, or the one already made with the same idempotency key and False.
+        It raises ValueError if the transaction was rejected or the key was used for another one"""
+        intent = TransactionIntent(account_id, amount, transaction_type, idempotency_key)
+        self._queue.put(intent)
+        return intent.future
+
+    def stop(self) -> None:
+        """Writes the transactions already submitted and stops the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self) -> tuple[list[TransactionIntent], bool]:
+        """Waits for a transaction, then collects more until the batch is full or max_wait has
+        passed. Returns the batch and whether the writer was asked to stop"""
+        intent = self._queue.get()
+        if intent is None:
+            return [], True
+
+        batch = [intent]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                intent = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
+                break
+            if intent is None:
+                return batch, True
+            batch.append(intent)
+        return batch, False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                with self.app.app_context():
+                    self._write(batch)
+
+    def _resolve_stored_keys(self, batch: list[TransactionIntent]) -> list[TransactionIntent]:
+        """Resolves the intents whose idempotency key has already made a transaction, and those
+        repeating the key of an earlier intent in the batch, rejecting the ones whose request
+        differs from the key's. Returns the intents left to write"""
+        keys = [intent.idempotency_key for intent in batch if intent.idempotency_key]
+        if not keys:
+            return batch
+
+        stored_keys = self.transaction_repository.idempotency_repository.get_stored_keys(keys)
+        stored_transactions = {}
+        for transaction in self.transaction_repository.idempotency_repository.get_transactions(
+                [id for _, ids in stored_keys.values() for id in ids]):
+            # Detached before the batch's commit expires them, like the transactions it writes
+            db.session.expunge(transaction)
+            stored_transactions[transaction.id] = transaction
+        first_with_key = {}
+        remaining = []
+        for intent in batch:
+            if intent.idempotency_key in stored_keys:
+                fingerprint, ids = stored_keys[intent.idempotency_key]
+                if fingerprint not in (None, intent.fingerprint):
+                    intent.future.set_exception(ValueError(ErrorMessages.IDEMPOTENCY_KEY_REUSED.value))
+                else:
+                    intent.future.set_result((stored_transactions[ids[0]], False))
+            elif intent.idempotency_key in first_with_key:
+                first = first_with_key[intent.idempotency_key]
+                if first.fingerprint != intent.fingerprint:
+                    intent.future.set_exception(ValueError(ErrorMessages.IDEMPOTENCY_KEY_REUSED.value))
+                else:
+                    intent.follow(first)
+            else:
+                if intent.idempotency_key:
+                    first_with_key[intent.idempotency_key] = intent
+                remaining.append(intent)
+        return remaining
+
+    def _write(self, batch: list[TransactionIntent], retry: bool=True) -> None:
+        """Locks every account in the batch, applies the transactions in the order they were
+        submitted against the balances left by the ones before, and commits the accepted ones
+        at once. Callers are woken only after the commit, or with its error if it fails.
+        If another process commits one of the batch's idempotency keys first, the batch is
+        written once more without it"""
+        accepted = []
+        try:
+            batch = self._resolve_stored_keys(batch)
+            accounts = self.transaction_repository.lock_accounts([intent.account_id for intent in batch])
+            balances = {account_id: account.balance for account_id, account in accounts.items()}
+            transactions = []
+            for intent in batch:
+                if intent.account_id not in accounts:
+                    intent.future.set_exception(ValueError(ErrorMessages.UNKNOWN_ACCOUNT.value))
+                    continue
+                if intent.transaction_type == TransactionTypes.WITHDRAW:
+                    if intent.amount > balances[intent.account_id]:
+                        intent.future.set_exception(ValueError(ErrorMessages.INSUFFICIENT_FUNDS.value))
+                        continue
+                    balances[intent.account_id] -= intent.amount
+                else:
+                    balances[intent.account_id] += intent.amount
+
+                accepted.append(intent)
+                transactions.append((accounts[intent.account_id], intent.amount,
+                                     intent.transaction_type, balances[intent.account_id]))
+
+            executed = self.transaction_repository.execute_transactions(
+                transactions,
+                [intent.idempotency_key for intent in accepted])
+            for intent, transaction in zip(accepted, executed):
+                intent.future.set_result((transaction, True))
+        except Exception as error:
+            self.transaction_repository.rollback()
+            if retry and isinstance(error, IntegrityError):
+                # The key another process committed is resolved as stored on the second write
+                self._write([intent for intent in batch if not intent.future.done()], retry=False)
+                return
+            self.app.logger.exception("Group commit of %s transactions failed", len(batch))
+            for intent in batch:
+                if not intent.future.done():
+                    intent.future.set_exception(error)
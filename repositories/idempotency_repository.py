@@ -0,0 +1,65 @@
+from datetime import datetime
+from decimal import Decimal
+from models import db, IdempotencyKey, Transaction
+from sqlalchemy import select, delete
+
+PURGE_CHUNK_SIZE = 10000
+
+
+def request_fingerprint(transaction_type_name: str,
+                        account_id: int,
+                        to_account_id: int|None,
+                        amount: Decimal
+                        ) -> str:
+    """Identifies what a submission asked for, so a key reused for another one is caught"""
+    return f"{transaction_type_name}:{account_id}:{to_account_id or ''}:{amount:.2f}"
+
+
+def transactions_fingerprint(transactions: list[Transaction]) -> str:
+    """The request_fingerprint of the submission that made transactions,
+    a withdrawal and a deposit for a transfer"""
+    if len(transactions) == 2:
+        withdrawal, deposit = transactions
+        return request_fingerprint("transfer", withdrawal.account_id, deposit.account_id, withdrawal.amount)
+    return request_fingerprint(transactions[0].type, transactions[0].account_id, None, transactions[0].amount)
+
+
+class IdempotencyRepository():
+    def add_key(self, key: str, transactions: list[Transaction], created: datetime) -> None:
+        """Adds a key with the ids and fingerprint of the transactions it made to the session
+        without committing, so it is committed together with them. A second commit of the same
+        key fails on its primary key, rolling back that submission's transactions too"""
+        db.session.add(IdempotencyKey(key=key,
+                                      created=created,
+                                      transaction_ids=",".join(str(transaction.id) for transaction in transactions),
+                                      fingerprint=transactions_fingerprint(transactions)))
+
+    def get_stored_keys(self, keys: list[str]) -> dict[str, tuple[str|None, list[int]]]:
+        """Returns the fingerprint and transaction ids of each of keys that has been stored"""
+        rows = db.session.execute(
+            select(IdempotencyKey.key, IdempotencyKey.fingerprint, IdempotencyKey.transaction_ids)
+            .where(IdempotencyKey.key.in_(keys)))
+        return {key: (fingerprint, [int(id) for id in transaction_ids.split(",")])
+                for key, fingerprint, transaction_ids in rows}
+
+    def get_transactions(self, transaction_ids: list[int]) -> list[Transaction]:
+        return (Transaction.query
+                .filter(Transaction.id.in_(transaction_ids))
+                .order_by(Transaction.id)
+                .all())
+
+    def delete_keys_created_before(self, before: datetime) -> int:
+        """Deletes the keys created before a time in chunks, committing after each so the
+        table is never locked for long. Returns the number of keys deleted"""
+        deleted = 0
+        while True:
+            keys = db.session.execute(
+                select(IdempotencyKey.key)
+                .where(IdempotencyKey.created < before)
+                .limit(PURGE_CHUNK_SIZE)
+            ).scalars().all()
+            if not keys:
+                return deleted
+            db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.key.in_(keys)))
+            db.session.commit()
+            deleted += len(keys)
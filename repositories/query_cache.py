@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from uuid import uuid4
+import pickle
+import time
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db
+
+TAG_VERSIONS_KEY = "query-cache-tags"
+# Session.info key of the tags to invalidate when the session commits
+PENDING_TAGS_KEY = "query_cache_pending_tags"
+
+
+class LocalCacheBackend():
+    """Keeps up to max_entries values in this process, evicting the least recently used
+    one when full and the ones older than their ttl when read"""
+    def __init__(self, max_entries: int=10000) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float|None, bytes]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> bytes|None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float=None) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class LocalSharedClient():
+    """Stands in for a shared cache server in a single process, with the get and set
+    methods of a redis.Redis client the shared backend uses"""
+    def __init__(self) -> None:
+        self._values: dict[str, tuple[float|None, bytes]] = {}
+        self._lock = Lock()
+
+    def get(self, key: str) -> bytes|None:
+        with self._lock:
+            expires, value = self._values.get(key, (None, None))
+            if expires is not None and expires < time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key: str, value: bytes, ex: int=None) -> None:
+        with self._lock:
+            self._values[key] = (time.monotonic() + ex if ex else None, value)
+
+
+class SharedCacheBackend():
+    """Keeps values in a cache server shared by every process, such as redis.Redis(), so an
+    invalidation in one process is seen by all. The server evicts by its own policy"""
+    def __init__(self, client=None, prefix: str="bank:") -> None:
+        self.client = client or LocalSharedClient()
+        self.prefix = prefix
+
+    def get(self, key: str) -> bytes|None:
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: float=None) -> None:
+        self.client.set(self.prefix + key, value, ex=int(ttl) if ttl else None)
+
+
+class QueryCache():
+    """Caches repository query results by method and arguments for up to ttl seconds.
+    Each result is stored with the versions of its tags, and invalidating a tag gives it a
+    new version, so every result stored under it is missed from then on. Results are stored
+    pickled, so a hit returns ORM objects that no other session has changed; they are merged
+    into the current session without querying"""
+    def __init__(self, backend=None, ttl: float=60) -> None:
+        self.backend = backend or LocalCacheBackend()
+        self.ttl = ttl
+        self._counters: dict[str, list[int]] = {}
+        self._lock = Lock()
+
+    def init_app(self, app: Flask) -> None:
+        """Uses a new backend of the kind the app is configured with"""
+        if app.config.get("QUERY_CACHE_BACKEND") == "shared":
+            self.backend = SharedCacheBackend(app.config.get("QUERY_CACHE_SHARED_CLIENT"))
+        else:
+            self.backend = LocalCacheBackend(app.config.get("QUERY_CACHE_MAX_ENTRIES", 10000))
+        self.ttl = app.config.get("QUERY_CACHE_TTL", 60)
+        self.reset_stats()
+
+    def _tag_version(self, tag: str) -> bytes:
+        """Versions are random, so one that was evicted can never come back"""
+        key = f"{TAG_VERSIONS_KEY}:{tag}"
+        version = self.backend.get(key)
+        if version is None:
+            version = uuid4().bytes
+            self.backend.set(key, version)
+        return version
+
+    def get_or_load(self, name: str, arguments: tuple, tags: list[str], load, shared_only: bool=False):
+        """Returns the cached result of a query, or loads and caches it. A shared_only query
+        is always loaded unless the backend is shared, see cached"""
+        if shared_only and not isinstance(self.backend, SharedCacheBackend):
+            return load()
+
+        key = f"{name}:{arguments!r}"
+        versions = [self._tag_version(tag) for tag in tags]
+        entry = self.backend.get(key)
+        if entry is not None:
+            stored_versions, value = pickle.loads(entry)
+            if stored_versions == versions:
+                self._count(name, 0)
+                return self._attach(value)
+
+        self._count(name, 1)
+        value = load()
+        self.backend.set(key, pickle.dumps((versions, value)), self.ttl)
+        return value
+
+    def _attach(self, value):
+        if isinstance(value, db.Model):
+            return db.session.merge(value, load=False)
+        if isinstance(value, list):
+            return [self._attach(item) for item in value]
+        return value
+
+    def invalidate(self, *tags: str) -> None:
+        for tag in tags:
+            self.backend.set(f"{TAG_VERSIONS_KEY}:{tag}", uuid4().bytes)
+
+    def _count(self, name: str, index: int) -> None:
+        with self._lock:
+            self._counters.setdefault(name, [0, 0])[index] += 1
+
+    def get_stats(self) -> dict:
+        """Hits and misses of each cached query since the stats were reset"""
+        with self._lock:
+            queries = {name: {"hits": hits, "misses": misses}
+                       for name, (hits, misses) in sorted(self._counters.items())}
+        return {"hits": sum(query["hits"] for query in queries.values()),
+                "misses": sum(query["misses"] for query in queries.values()),
+                "queries": queries}
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+
+query_cache = QueryCache()
+
+
+def cached(tags=(), shared_only: bool=False):
+    """Caches the results of a repository method in query_cache. tags is a list of tag names,
+    or a function of the method's arguments that returns one. Set shared_only for reads that
+    must not be stale, like balances: a local backend only sees the invalidations of its own
+    process, so they are only cached when the backend is shared"""
+    def decorator(method):
+        name = method.__qualname__
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            arguments = (*args, tuple(sorted(kwargs.items()))) if kwargs else args
+            return query_cache.get_or_load(name, arguments,
+                                           tags(*args, **kwargs) if callable(tags) else tags,
+                                           lambda: method(self, *args, **kwargs),
+                                           shared_only)
+        return wrapper
+    return decorator
+
+
+def invalidate_on_commit(*tags: str) -> None:
+    """Invalidates tags once the current transaction commits, when other sessions can read
+    the change. Forgotten on rollback"""
+    db.session.info.setdefault(PENDING_TAGS_KEY, set()).update(tags)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_tags(session: Session) -> None:
+    tags = session.info.pop(PENDING_TAGS_KEY, None)
+    if tags:
+        query_cache.invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_tags(session: Session) -> None:
+    session.info.pop(PENDING_TAGS_KEY, None)
@@ -0,0 +1,43 @@
+from datetime import date, datetime
+from models import db, Account
+from sqlalchemy import select
+from repositories.transaction_archive_repository import select_transactions
+
+STATEMENT_FETCH_SIZE = 1000
+
+
+class StatementRepository():
+    def get_accounts(self, first_account_id: int, last_account_id: int, created_before: date) -> list:
+        """Returns (id, customer_id, account_type) of the accounts with ids in a range that
+        were opened before created_before, ordered by id"""
+        return db.session.execute(
+            select(Account.id, Account.customer_id, Account.account_type)
+            .where(Account.id.between(first_account_id, last_account_id),
+                   Account.created < created_before)
+            .order_by(Account.id)).all()
+
+    def iter_transactions(self,
+                          first_account_id: int,
+                          last_account_id: int,
+                          from_date: datetime,
+                          to_date: datetime):
+        """Yields (id, type, timestamp, amount, new_balance, account_id) rows of the accounts with
+        ids in a range from from_date up to but not including to_date, ordered by account,
+        timestamp and id. This is one range scan of the (account_id, timestamp, id) index, merged
+        with one of the archive's for months older than the archive horizon, fetched from a server-side
+        cursor so a partition never has to fit in memory"""
+        def build_query(source):
+            return (select(source.id.label("id"),
+                           source.type.label("type"),
+                           source.timestamp.label("timestamp"),
+                           source.amount.label("amount"),
+                           source.new_balance.label("new_balance"),
+                           source.account_id.label("account_id"))
+                    .where(source.account_id.between(first_account_id, last_account_id),
+                           source.timestamp >= from_date,
+                           source.timestamp < to_date))
+
+        query = select_transactions(from_date, build_query)
+        columns = query.selected_columns
+        query = query.order_by(columns.account_id, columns.timestamp, columns.id)
+        yield from db.session.execute(query.execution_options(yield_per=STATEMENT_FETCH_SIZE))
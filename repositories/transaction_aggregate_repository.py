@@ -0,0 +1,141 @@
+from decimal import Decimal
+from datetime import datetime, timedelta
+from models import db, Customer, Account, Transaction, CustomerHourlyTransactions
+from sqlalchemy import select, func, insert, delete, union_all
+from sqlalchemy.dialects import mysql, sqlite
+from repositories.transaction_archive_repository import transactions_from
+
+
+def hour_of(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class TransactionAggregateRepository():
+    def add_transaction(self, customer_id: int, timestamp: datetime, amount: Decimal) -> None:
+        """Adds a transaction to its customer's hourly aggregate without committing,
+        so it is committed together with the transaction"""
+        self.add_transactions([(customer_id, timestamp, amount)])
+
+    def add_transactions(self, transactions: list[tuple[int, datetime, Decimal]]) -> None:
+        """Adds (customer_id, timestamp, amount) transactions to their hourly aggregates without
+        committing. They are combined per customer and hour first, then upserted in one statement"""
+        aggregates = {}
+        for customer_id, timestamp, amount in transactions:
+            aggregate = aggregates.setdefault(
+                (customer_id, hour_of(timestamp)),
+                {"customer_id": customer_id, "hour": hour_of(timestamp),
+                 "amount_sum": Decimal(0), "transaction_count": 0, "max_amount": amount})
+            aggregate["amount_sum"] += amount
+            aggregate["transaction_count"] += 1
+            aggregate["max_amount"] = max(aggregate["max_amount"], amount)
+        if aggregates:
+            db.session.execute(self._upsert_statement(), list(aggregates.values()))
+
+    def _upsert_statement(self):
+        """Insert of an hourly aggregate that adds to the existing row if there is one"""
+        if db.engine.dialect.name == "mysql":
+            statement = mysql.insert(CustomerHourlyTransactions)
+            return statement.on_duplicate_key_update(
+                amount_sum=CustomerHourlyTransactions.amount_sum + statement.inserted.amount_sum,
+                transaction_count=(CustomerHourlyTransactions.transaction_count
+                                   + statement.inserted.transaction_count),
+                max_amount=func.greatest(CustomerHourlyTransactions.max_amount,
+                                         statement.inserted.max_amount))
+        statement = sqlite.insert(CustomerHourlyTransactions)
+        return statement.on_conflict_do_update(
+            index_elements=[CustomerHourlyTransactions.customer_id,
+                            CustomerHourlyTransactions.hour],
+            set_={"amount_sum": CustomerHourlyTransactions.amount_sum + statement.excluded.amount_sum,
+                  "transaction_count": (CustomerHourlyTransactions.transaction_count
+                                        + statement.excluded.transaction_count),
+                  "max_amount": func.max(CustomerHourlyTransactions.max_amount,
+                                         statement.excluded.max_amount)})
+
+    def _hour_expression(self, timestamp_column):
+        """Truncates a timestamp column to the hour in SQL, formatted the way each database
+        stores datetimes so the result compares equal to hour_of"""
+        if db.engine.dialect.name == "mysql":
+            return func.date_format(timestamp_column, "%Y-%m-%d %H:00:00")
+        return func.strftime("%Y-%m-%d %H:00:00.000000", timestamp_column)
+
+    def backfill(self, from_date: datetime=None) -> int:
+        """Rebuilds the hourly aggregates from the hour of from_date, or all of them, from the
+        transactions table, and the archive if from_date is older than the archive horizon,
+        in two bulk statements and commits. Transactions made while this runs may be counted
+        twice or not at all, so run it when the bank is quiet.
+        Returns the number of hourly aggregates written"""
+        source = transactions_from(from_date)
+        hour = self._hour_expression(source.timestamp)
+        transactions_per_hour = (
+            select(Account.customer_id,
+                   hour,
+                   func.sum(source.amount),
+                   func.count(source.id),
+                   func.max(source.amount))
+            .join(Account, Account.id==source.account_id)
+            .group_by(Account.customer_id, hour)
+        )
+        clear_aggregates = delete(CustomerHourlyTransactions)
+        if from_date:
+            transactions_per_hour = transactions_per_hour.where(
+                source.timestamp >= hour_of(from_date))
+            clear_aggregates = clear_aggregates.where(
+                CustomerHourlyTransactions.hour >= hour_of(from_date))
+
+        db.session.execute(clear_aggregates)
+        result = db.session.execute(
+            insert(CustomerHourlyTransactions).from_select(
+                ["customer_id", "hour", "amount_sum", "transaction_count", "max_amount"],
+                transactions_per_hour))
+        db.session.commit()
+        return result.rowcount
+
+    def get_customer_sums(self,
+                          from_date: datetime,
+                          to_date: datetime,
+                          country_code: str=None,
+                          customer_id: int=None):
+        """Select of customer_id and amount_sum per customer, summing transactions from
+        from_date to to_date (both inclusive), optionally for one country or customer.
+        Whole hours are read from the hourly aggregates, only the partial hours at either
+        end of the period are read from the transactions table"""
+        first_whole_hour = hour_of(from_date)
+        if first_whole_hour < from_date:
+            first_whole_hour += timedelta(hours=1)
+        last_hour = hour_of(to_date)
+
+        def raw_transactions(from_timestamp, to_timestamp, include_end):
+            part = (select(Account.customer_id, Transaction.amount.label("amount"))
+                    .join(Account, Account.id==Transaction.account_id)
+                    .where(Transaction.timestamp >= from_timestamp))
+            if include_end:
+                part = part.where(Transaction.timestamp <= to_timestamp)
+            else:
+                part = part.where(Transaction.timestamp < to_timestamp)
+            return self._filter(part, Account.customer_id, country_code, customer_id)
+
+        if first_whole_hour > last_hour:
+            # The period lies within a single hour
+            parts = [raw_transactions(from_date, to_date, include_end=True)]
+        else:
+            whole_hours = self._filter(
+                select(CustomerHourlyTransactions.customer_id,
+                       CustomerHourlyTransactions.amount_sum.label("amount"))
+                .where(CustomerHourlyTransactions.hour >= first_whole_hour)
+                .where(CustomerHourlyTransactions.hour < last_hour),
+                CustomerHourlyTransactions.customer_id, country_code, customer_id)
+            parts = [raw_transactions(from_date, first_whole_hour, include_end=False),
+                     whole_hours,
+                     raw_transactions(last_hour, to_date, include_end=True)]
+
+        amounts = union_all(*parts).subquery()
+        return (select(amounts.c.customer_id, func.sum(amounts.c.amount).label("amount_sum"))
+                .group_by(amounts.c.customer_id))
+
+    def _filter(self, part, customer_id_column, country_code: str, customer_id: int):
+        if country_code:
+            part = (part.join(Customer, Customer.id==customer_id_column)
+                    .where(Customer.country==country_code))
+        if customer_id:
+            part = part.where(customer_id_column==customer_id)
+        return part
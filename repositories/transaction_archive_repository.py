@@ -0,0 +1,63 @@
+from datetime import datetime
+from models import db, Transaction, ArchivedTransaction, TransactionFlag, AuditWindowTransaction
+from sqlalchemy import select, insert, delete, exists, union_all
+from sqlalchemy.orm import aliased
+from constants.constants import BusinessConstants
+
+TRANSACTION_COLUMNS = ("id", "type", "timestamp", "amount", "new_balance", "account_id")
+
+
+def archive_horizon(now: datetime=None) -> datetime:
+    """Transactions are only archived once they are older than this"""
+    return (now or datetime.now()) - BusinessConstants.TRANSACTION_ARCHIVE_HORIZON
+
+
+def includes_archive(from_date: datetime|None) -> bool:
+    """Whether transactions from from_date on, or all of them if it is None, may be archived"""
+    return from_date is None or from_date < archive_horizon()
+
+
+def transactions_from(from_date: datetime|None):
+    """Returns Transaction if every transaction from from_date on is in the Transactions table,
+    otherwise Transaction mapped over the union of Transactions and ArchivedTransactions, which
+    queries use in its place. Their filters are pushed down into both tables' indexes"""
+    if not includes_archive(from_date):
+        return Transaction
+    all_transactions = union_all(
+        select(*(getattr(Transaction, column) for column in TRANSACTION_COLUMNS)),
+        select(*(getattr(ArchivedTransaction, column) for column in TRANSACTION_COLUMNS)))
+    return aliased(Transaction, all_transactions.subquery("AllTransactions"))
+
+
+def select_transactions(from_date: datetime|None, build_query):
+    """Returns build_query(Transaction), or if transactions from from_date on may be archived its
+    union with build_query(ArchivedTransaction). Either can be ordered by selected_columns, so
+    build_query should label its columns. Each side reads its own table's indexes, and an
+    ordered union is merged from both without a sort"""
+    if not includes_archive(from_date):
+        return build_query(Transaction)
+    return union_all(build_query(Transaction), build_query(ArchivedTransaction))
+
+
+class TransactionArchiveRepository():
+    def archive_batch(self, before: datetime, batch_size: int) -> int:
+        """Moves up to batch_size of the oldest transactions made before a time to the archive
+        and commits, so rows are only locked for one short batch. Transactions referenced by
+        fraud flags or the audit window are left in place. Returns the number moved"""
+        ids = db.session.execute(
+            select(Transaction.id)
+            .where(Transaction.timestamp < before,
+                   ~exists().where(TransactionFlag.transaction_id==Transaction.id),
+                   ~exists().where(AuditWindowTransaction.transaction_id==Transaction.id))
+            .order_by(Transaction.timestamp)
+            .limit(batch_size)).scalars().all()
+        if not ids:
+            return 0
+
+        db.session.execute(insert(ArchivedTransaction).from_select(
+            TRANSACTION_COLUMNS,
+            select(*(getattr(Transaction, column) for column in TRANSACTION_COLUMNS))
+            .where(Transaction.id.in_(ids))))
+        db.session.execute(delete(Transaction).where(Transaction.id.in_(ids)))
+        db.session.commit()
+        return len(ids)
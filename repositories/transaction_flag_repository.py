@@ -0,0 +1,59 @@
+from datetime import datetime
+from models import db, Customer, Account, Transaction, TransactionFlag
+from sqlalchemy import select
+from sqlalchemy.dialects import mysql, sqlite
+from constants.constants import AuditRules
+
+
+class TransactionFlagRepository():
+    def get_customer_country(self, customer_id: int) -> str|None:
+        return db.session.execute(
+            select(Customer.country).where(Customer.id==customer_id)
+        ).scalar()
+
+    def get_recent_transactions_of_customer(self, customer_id: int, from_date: datetime) -> list:
+        """Get timestamp, amount, id and account id of a customer's transactions from from_date,
+        oldest first, and whether each one is already flagged by the recent transactions rule"""
+        return db.session.execute(
+            select(Transaction.timestamp,
+                   Transaction.amount,
+                   Transaction.id,
+                   Transaction.account_id,
+                   TransactionFlag.id.is_not(None).label("flagged"))
+            .join(Account, Account.id==Transaction.account_id)
+            .outerjoin(TransactionFlag,
+                       (TransactionFlag.transaction_id==Transaction.id)
+                       & (TransactionFlag.rule==AuditRules.RECENT_TRANSACTIONS.value))
+            .where(Account.customer_id==customer_id)
+            .where(Transaction.timestamp >= from_date)
+            .order_by(Transaction.timestamp, Transaction.id)
+        ).all()
+
+    def add_flags(self, flags: list[dict]) -> None:
+        """Bulk inserts flags and commits. Flags another process already raised for the same
+        transaction and rule are skipped, the others are still inserted"""
+        db.session.execute(self._insert_ignore_statement(), flags)
+        db.session.commit()
+
+    def _insert_ignore_statement(self):
+        """Insert of a flag that does nothing if the transaction already has a flag for the rule"""
+        if db.engine.dialect.name == "mysql":
+            statement = mysql.insert(TransactionFlag)
+            return statement.on_duplicate_key_update(id=TransactionFlag.id)
+        return sqlite.insert(TransactionFlag).on_conflict_do_nothing(
+            index_elements=[TransactionFlag.transaction_id, TransactionFlag.rule])
+
+    def rollback(self) -> None:
+        db.session.rollback()
+
+    def get_flags_for_country(self,
+                              country_code: str,
+                              from_date: datetime,
+                              to_date: datetime
+                              ) -> list[TransactionFlag]:
+        """Get flags raised in a country from from_date (inclusive) to to_date (exclusive)"""
+        return (TransactionFlag.query
+                .filter(TransactionFlag.country==country_code)
+                .filter(TransactionFlag.flagged >= from_date)
+                .filter(TransactionFlag.flagged < to_date)
+                .all())
@@ -1,75 +1,339 @@
+from concurrent.futures import TimeoutError
 from decimal import Decimal
-from datetime import datetime, date
-from models import db, Customer, Account, Transaction, Country
-from sqlalchemy import select, func, desc, between
+from datetime import datetime, date, time
+from flask import Flask
+from models import db, Customer, Account, Transaction
+from sqlalchemy import select, func, desc, between, insert, or_, and_
+from repositories.transaction_aggregate_repository import TransactionAggregateRepository
+from repositories.country_stats_repository import CountryStatsRepository
+from repositories.query_cache import invalidate_on_commit
+from repositories.group_commit_writer import GroupCommitWriter
+from repositories.idempotency_repository import IdempotencyRepository
+from repositories.transaction_archive_repository import (archive_horizon, transactions_from,
+                                                         select_transactions)
 from constants.constants import TransactionTypes
+from constants.errors_messages import ErrorMessages
+
+TRANSACTION_INSERT_CHUNK_SIZE = 5000
+EXPORT_PARTITION_SIZE = 1000
+LOCK_ACCOUNTS_CHUNK_SIZE = 1000
 
 
 class TransactionRepository():
+    def __init__(self) -> None:
+        self.aggregate_repository = TransactionAggregateRepository()
+        self.country_stats_repository = CountryStatsRepository()
+        self.idempotency_repository = IdempotencyRepository()
+        self.group_commit_writer = None
+
+    def enable_group_commit(self,
+                            app: Flask,
+                            max_batch_size: int=100,
+                            max_wait: float=0.005,
+                            timeout: float=10
+                            ) -> None:
+        """Makes execute_group_committed hand transactions to a GroupCommitWriter,
+        which commits them in batches of up to max_batch_size or after max_wait seconds.
+        Callers wait up to timeout seconds for their batch"""
+        self.disable_group_commit()
+        self.group_commit_writer = GroupCommitWriter(app, self, max_batch_size, max_wait, timeout)
+
+    def disable_group_commit(self) -> None:
+        """Writes the transactions already submitted and stops the group commit writer"""
+        writer, self.group_commit_writer = self.group_commit_writer, None
+        if writer:
+            writer.stop()
+
+    def lock_accounts(self, account_ids: list[int]) -> dict[int, Account]:
+        """Reloads accounts with SELECT ... FOR UPDATE, locking them until the next commit or
+        rollback. Rows are locked in id order so concurrent transfers cannot deadlock,
+        in chunks so a large batch of accounts does not hit the database's parameter limit"""
+        account_ids = sorted(set(account_ids))
+        accounts = {}
+        for start in range(0, len(account_ids), LOCK_ACCOUNTS_CHUNK_SIZE):
+            accounts.update((account.id, account) for account in (
+                Account.query
+                .filter(Account.id.in_(account_ids[start:start + LOCK_ACCOUNTS_CHUNK_SIZE]))
+                .order_by(Account.id)
+                .with_for_update()
+                .populate_existing()
+                .all()))
+        return accounts
+
+    def rollback(self) -> None:
+        db.session.rollback()
+
+    def _add_transactions(self,
+                          transactions: list[tuple[Account, Decimal, TransactionTypes, Decimal]]
+                          ) -> list[Transaction]:
+        """Adds (account, amount, transaction_type, new_balance) transactions and the accounts'
+        new balances to the session without committing, with their hourly aggregates and the
+        changes to their countries' stats"""
+        timestamp = datetime.now()
+        added = []
+        balance_changes = []
+        for account, amount, transaction_type, new_balance in transactions:
+            transaction = Transaction()
+            transaction.amount = amount
+            transaction.timestamp = timestamp
+            transaction.new_balance = new_balance
+            transaction.account_id = account.id
+            transaction.type = transaction_type.value
+
+            balance_changes.append((account.customer_id, 0, new_balance - account.balance))
+            account.balance = transaction.new_balance
+
+            db.session.add(transaction)
+            added.append(transaction)
+        self.aggregate_repository.add_transactions(
+            [(account.customer_id, timestamp, amount) for account, amount, _, _ in transactions])
+        self.country_stats_repository.add_customer_changes(balance_changes)
+        invalidate_on_commit(*{f"customer:{customer_id}" for customer_id, _, _ in balance_changes})
+        return added
+
+    def _add_transaction(self,
+                         account: Account,
+                         amount: Decimal,
+                         transaction_type: TransactionTypes,
+                         new_balance: Decimal
+                         ) -> Transaction:
+        """Adds a transaction and the account's new balance to the session without committing"""
+        return self._add_transactions([(account, amount, transaction_type, new_balance)])[0]
+
+    def _add_idempotency_key(self, idempotency_key: str|None, transactions: list[Transaction]) -> None:
+        """Adds the key of a submission, if it has one, with the ids of its transactions"""
+        if idempotency_key:
+            db.session.flush()
+            self.idempotency_repository.add_key(idempotency_key, transactions, transactions[0].timestamp)
+
     def execute_transaction(
             self,
             account: Account,
             amount: Decimal,
             transaction_type: TransactionTypes,
-            new_balance: Decimal
+            new_balance: Decimal,
+            idempotency_key: str=None
             ) -> Transaction:
-        """Executes a transaction, returning the transaction"""
-        transaction = Transaction()
-        transaction.amount = amount
-        transaction.timestamp = datetime.now()
-        transaction.new_balance = new_balance
-        transaction.account_id = account.id
-        transaction.type = transaction_type.value
-
-        account.balance = transaction.new_balance
-        
-        db.session.add(transaction)
+        """Executes a transaction, returning the transaction.
+        An idempotency key is stored in the same commit"""
+        transaction = self._add_transaction(account, amount, transaction_type, new_balance)
+        self._add_idempotency_key(idempotency_key, [transaction])
         db.session.commit()
 
         return transaction
+
+    def execute_transactions(self,
+                             transactions: list[tuple[Account, Decimal, TransactionTypes, Decimal]],
+                             idempotency_keys: list[str|None]=None
+                             ) -> list[Transaction]:
+        """Executes (account, amount, transaction_type, new_balance) transactions in a single commit,
+        with the idempotency key of each transaction that has one. The accounts should be locked
+        with lock_accounts first. The returned transactions are detached from the session,
+        so they can be read from other threads after the commit"""
+        added = self._add_transactions(transactions)
+        db.session.flush()
+        for transaction, idempotency_key in zip(added, idempotency_keys or []):
+            self._add_idempotency_key(idempotency_key, [transaction])
+        for transaction in added:
+            db.session.expunge(transaction)
+        db.session.commit()
+
+        return added
+
+    def execute_group_committed(self,
+                                account: Account,
+                                amount: Decimal,
+                                transaction_type: TransactionTypes,
+                                idempotency_key: str=None
+                                ) -> tuple[Transaction, bool]:
+        """Hands a deposit or withdrawal to the group commit writer and waits until the batch it
+        is written in has been committed. The writer checks the balance again under its lock and
+        raises ValueError if the account no longer covers a withdrawal, or if the batch was not
+        committed within the writer's timeout, in which case it may still be committed later.
+        Returns the transaction and whether it was written, rather than made before with the key"""
+        future = self.group_commit_writer.submit(account.id, amount, transaction_type, idempotency_key)
+        try:
+            transaction, written = future.result(timeout=self.group_commit_writer.timeout)
+        except TimeoutError:
+            raise ValueError(ErrorMessages.GROUP_COMMIT_TIMEOUT.value)
+        # The writer updated the balance in its own session
+        db.session.expire(account)
+
+        return transaction, written
+
+    def execute_transfer(self,
+                         from_account: Account,
+                         to_account: Account,
+                         amount: Decimal,
+                         idempotency_key: str=None
+                         ) -> tuple[Transaction, Transaction]:
+        """Withdraws amount from from_account and deposits it into to_account in a single commit,
+        with the idempotency key if given. The accounts should be locked with lock_accounts first.
+        Returns both transactions"""
+        withdraw_transaction, deposit_transaction = self._add_transactions(
+            [(from_account, amount, TransactionTypes.WITHDRAW, from_account.balance - amount),
+             (to_account, amount, TransactionTypes.DEPOSIT, to_account.balance + amount)])
+        self._add_idempotency_key(idempotency_key, [withdraw_transaction, deposit_transaction])
+        db.session.commit()
+
+        return withdraw_transaction, deposit_transaction
     
+    def execute_batch(self, transactions: list[dict], accounts: dict[int, Account]) -> list[int]:
+        """Bulk inserts transactions, given as dicts of Transaction columns sharing one timestamp,
+        with their hourly aggregates, country stats and the new balances already set on accounts,
+        in a single commit. The accounts should be locked with lock_accounts first.
+        Returns the ids of the inserted transactions, in order"""
+        for start in range(0, len(transactions), TRANSACTION_INSERT_CHUNK_SIZE):
+            db.session.execute(insert(Transaction),
+                               transactions[start:start + TRANSACTION_INSERT_CHUNK_SIZE])
+        ids = self._get_batch_ids(transactions)
+        self.aggregate_repository.add_transactions(
+            [(accounts[transaction["account_id"]].customer_id,
+              transaction["timestamp"],
+              transaction["amount"])
+             for transaction in transactions])
+        balance_changes = [(accounts[transaction["account_id"]].customer_id,
+                            0,
+                            transaction["amount"] if transaction["type"] == TransactionTypes.DEPOSIT.value
+                            else -transaction["amount"])
+                           for transaction in transactions]
+        self.country_stats_repository.add_customer_changes(balance_changes)
+        invalidate_on_commit(*{f"customer:{customer_id}" for customer_id, _, _ in balance_changes})
+        db.session.commit()
+        return ids
+
+    def _get_batch_ids(self, transactions: list[dict]) -> list[int]:
+        """The ids of a batch inserted but not yet committed, read back by its timestamp. No one
+        else can write to the batch's accounts while they are locked, and ids grow in insert order"""
+        if not transactions:
+            return []
+        account_ids = list({transaction["account_id"] for transaction in transactions})
+        ids = []
+        for start in range(0, len(account_ids), LOCK_ACCOUNTS_CHUNK_SIZE):
+            ids += db.session.execute(
+                select(Transaction.id)
+                .where(Transaction.account_id.in_(account_ids[start:start + LOCK_ACCOUNTS_CHUNK_SIZE]))
+                .where(Transaction.timestamp==transactions[0]["timestamp"])
+            ).scalars().all()
+        return sorted(ids)
+
+    def _reaches_archive(self, page: list[Transaction], limit: int) -> bool:
+        """Whether archived transactions may belong on a newest first page read from the
+        Transactions table: it ran out of rows, or its oldest row is older than the archive horizon"""
+        return len(page) < limit or page[-1].timestamp < archive_horizon()
+
     def get_limited_offset_transactions(self,
                                         account_id: int,
                                         limit: int,
                                         offset: int
                                         ) -> list[Transaction]:
-        """Get transactions for an account, applying provided limit and offset"""
-        return (Transaction.query
-                .filter_by(account_id=account_id)
-                .order_by(Transaction.timestamp.desc())
+        """Get transactions for an account, applying provided limit and offset.
+        Archived transactions are only read for pages reaching back beyond the archive horizon"""
+        def page(source) -> list[Transaction]:
+            return db.session.execute(
+                select(source)
+                .where(source.account_id==account_id)
+                .order_by(source.timestamp.desc())
                 .limit(limit)
                 .offset(offset)
-                .all())
+            ).scalars().all()
+
+        transactions = page(Transaction)
+        if self._reaches_archive(transactions, limit):
+            transactions = page(transactions_from(None))
+        return transactions
+
+    def get_transactions_before_cursor(self,
+                                       account_id: int,
+                                       limit: int,
+                                       cursor: tuple[datetime, int]=None
+                                       ) -> list[Transaction]:
+        """Get up to limit transactions for an account, newest first, that come after the
+        (timestamp, id) cursor in that order. Seeks instead of offsetting, so every page is as fast.
+        Archived transactions are only read for pages reaching back beyond the archive horizon"""
+        def page(source) -> list[Transaction]:
+            query = select(source).where(source.account_id==account_id)
+            if cursor:
+                timestamp, id = cursor
+                query = query.where(or_(source.timestamp < timestamp,
+                                        and_(source.timestamp == timestamp, source.id < id)))
+            return db.session.execute(
+                query
+                .order_by(source.timestamp.desc(), source.id.desc())
+                .limit(limit)
+            ).scalars().all()
+
+        transactions = page(Transaction)
+        if self._reaches_archive(transactions, limit):
+            transactions = page(transactions_from(None))
+        return transactions
+
+    def iter_transaction_partitions(self,
+                                    account_id: int=None,
+                                    customer_id: int=None,
+                                    from_date: datetime=None,
+                                    to_date: datetime=None):
+        """Yields lists of (id, type, timestamp, amount, new_balance, account_id) rows of an account's
+        transactions, or a customer's if customer_id is given, from from_date up to but not
+        including to_date, ordered by account, timestamp and id. Rows are fetched from a server-side
+        cursor a partition at a time, so memory stays flat however long the history is.
+        Archived transactions are included if the range reaches back beyond the archive horizon"""
+        def build_query(source):
+            query = select(source.id.label("id"),
+                           source.type.label("type"),
+                           source.timestamp.label("timestamp"),
+                           source.amount.label("amount"),
+                           source.new_balance.label("new_balance"))
+            if customer_id is not None:
+                query = (query.add_columns(Account.id.label("account_id"))
+                         .join(Account, Account.id==source.account_id)
+                         .where(Account.customer_id==customer_id))
+            else:
+                query = (query.add_columns(source.account_id.label("account_id"))
+                         .where(source.account_id==account_id))
+            if from_date:
+                query = query.where(source.timestamp >= from_date)
+            if to_date:
+                query = query.where(source.timestamp < to_date)
+            return query
+
+        query = select_transactions(from_date, build_query)
+        # Ordered like the indexes are read, so no sort is needed before the first row.
+        # A customer's rows are ordered by the account id read from the accounts index
+        columns = query.selected_columns
+        query = query.order_by(columns.account_id, columns.timestamp, columns.id)
+
+        yield from db.session.execute(
+            query.execution_options(yield_per=EXPORT_PARTITION_SIZE)).partitions()
 
     def get_count_of_transactions(self, account_id) -> int:
-        """Returns count of transactions for an account"""
-        return Transaction.query.filter_by(account_id=account_id).count()
+        """Returns count of transactions for an account, archived ones included"""
+        source = transactions_from(None)
+        return db.session.execute(
+            select(func.count()).select_from(source).where(source.account_id==account_id)
+        ).scalar()
     
     def get_sum_transactions_of_customer(
             self,
             customer: Customer,
             from_date: datetime
             ) -> Decimal:
-        """Get the sum of all transactions from a from_date to now"""
+        """Get the sum of all transactions from a from_date to now, read from the hourly aggregates"""
+        customer_sums = self.aggregate_repository.get_customer_sums(from_date,
+                                                                    datetime.now(),
+                                                                    customer_id=customer.id)
         return db.session.execute(
-            select(func.sum(Transaction.amount)
-                   ).join(Account, Account.id==Transaction.account_id)
-                   .join(Customer, Customer.id==Account.customer_id)
-                   .join(Country, Country.country_code==Customer.country)
-                   .where(Customer.id==customer.id)
-                   .where(between(Transaction.timestamp, from_date, datetime.now()))
-                   .group_by(Customer.id)
+            select(customer_sums.subquery().c.amount_sum)
         ).scalar()
 
     def get_summed_transactions(self, customer: Customer, from_date: datetime) -> list[Transaction]:
         """Get all transactions for a customer from the from_date to now"""
+        source = transactions_from(from_date)
         return db.session.execute(
-            select(Transaction
-                   ).join(Account, Account.id==Transaction.account_id)
-                   .join(Customer, Customer.id==Account.customer_id)
-                   .join(Country, Country.country_code==Customer.country)
-                   .where(Customer.id==customer.id)
-                   .where(between(Transaction.timestamp, from_date, datetime.now()))
+            select(source
+                   ).join(Account, Account.id==source.account_id)
+                   .where(Account.customer_id==customer.id)
+                   .where(between(source.timestamp, from_date, datetime.now()))
         ).scalars().all()
 
     def get_transactions_for_customer_on_date(self,
@@ -77,12 +341,11 @@ class TransactionRepository():
                                              target_date: date
                                              ) -> list[Transaction]:
         """Get all transactions for a customer for a given date"""
+        source = transactions_from(datetime.combine(target_date, time.min))
         return db.session.execute(
-            select(Transaction)
-            .join(Account, Account.id==Transaction.account_id)
-            .join(Customer, Customer.id==Account.customer_id)
-            .join(Country, Country.country_code==Customer.country)
-            .where(Customer.id==customer.id)
-            .where(func.date(Transaction.timestamp)==target_date)
-            .order_by(desc(Transaction.timestamp))
+            select(source)
+            .join(Account, Account.id==source.account_id)
+            .where(Account.customer_id==customer.id)
+            .where(func.date(source.timestamp)==target_date)
+            .order_by(desc(source.timestamp))
         ).scalars().all()
\ No newline at end of file
@@ -1,6 +1,7 @@
 from models import User, user_datastore, db, Role
 from sqlalchemy import desc
 from flask_security.utils import hash_password
+from repositories.query_cache import cached, invalidate_on_commit
 
 class UserRepository():
     def get_user_from_email(self, user_email: str) -> User:
@@ -9,9 +10,11 @@ class UserRepository():
     def get_user_or_404(self, user_id) -> User:
         return User.query.filter_by(id=user_id).one_or_404()
 
+    @cached(["users"])
     def get_all_users(self) -> list[User]:
         return User.query.order_by(desc(User.active)).all()
     
+    @cached(["users"])
     def get_active_users(self) -> list[User]:
         return User.query.filter_by(active=True).all()
 
@@ -21,23 +24,28 @@ class UserRepository():
                 password=hash_password(password),
                 active=True,
                 roles=[role])
+        invalidate_on_commit("users")
         db.session.commit()
     
     def update_password(self, user: User, new_password: str) -> None:
         user.password = hash_password(new_password)
+        invalidate_on_commit("users")
         db.session.commit()
     
     def update_role(self, user: User, new_role: Role|str) -> None:
         user_datastore.remove_role_from_user(user, user.roles[0])
         user_datastore.add_role_to_user(user, new_role)
+        invalidate_on_commit("users")
         db.session.commit()
 
     def deactivate_user(self, user: User) -> None:
         user_datastore.deactivate_user(user)
+        invalidate_on_commit("users")
         db.session.commit()
     
     def activate_user(self, user: User) -> None:
         user_datastore.activate_user(user)
+        invalidate_on_commit("users")
         db.session.commit()
 
     def delete_user(self, user: User) -> None:
@@ -45,4 +53,5 @@ class UserRepository():
         user.password = None
         user.active = False
         user.roles = []
+        invalidate_on_commit("users")
         db.session.commit()
\ No newline at end of file
@@ -21,6 +21,8 @@ from models import (
     Transaction,
     Country
 )
+from repositories.transaction_aggregate_repository import TransactionAggregateRepository
+from repositories.country_stats_repository import CountryStatsRepository
 
 SEED_USERS = [
         {
@@ -72,6 +74,7 @@ def seed_data(db: SQLAlchemy):
     existing_national_ids = {customer.national_id for customer in Customer.query.all()}
 
     count_users =  Customer.query.count()
+    seeded = count_users < SEED_AMOUNT_CUSTOMERS
 
     while count_users < SEED_AMOUNT_CUSTOMERS:
         # generate customer details based on random supported locale
@@ -134,6 +137,11 @@ def seed_data(db: SQLAlchemy):
 
         count_users += 1
 
+    if seeded:
+        # Seeded transactions are not added through execute_transaction
+        TransactionAggregateRepository().backfill()
+        CountryStatsRepository().rebuild()
+
 def create_customer(fake: Faker, existing_national_ids) -> Customer:
         customer = Customer()
         
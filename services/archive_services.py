@@ -0,0 +1,44 @@
+from datetime import datetime
+from repositories.transaction_archive_repository import TransactionArchiveRepository, archive_horizon
+from repositories.balance_checkpoint_repository import BalanceCheckpointRepository
+from services.balance_services import month_start
+from constants.constants import BusinessConstants
+
+
+class TransactionArchiveService():
+    """Moves transactions older than the archive horizon out of the Transactions table, so its
+    indexes stay small enough to be cached. Reads whose range reaches back beyond the horizon
+    read the archive as well, see repositories.transaction_archive_repository"""
+    def __init__(self,
+                 transaction_archive_repository: TransactionArchiveRepository,
+                 balance_checkpoint_repository: BalanceCheckpointRepository
+                 ) -> None:
+        self.transaction_archive_repository = transaction_archive_repository
+        self.balance_checkpoint_repository = balance_checkpoint_repository
+
+    def get_archive_cutoff(self, now: datetime=None) -> datetime|None:
+        """Transactions made before the returned time can be archived: the start of the month of
+        the archive horizon, or the latest balance checkpoint if that is earlier, so balances
+        after the horizon are still summed from a checkpoint and the Transactions table alone.
+        None if no checkpoints have been created"""
+        latest_checkpoint_time = self.balance_checkpoint_repository.get_latest_checkpoint_time()
+        if latest_checkpoint_time is None:
+            return None
+        return min(month_start(archive_horizon(now)), latest_checkpoint_time)
+
+    def archive_cold_transactions(self,
+                                  now: datetime=None,
+                                  batch_size: int=BusinessConstants.TRANSACTION_ARCHIVE_BATCH_SIZE
+                                  ) -> int:
+        """Archives the transactions before the archive cutoff in batches of batch_size, each
+        committed on its own so no lock is held for long. Returns the number archived"""
+        cutoff = self.get_archive_cutoff(now)
+        if cutoff is None:
+            return 0
+
+        archived = 0
+        while True:
+            moved = self.transaction_archive_repository.archive_batch(cutoff, batch_size)
+            archived += moved
+            if moved < batch_size:
+                return archived
@@ -0,0 +1,87 @@
+import csv
+import io
+from html import escape
+from prettytable import PrettyTable
+from services.customer_services import CustomerService
+from models import Customer
+
+REPORT_COLUMNS = ["Id", "Name", "Account number(s)", "Transaction number(s)"]
+
+
+class AuditReportService():
+    """Composes the audit report for each country, optionally with CSV and HTML attachments"""
+    def __init__(self, customer_service: CustomerService) -> None:
+        self.customer_service = customer_service
+
+    def compose_reports(self,
+                        flagged_customers_per_country: dict[str, dict],
+                        message_header: str,
+                        attachment_formats: list[str]=None
+                        ) -> dict[str, dict]:
+        """Composes reports for all countries in one pass, fetching every flagged customer
+        with a single bulk query. Returns {country_name: {"body": str, "attachments": list}},
+        attachments are (filename, content_type, data) tuples in attachment_formats, csv and html"""
+        customer_ids = {customer_id
+                        for flagged_customers in flagged_customers_per_country.values()
+                        for customer_id in flagged_customers}
+        customers = {customer.id: customer
+                     for customer in self.customer_service.get_customers_from_ids(customer_ids)}
+
+        reports = {}
+        for country_name, flagged_customers in flagged_customers_per_country.items():
+            attachments = []
+            if "csv" in (attachment_formats or []):
+                csv_data = self.compose_csv(flagged_customers, customers)
+                attachments.append((f"{country_name}.csv", "text/csv", csv_data.encode()))
+            if "html" in (attachment_formats or []):
+                html_data = self.compose_html(flagged_customers, customers)
+                attachments.append((f"{country_name}.html", "text/html", html_data.encode()))
+
+            reports[country_name] = {
+                "body": self.compose_message_table(flagged_customers, customers, message_header),
+                "attachments": attachments
+            }
+        return reports
+
+    def _iter_report_rows(self, flagged_customers: dict[int, dict], customers: dict[int, Customer]):
+        """Yields one report row per flagged customer, ordered by customer id"""
+        for customer_id in sorted(flagged_customers):
+            flagged_accounts_transactions = flagged_customers[customer_id]
+            customer = customers[customer_id]
+            yield [
+                customer.id,
+                f"{customer.first_name} {customer.last_name}",
+                ", ".join(str(account_number)
+                          for account_number in sorted(flagged_accounts_transactions["accounts"])),
+                ", ".join(str(transaction_number)
+                          for transaction_number in sorted(flagged_accounts_transactions["transactions"]))
+            ]
+
+    def compose_message_table(self,
+                              flagged_customers: dict[int, dict],
+                              customers: dict[int, Customer],
+                              message_header: str
+                              ) -> str:
+        table = PrettyTable()
+        table.field_names = REPORT_COLUMNS
+        for message_row in self._iter_report_rows(flagged_customers, customers):
+            table.add_row(message_row)
+        table.align["Transaction number(s)"] = "l"
+
+        return message_header + "\n" + table.get_string() + "\n"
+
+    def compose_csv(self, flagged_customers: dict[int, dict], customers: dict[int, Customer]) -> str:
+        """The report as csv. Mail attachments are held in memory, so it is built as one string"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(REPORT_COLUMNS)
+        writer.writerows(self._iter_report_rows(flagged_customers, customers))
+        return buffer.getvalue()
+
+    def compose_html(self, flagged_customers: dict[int, dict], customers: dict[int, Customer]) -> str:
+        """The report as an html table"""
+        lines = ["<table>", "<tr>" + "".join(f"<th>{column}</th>" for column in REPORT_COLUMNS) + "</tr>"]
+        for row in self._iter_report_rows(flagged_customers, customers):
+            lines.append("<tr>" + "".join(f"<td>{escape(str(value))}</td>" for value in row) + "</tr>")
+        lines.append("</table>")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta, time
+from repositories.audit_repository import AuditRepository
+from constants.constants import AuditConstants, AuditRules
+from models import AuditRun
+
+
+class AuditService():
+    INCREMENTAL_WATERMARK_NAME = "incremental_audit"
+    LOCK_NAME = "audit"
+
+    def __init__(self, audit_repository: AuditRepository) -> None:
+        self.audit_repository = audit_repository
+
+    def _audit_periods(self, audit_time: datetime) -> tuple[datetime, datetime, datetime]:
+        """Returns start of yesterday, start of today and start of the recent period"""
+        yesterday_start = datetime.combine((audit_time - timedelta(days=1)).date(), time.min)
+        today_start = yesterday_start + timedelta(days=1)
+        recent_period_start = audit_time - AuditConstants.RECENT_TRANSACTIONS_PERIOD
+        return yesterday_start, today_start, recent_period_start
+
+    def find_suspicious_transactions(self, country_code: str, audit_time: datetime) -> list[tuple]:
+        """Evaluates both audit rules for every customer in a country at once.
+        Flags single transactions over the limit made the day before audit_time,
+        and all transactions of customers whose transactions in the recent period
+        add up to more than the limit.
+        Returns (customer_id, account_id, transaction_id, rule) rows"""
+        yesterday_start, today_start, recent_period_start = self._audit_periods(audit_time)
+
+        large_transactions = self.audit_repository.get_transactions_exceeding_amount(
+            country_code,
+            yesterday_start,
+            today_start,
+            AuditConstants.SINGLE_TRANSACTION_LIMIT)
+
+        recent_transactions = self.audit_repository.get_transactions_of_customers_exceeding_sum(
+            country_code,
+            recent_period_start,
+            audit_time,
+            AuditConstants.RECENT_TRANSACTIONS_LIMIT)
+
+        return self._label_rows(large_transactions, recent_transactions)
+
+    def audit_country(self, country_code: str, audit_time: datetime) -> dict[int, dict]:
+        """Audits a country, see find_suspicious_transactions.
+        Returns {customer_id: {"transactions": set, "accounts": set}}"""
+        return self.group_flagged_transactions(
+            self.find_suspicious_transactions(country_code, audit_time))
+
+    def refresh_audit_window(self, audit_time: datetime) -> int:
+        """Copies transactions added since the last refresh into the audit window
+        and drops the ones that have fallen out of the recent period.
+        Transactions with ids above the stored watermark are read, and so are the ones with a
+        timestamp less than MAX_COMMIT_LAG before the last read started, which may have
+        committed after it with a lower id. Returns the number of new transactions copied"""
+        _, _, recent_period_start = self._audit_periods(audit_time)
+        read_started = datetime.now()
+
+        watermark = self.audit_repository.get_watermark(self.INCREMENTAL_WATERMARK_NAME)
+        if watermark:
+            last_transaction_id = watermark.last_transaction_id
+            committed_from = max(watermark.updated - AuditConstants.MAX_COMMIT_LAG, recent_period_start)
+        else:
+            last_transaction_id, committed_from = 0, recent_period_start
+
+        copied_ids = self.audit_repository.get_window_transaction_ids(committed_from)
+        new_transactions = [transaction for transaction in self.audit_repository.get_new_transactions(
+                                last_transaction_id,
+                                committed_from,
+                                recent_period_start)
+                            if transaction.transaction_id not in copied_ids]
+
+        self.audit_repository.add_window_transactions(
+            [transaction._asdict() for transaction in new_transactions])
+        self.audit_repository.delete_window_transactions_before(recent_period_start)
+        self.audit_repository.save_watermark(
+            self.INCREMENTAL_WATERMARK_NAME,
+            max([last_transaction_id] + [transaction.transaction_id for transaction in new_transactions]),
+            read_started)
+
+        return len(new_transactions)
+
+    def find_suspicious_transactions_incremental(self,
+                                                 country_code: str,
+                                                 audit_time: datetime
+                                                 ) -> list[tuple]:
+        """Same as find_suspicious_transactions, but evaluated against the audit window,
+        refresh_audit_window must be called first with the same audit_time"""
+        yesterday_start, today_start, recent_period_start = self._audit_periods(audit_time)
+
+        large_transactions = self.audit_repository.get_window_transactions_exceeding_amount(
+            country_code,
+            yesterday_start,
+            today_start,
+            AuditConstants.SINGLE_TRANSACTION_LIMIT)
+
+        recent_transactions = self.audit_repository.get_window_transactions_of_customers_exceeding_sum(
+            country_code,
+            recent_period_start,
+            audit_time,
+            AuditConstants.RECENT_TRANSACTIONS_LIMIT)
+
+        return self._label_rows(large_transactions, recent_transactions)
+
+    def audit_country_incremental(self, country_code: str, audit_time: datetime) -> dict[int, dict]:
+        return self.group_flagged_transactions(
+            self.find_suspicious_transactions_incremental(country_code, audit_time))
+
+    def _label_rows(self, large_transactions, recent_transactions) -> list[tuple]:
+        """Adds the rule that flagged them to (customer_id, account_id, transaction_id) rows"""
+        return ([(*row, AuditRules.SINGLE_TRANSACTION.value) for row in large_transactions]
+                + [(*row, AuditRules.RECENT_TRANSACTIONS.value) for row in recent_transactions])
+
+    def group_flagged_transactions(self, flagged_rows) -> dict[int, dict]:
+        """Groups (customer_id, account_id, transaction_id, rule) rows per customer,
+        sets are used to deduplicate transactions flagged by both rules"""
+        flagged_customers = {}
+        for customer_id, account_id, transaction_id, _ in flagged_rows:
+            flags = flagged_customers.setdefault(customer_id,
+                                                 {"transactions": set(), "accounts": set()})
+            flags["transactions"].add(transaction_id)
+            flags["accounts"].add(account_id)
+        return flagged_customers
+
+    def compare_audit_results(self,
+                              full_result: dict[int, dict],
+                              incremental_result: dict[int, dict]
+                              ) -> list[str]:
+        """Describes every customer whose flags differ between a full and an incremental audit,
+        an empty list means the results are identical"""
+        differences = []
+        for customer_id in sorted(full_result.keys() | incremental_result.keys()):
+            full_flags = full_result.get(customer_id)
+            incremental_flags = incremental_result.get(customer_id)
+            if full_flags != incremental_flags:
+                differences.append(f"Customer {customer_id}: full audit {full_flags}, "
+                                   f"incremental audit {incremental_flags}")
+        return differences
+
+    def count_audited_transactions(self, audit_time: datetime) -> int:
+        """Number of transactions a full audit at audit_time reads"""
+        yesterday_start, _, recent_period_start = self._audit_periods(audit_time)
+        return self.audit_repository.count_transactions(min(yesterday_start, recent_period_start),
+                                                        audit_time)
+
+    def start_run(self, audit_time: datetime, node: str=None) -> AuditRun:
+        return self.audit_repository.create_run(audit_time, node)
+
+    def finish_run(self, run: AuditRun, rows_scanned: int=None, findings_count: int=None) -> None:
+        """Marks a run finished and records how long it took, with its rows scanned and findings"""
+        self.audit_repository.finish_run(run, rows_scanned, findings_count)
+
+    def has_finished_run(self, audit_time: datetime) -> bool:
+        """True if some node already finished an audit at audit_time"""
+        return self.audit_repository.has_finished_run(audit_time)
+
+    def acquire_lock(self, owner: str) -> bool:
+        """Takes the audit lock shared by all nodes, returns False if another owner holds it.
+        The lock expires after AuditConstants.LOCK_TIMEOUT in case its owner dies"""
+        now = datetime.now()
+        return self.audit_repository.acquire_lock(self.LOCK_NAME, owner, now,
+                                                  now + AuditConstants.LOCK_TIMEOUT)
+
+    def release_lock(self, owner: str) -> None:
+        self.audit_repository.release_lock(self.LOCK_NAME, owner)
+
+    def get_missed_audit_times(self, scheduled_time: time, now: datetime) -> list[datetime]:
+        """Scheduled audit times after the last finished run up to now, oldest first,
+        at most AuditConstants.MAX_CATCH_UP_NIGHTS of them. Empty if there never was a run"""
+        last_run = self.audit_repository.get_last_finished_run()
+        if last_run is None:
+            return []
+
+        audit_time = datetime.combine(last_run.audit_time.date(), scheduled_time)
+        missed = []
+        while True:
+            if audit_time > last_run.audit_time:
+                if audit_time > now:
+                    break
+                missed.append(audit_time)
+            audit_time += timedelta(days=1)
+        return missed[-AuditConstants.MAX_CATCH_UP_NIGHTS:]
+
+    def save_findings(self, run: AuditRun, findings_per_country: dict[str, list[tuple]]) -> int:
+        """Bulk inserts the (customer_id, account_id, transaction_id, rule) rows found per
+        country code for an audit run, returns the number of findings saved"""
+        findings = [
+            {"run_id": run.id,
+             "customer_id": customer_id,
+             "account_id": account_id,
+             "transaction_id": transaction_id,
+             "country": country_code,
+             "rule": rule}
+            for country_code, rows in findings_per_country.items()
+            for customer_id, account_id, transaction_id, rule in rows
+        ]
+        self.audit_repository.add_findings(findings)
+        return len(findings)
+
+    def get_paginated_findings(self, filters: dict, page: int, per_page: int):
+        """Filters can hold run_id, country and customer_id, empty values are ignored"""
+        filters = {name: value for name, value in filters.items() if value}
+        return self.audit_repository.get_paginated_findings(filters, page, per_page)
+
+    def get_paginated_runs(self, page: int, per_page: int):
+        return self.audit_repository.get_paginated_runs(page, per_page)
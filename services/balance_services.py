@@ -0,0 +1,57 @@
+from decimal import Decimal
+from datetime import datetime, date, time, timedelta
+from repositories.balance_checkpoint_repository import BalanceCheckpointRepository
+
+CHECKPOINT_ACCOUNT_CHUNK_SIZE = 5000
+
+
+def month_start(timestamp: datetime) -> datetime:
+    return datetime.combine(timestamp.date().replace(day=1), time.min)
+
+
+def next_month_start(timestamp: datetime) -> datetime:
+    return month_start(month_start(timestamp) + timedelta(days=32))
+
+
+class BalanceService():
+    """Point-in-time balances read from monthly checkpoints, so a lookup never scans
+    more than a month of an account's transactions"""
+    def __init__(self, balance_checkpoint_repository: BalanceCheckpointRepository) -> None:
+        self.balance_checkpoint_repository = balance_checkpoint_repository
+
+    def get_balances_on_date(self, account_ids: list[int], on_date: date) -> dict[int, Decimal]:
+        """Returns each account's balance at the end of on_date, leaving out unknown accounts"""
+        end_of_day = datetime.combine(on_date + timedelta(days=1), time.min)
+        return self.balance_checkpoint_repository.get_balances_as_of(account_ids, end_of_day)
+
+    def get_balance_on_date(self, account_id: int, on_date: date) -> Decimal|None:
+        return self.get_balances_on_date([account_id], on_date).get(account_id)
+
+    def create_missing_checkpoints(self,
+                                   now: datetime=None,
+                                   chunk_size: int=CHECKPOINT_ACCOUNT_CHUNK_SIZE
+                                   ) -> int:
+        """Creates the checkpoints at each month start up to now that do not exist yet, oldest
+        month first, committing every chunk_size accounts. Each month builds on the one before,
+        so the first run backfills all history and later runs only add the months since.
+        The latest month is done again, completing it if an earlier run was interrupted.
+        Returns the number of checkpoints created"""
+        now = now or datetime.now()
+        latest = self.balance_checkpoint_repository.get_latest_checkpoint_time()
+        if latest is None:
+            first_transaction_time = self.balance_checkpoint_repository.get_first_transaction_time()
+            if first_transaction_time is None:
+                return 0
+            latest = next_month_start(first_transaction_time)
+
+        first_account_id, last_account_id = self.balance_checkpoint_repository.get_account_id_range()
+        created = 0
+        as_of = latest
+        while as_of <= now:
+            for chunk_start in range(first_account_id, last_account_id + 1, chunk_size):
+                created += self.balance_checkpoint_repository.create_checkpoints(
+                    as_of,
+                    chunk_start,
+                    min(chunk_start + chunk_size - 1, last_account_id))
+            as_of = next_month_start(as_of)
+        return created
@@ -1,14 +1,34 @@
-from repositories.country_repository import CountryRepository
-from models import Country
+from repositories.country_repository import CountryRepository, CountryRecord
+from repositories.country_stats_repository import CountryStatsRepository
 
 class CountryService():
-    def __init__(self, country_repository: CountryRepository) -> None:
+    def __init__(self,
+                 country_repository: CountryRepository,
+                 country_stats_repository: CountryStatsRepository=None
+                 ) -> None:
         self.country_repository = country_repository
+        self.country_stats_repository = country_stats_repository or CountryStatsRepository()
 
     def get_country_stats(self):
-        return self.country_repository.get_country_stats()
+        """Country stats kept current by every customer, account and transaction write,
+        so the index page reads a few rows per country instead of every account"""
+        return self.country_stats_repository.get_country_stats()
+
+    def reconcile_country_stats(self) -> dict[str, dict]:
+        """Recounts the country stats from the customers and accounts tables and replaces the
+        stored ones with the recount. Returns the stored and counted (number of customers,
+        number of accounts, sum of accounts) of each country where they differed"""
+        stored = self.country_stats_repository.get_stored_country_stats()
+        counted = self.country_stats_repository.count_country_stats()
+        empty = (0, 0, 0)
+        drift = {country_code: {"stored": stored.get(country_code, empty),
+                                "counted": counted.get(country_code, empty)}
+                 for country_code in stored.keys() | counted.keys()
+                 if stored.get(country_code, empty) != counted.get(country_code, empty)}
+        self.country_stats_repository.rebuild()
+        return drift
     
-    def get_all_countries(self) -> list[Country]:
+    def get_all_countries(self) -> tuple[CountryRecord, ...]:
         return self.country_repository.get_all_countries()
 
     def calculate_global_stats(self, country_stats):
@@ -17,12 +17,12 @@ class CustomerService():
     def get_customer_accounts_country(self, customer_id: int) -> Customer:
         return self.customer_repository.get_customer_joined_accounts_country_or_404(customer_id)
     
+    def get_customers_from_ids(self, customer_ids) -> list[Customer]:
+        return self.customer_repository.get_customers_from_ids(customer_ids)
+
     def get_all_customers_for_country(self, country: Country) -> list[Customer]:
         return self.customer_repository.get_all_customers_for_country(country)
     
-    def get_top_10_customers_for_country(self, country_name: str) -> list[Customer]:
-        return self.customer_repository.get_top_10_customers_for_country(country_name)
-    
     def get_customer_from_national_id(self, national_id: str) -> Customer|None:
         return self.customer_repository.get_customer_from_national_id(national_id)
     
@@ -0,0 +1,60 @@
+from datetime import date, datetime, time, timedelta
+import csv
+import io
+import json
+from repositories.transaction_repository import TransactionRepository
+from constants.errors_messages import ErrorMessages
+
+EXPORT_COLUMNS = ["id", "type", "timestamp", "amount", "new_balance", "account_id"]
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class TransactionExportService():
+    """Streams an account's or a customer's transactions as csv or newline delimited json"""
+    def __init__(self, transaction_repository: TransactionRepository) -> None:
+        self.transaction_repository = transaction_repository
+
+    def get_mimetype(self, export_format: str) -> str:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(ErrorMessages.INVALID_EXPORT_FORMAT.value)
+        return EXPORT_FORMATS[export_format]
+
+    def iter_export(self,
+                    export_format: str,
+                    account_id: int=None,
+                    customer_id: int=None,
+                    from_date: date=None,
+                    to_date: date=None):
+        """Yields the transactions from the start of from_date to the end of to_date, both optional,
+        one chunk of text per partition fetched from the database"""
+        self.get_mimetype(export_format)
+        partitions = self.transaction_repository.iter_transaction_partitions(
+            account_id,
+            customer_id,
+            datetime.combine(from_date, time.min) if from_date else None,
+            datetime.combine(to_date + timedelta(days=1), time.min) if to_date else None)
+        if export_format == "csv":
+            return self._iter_csv(partitions)
+        return self._iter_ndjson(partitions)
+
+    def _iter_csv(self, partitions):
+        """Yields the header at once, then one block of lines per partition, reusing one buffer"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+        for rows in partitions:
+            buffer.seek(0)
+            buffer.truncate(0)
+            writer.writerows(rows)
+            yield buffer.getvalue()
+
+    def _iter_ndjson(self, partitions):
+        for rows in partitions:
+            yield "".join(json.dumps({"id": id,
+                                      "type": transaction_type,
+                                      "timestamp": timestamp.isoformat(),
+                                      "amount": str(amount),
+                                      "new_balance": str(new_balance),
+                                      "account_id": account_id}) + "\n"
+                          for id, transaction_type, timestamp, amount, new_balance, account_id in rows)
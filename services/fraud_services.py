@@ -0,0 +1,133 @@
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from decimal import Decimal
+from threading import Lock
+import time
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from repositories.transaction_flag_repository import TransactionFlagRepository
+from models import Transaction
+from constants.constants import AuditConstants, AuditRules
+
+
+class CustomerWindow():
+    """A customer's transactions inside the recent period, oldest first, with their running sum.
+    Entries are [timestamp, amount, transaction_id, account_id, flagged]"""
+    def __init__(self, country: str) -> None:
+        self.country = country
+        self.transactions = deque()
+        self.ids = set()
+        self.sum = Decimal(0)
+        self.loaded = time.monotonic()
+
+    def add(self, timestamp: datetime, amount: Decimal, transaction_id: int,
+            account_id: int, flagged: bool=False) -> None:
+        """Adds a transaction unless the window already holds it, as when it was loaded from
+        the database after the transaction committed"""
+        if transaction_id in self.ids:
+            return
+        self.transactions.append([timestamp, amount, transaction_id, account_id, flagged])
+        self.ids.add(transaction_id)
+        self.sum += amount
+
+    def expire_before(self, from_date: datetime) -> None:
+        while self.transactions and self.transactions[0][0] < from_date:
+            timestamp, amount, transaction_id, account_id, flagged = self.transactions.popleft()
+            self.ids.discard(transaction_id)
+            self.sum -= amount
+
+
+class FraudMonitor():
+    """Flags suspicious transactions the moment they are made, using the same limits as the
+    nightly audit. Each customer's recent transactions are kept in memory with a running sum.
+    State is per process, so a window is loaded from the database again once it is older than
+    reload_interval, counting the transactions other processes made meanwhile. Only the
+    max_windows most recently seen customers are kept"""
+    def __init__(self,
+                 flag_repository: TransactionFlagRepository,
+                 reload_interval: timedelta=AuditConstants.FRAUD_WINDOW_RELOAD_INTERVAL,
+                 max_windows: int=AuditConstants.FRAUD_MAX_WINDOWS) -> None:
+        self.flag_repository = flag_repository
+        self.reload_interval = reload_interval.total_seconds()
+        self.max_windows = max_windows
+        self._windows: OrderedDict[int, CustomerWindow] = OrderedDict()
+        self._lock = Lock()
+
+    def _load_window(self, customer_id: int, from_date: datetime) -> CustomerWindow:
+        window = CustomerWindow(self.flag_repository.get_customer_country(customer_id))
+        for row in self.flag_repository.get_recent_transactions_of_customer(customer_id, from_date):
+            window.add(row.timestamp, row.amount, row.id, row.account_id, row.flagged)
+        return window
+
+    def check_transaction(self, transaction: Transaction, customer_id: int) -> list[dict]:
+        """Adds a committed transaction to its customer's window and persists flags for any
+        rule it breaks. When the recent transactions limit is crossed, every unflagged
+        transaction in the window is flagged, like the nightly audit does.
+        Returns the new flags"""
+        from_date = transaction.timestamp - AuditConstants.RECENT_TRANSACTIONS_PERIOD
+        flags = []
+
+        with self._lock:
+            seen_window = self._windows.get(customer_id)
+            fresh = seen_window is not None and time.monotonic() - seen_window.loaded <= self.reload_interval
+        # Loaded without holding the lock, so other customers' transactions are not held up.
+        # A window loaded from the database includes this transaction
+        loaded_window = None if fresh else self._load_window(customer_id, from_date)
+
+        with self._lock:
+            window = self._windows.get(customer_id)
+            if window is None or (loaded_window and window is seen_window):
+                # A window another thread installed meanwhile is kept. One evicted meanwhile
+                # is reloaded under the lock, which is rare
+                window = loaded_window or self._load_window(customer_id, from_date)
+                self._windows[customer_id] = window
+            window.add(transaction.timestamp, transaction.amount,
+                       transaction.id, transaction.account_id)
+            self._windows.move_to_end(customer_id)
+            if len(self._windows) > self.max_windows:
+                self._windows.popitem(last=False)
+            window.expire_before(from_date)
+
+            if transaction.amount > AuditConstants.SINGLE_TRANSACTION_LIMIT:
+                flags.append(self._flag(window, customer_id, transaction.id,
+                                        transaction.account_id, AuditRules.SINGLE_TRANSACTION))
+
+            if window.sum > AuditConstants.RECENT_TRANSACTIONS_LIMIT:
+                # Flagged transactions are always the oldest ones in a window,
+                # so only the unflagged newest ones need to be visited
+                for entry in reversed(window.transactions):
+                    if entry[4]:
+                        break
+                    entry[4] = True
+                    flags.append(self._flag(window, customer_id, entry[2], entry[3],
+                                            AuditRules.RECENT_TRANSACTIONS))
+
+        if flags:
+            try:
+                self.flag_repository.add_flags(flags)
+            except SQLAlchemyError:
+                # The transaction itself is already committed and must not fail because of this
+                self.flag_repository.rollback()
+                current_app.logger.exception("Could not save flags for transaction %s", transaction.id)
+        return flags
+
+    def _flag(self, window: CustomerWindow, customer_id: int, transaction_id: int,
+              account_id: int, rule: AuditRules) -> dict:
+        return {"transaction_id": transaction_id,
+                "account_id": account_id,
+                "customer_id": customer_id,
+                "country": window.country,
+                "rule": rule.value,
+                "flagged": datetime.now()}
+
+    def get_flagged_transactions_for_country(self,
+                                             country_code: str,
+                                             from_date: datetime,
+                                             to_date: datetime
+                                             ) -> list[tuple]:
+        """Returns the flags raised in a country between from_date and to_date as
+        (customer_id, account_id, transaction_id, rule) rows, like the audit finds them"""
+        return [(flag.customer_id, flag.account_id, flag.transaction_id, flag.rule)
+                for flag in self.flag_repository.get_flags_for_country(country_code,
+                                                                       from_date,
+                                                                       to_date)]
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from repositories.idempotency_repository import IdempotencyRepository
+from models import Transaction
+from constants.constants import BusinessConstants
+from constants.errors_messages import ErrorMessages
+
+
+class IdempotencyService():
+    """Looks up the transactions an idempotency key already made. The most recently used keys
+    are kept in memory, so a retry storm is answered without querying the keys table.
+    A key is honoured until it is purged, for the same request only"""
+    def __init__(self,
+                 idempotency_repository: IdempotencyRepository,
+                 cache_size: int=BusinessConstants.IDEMPOTENCY_KEY_CACHE_SIZE
+                 ) -> None:
+        self.idempotency_repository = idempotency_repository
+        self.cache_size = cache_size
+        self._recent_keys: OrderedDict[str, tuple[str|None, list[int]]] = OrderedDict()
+        self._lock = Lock()
+
+    def validate_key(self, key: str) -> None:
+        if not isinstance(key, str) or not 0 < len(key) <= BusinessConstants.MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise ValueError(ErrorMessages.INVALID_IDEMPOTENCY_KEY.value)
+
+    def remember(self, key: str, fingerprint: str, transaction_ids: list[int]) -> None:
+        with self._lock:
+            self._recent_keys[key] = (fingerprint, transaction_ids)
+            self._recent_keys.move_to_end(key)
+            if len(self._recent_keys) > self.cache_size:
+                self._recent_keys.popitem(last=False)
+
+    def get_transactions(self, key: str, fingerprint: str) -> list[Transaction]|None:
+        """Returns the transactions made with key, or None if it has not been used. Raises
+        ValueError if key was used for a request with another fingerprint, see request_fingerprint"""
+        with self._lock:
+            stored = self._recent_keys.get(key)
+            if stored is not None:
+                self._recent_keys.move_to_end(key)
+
+        if stored is None:
+            stored = self.idempotency_repository.get_stored_keys([key]).get(key)
+            if stored is None:
+                return None
+            self.remember(key, *stored)
+
+        stored_fingerprint, transaction_ids = stored
+        if stored_fingerprint not in (None, fingerprint):
+            raise ValueError(ErrorMessages.IDEMPOTENCY_KEY_REUSED.value)
+        return self.idempotency_repository.get_transactions(transaction_ids)
+
+    def purge_expired_keys(self, now: datetime=None) -> int:
+        """Deletes the keys older than IDEMPOTENCY_KEY_LIFETIME in bulk, returning how many"""
+        before = (now or datetime.now()) - BusinessConstants.IDEMPOTENCY_KEY_LIFETIME
+        deleted = self.idempotency_repository.delete_keys_created_before(before)
+        with self._lock:
+            self._recent_keys.clear()
+        return deleted
@@ -0,0 +1,71 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import smtplib
+import time
+from flask import Flask, current_app
+from flask_mail import Mail, Message
+
+# Errors the server answers a single message with, the connection can still send the others
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+class MailDispatcher():
+    """Delivers batches of messages from a background thread over one reused SMTP connection,
+    so a slow or unreachable mail server never holds up the caller.
+    Batches are delivered one at a time in the order they were dispatched"""
+    def __init__(self, mail: Mail, retries: int=3, retry_delay: float=5.0) -> None:
+        self.mail = mail
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail-dispatch")
+
+    def dispatch(self, app: Flask, messages: list[Message]) -> Future:
+        """Queues messages for delivery and returns at once.
+        The future's result is the delivery report, see deliver"""
+        return self._executor.submit(self._deliver_in_app_context, app, messages)
+
+    def _deliver_in_app_context(self, app: Flask, messages: list[Message]) -> dict:
+        # Flask-Mail reads its settings from the current app, which threads do not inherit
+        with app.app_context():
+            return self.deliver(messages)
+
+    def deliver(self, messages: list[Message]) -> dict:
+        """Sends all messages over one SMTP connection. If the connection fails, a new one is
+        opened after a growing delay and delivery resumes with the first unsent message,
+        at most retries times. A message the server refuses is logged as failed and skipped.
+        Returns {"sent", "failed", "attempts", "seconds"}"""
+        started = time.perf_counter()
+        pending = deque(messages)
+        sent = 0
+        refused = 0
+        attempts = 0
+
+        while pending and attempts <= self.retries:
+            if attempts:
+                time.sleep(self.retry_delay * attempts)
+            attempts += 1
+            try:
+                with self.mail.connect() as connection:
+                    while pending:
+                        try:
+                            connection.send(pending[0])
+                            sent += 1
+                        except MESSAGE_ERRORS:
+                            current_app.logger.exception("Mail to %s was refused",
+                                                         ", ".join(pending[0].recipients))
+                            refused += 1
+                        pending.popleft()
+            except (smtplib.SMTPException, OSError):
+                current_app.logger.exception("Mail delivery failed with %s messages unsent, attempt %s of %s",
+                                             len(pending), attempts, self.retries + 1)
+
+        report = {"sent": sent,
+                  "failed": refused + len(pending),
+                  "attempts": attempts,
+                  "seconds": time.perf_counter() - started}
+        current_app.logger.info("Delivered %(sent)s messages, %(failed)s failed, "
+                                "in %(attempts)s attempts and %(seconds).2f seconds", report)
+        return report
+
+    def shutdown(self) -> None:
+        """Waits for all dispatched batches to be delivered"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,117 @@
+from decimal import Decimal
+from datetime import datetime, timedelta
+from itertools import groupby
+import json
+import os
+from repositories.statement_repository import StatementRepository
+from repositories.balance_checkpoint_repository import BalanceCheckpointRepository
+from services.balance_services import month_start, next_month_start
+from constants.constants import TransactionTypes
+
+STATEMENT_PARTITION_SIZE = 1000
+
+
+class StatementService():
+    """Monthly account statements, written as one newline delimited json file per partition
+    of account ids. A partition's file only appears once all its statements are written,
+    so a job that stops halfway is resumed by skipping the partitions that have a file"""
+    def __init__(self,
+                 statement_repository: StatementRepository,
+                 balance_checkpoint_repository: BalanceCheckpointRepository
+                 ) -> None:
+        self.statement_repository = statement_repository
+        self.balance_checkpoint_repository = balance_checkpoint_repository
+
+    def get_partitions(self, partition_size: int=STATEMENT_PARTITION_SIZE) -> list[tuple[int, int]]:
+        """Splits the account ids into (first_id, last_id) ranges of partition_size ids"""
+        first_account_id, last_account_id = self.balance_checkpoint_repository.get_account_id_range()
+        if first_account_id is None:
+            return []
+        return [(start, min(start + partition_size - 1, last_account_id))
+                for start in range(first_account_id, last_account_id + 1, partition_size)]
+
+    def get_partition_path(self, directory: str, month: datetime, first_account_id: int,
+                           last_account_id: int) -> str:
+        return os.path.join(directory, month.strftime("%Y-%m"),
+                            f"accounts-{first_account_id}-{last_account_id}.ndjson")
+
+    def write_partition(self,
+                        directory: str,
+                        month: datetime,
+                        first_account_id: int,
+                        last_account_id: int
+                        ) -> int|None:
+        """Writes the statements for month of the accounts with ids in a range to the partition's
+        file. Returns the number of statements written, or None if an earlier run already wrote them"""
+        path = self.get_partition_path(directory, month, first_account_id, last_account_id)
+        if os.path.exists(path):
+            return None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = 0
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            for statement in self.iter_statements(month, first_account_id, last_account_id):
+                file.write(json.dumps(statement) + "\n")
+                written += 1
+        # Renaming is atomic, so a partition is either missing or complete
+        os.replace(path + ".tmp", path)
+        return written
+
+    def iter_statements(self, month: datetime, first_account_id: int, last_account_id: int):
+        """Yields the statement for month of each account with an id in a range that was opened
+        by the end of the month. Opening balances are read from the month start checkpoints,
+        the transactions of the whole partition with one ordered range scan"""
+        period_start = month_start(month)
+        period_end = next_month_start(month)
+        accounts = self.statement_repository.get_accounts(first_account_id, last_account_id,
+                                                          period_end.date())
+        if not accounts:
+            return
+        opening_balances = self.balance_checkpoint_repository.get_balances_as_of(
+            [account.id for account in accounts], period_start)
+
+        transactions_per_account = groupby(
+            self.statement_repository.iter_transactions(first_account_id, last_account_id,
+                                                        period_start, period_end),
+            key=lambda transaction: transaction.account_id)
+        account_id, transactions = next(transactions_per_account, (None, []))
+        for account in accounts:
+            # Both are ordered by account id, so the accounts and their transactions are merged
+            while account_id is not None and account_id < account.id:
+                account_id, transactions = next(transactions_per_account, (None, []))
+            yield self._statement(account,
+                                  period_start,
+                                  period_end,
+                                  opening_balances.get(account.id, Decimal(0)),
+                                  transactions if account_id == account.id else [])
+
+    def _statement(self,
+                   account,
+                   period_start: datetime,
+                   period_end: datetime,
+                   opening_balance: Decimal,
+                   transactions
+                   ) -> dict:
+        total_deposits = total_withdrawals = Decimal(0)
+        lines = []
+        for id, transaction_type, timestamp, amount, new_balance, _ in transactions:
+            if transaction_type == TransactionTypes.WITHDRAW.value:
+                total_withdrawals += amount
+            else:
+                total_deposits += amount
+            lines.append({"id": id,
+                          "type": transaction_type,
+                          "timestamp": timestamp.isoformat(),
+                          "amount": str(amount),
+                          "new_balance": str(new_balance)})
+
+        return {"account_id": account.id,
+                "customer_id": account.customer_id,
+                "account_type": account.account_type,
+                "period_start": period_start.date().isoformat(),
+                "period_end": (period_end - timedelta(days=1)).date().isoformat(),
+                "opening_balance": str(opening_balance),
+                "closing_balance": str(opening_balance + total_deposits - total_withdrawals),
+                "total_deposits": str(total_deposits),
+                "total_withdrawals": str(total_withdrawals),
+                "transactions": lines}
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from threading import Lock
+from repositories.customer_repository import CustomerRepository
+from models import Customer
+from constants.constants import BusinessConstants
+
+
+class LeaderboardCustomer():
+    """The customer details shown on a leaderboard, copied so they outlive the session"""
+    def __init__(self, customer: Customer) -> None:
+        self.id = customer.id
+        self.first_name = customer.first_name
+        self.last_name = customer.last_name
+
+
+class LeaderboardEntry():
+    """Has the attributes of get_top_customers_for_country rows"""
+    def __init__(self, customer: Customer, number_of_accounts: int, sum_of_accounts: Decimal) -> None:
+        self.Customer = LeaderboardCustomer(customer)
+        self.number_of_accounts = number_of_accounts
+        self.sum_of_accounts = sum_of_accounts
+
+
+class CountryLeaderboard():
+    """A country's customers with the largest sums of balances, largest first. More are kept
+    than shown so customers dropping out of the top can be replaced without a query.
+    Complete if the country had fewer customers than that when loaded, so all of them are held"""
+    def __init__(self, entries: list[LeaderboardEntry], kept: int, loaded_at: datetime,
+                 merged_candidates: int) -> None:
+        self.entries = entries
+        self.complete = len(entries) < kept
+        self.loaded_at = loaded_at
+        self.merged_candidates = merged_candidates
+
+    def sort(self) -> None:
+        self.entries.sort(key=lambda entry: entry.sum_of_accounts, reverse=True)
+
+
+class TopCustomersService():
+    """Serves the top customers of each country from leaderboards kept in memory and updated
+    with the balance changes of the transactions made in this process, so a page view reads
+    no customers or accounts. Customers outside every leaderboard whose balance grew are noted
+    as candidates and looked up in one query on the next read of a leaderboard. Leaderboards
+    are reloaded after refresh_interval, which picks up other processes' transactions and
+    corrects any drift. Queries run without holding the lock, so transactions are not held up
+    by a page view"""
+    def __init__(self,
+                 customer_repository: CustomerRepository,
+                 shown: int=BusinessConstants.TOP_CUSTOMERS_SHOWN,
+                 kept: int=BusinessConstants.TOP_CUSTOMERS_KEPT,
+                 refresh_interval: timedelta=BusinessConstants.TOP_CUSTOMERS_REFRESH_INTERVAL,
+                 max_candidates: int=BusinessConstants.TOP_CUSTOMERS_MAX_CANDIDATES
+                 ) -> None:
+        self.customer_repository = customer_repository
+        self.shown = shown
+        self.kept = kept
+        self.refresh_interval = refresh_interval
+        self.max_candidates = max_candidates
+        self._leaderboards: dict[str, CountryLeaderboard] = {}
+        # Country code of every customer on a leaderboard
+        self._customer_countries: dict[int, str] = {}
+        # Ids of customers on no leaderboard whose balance grew, each leaderboard
+        # remembers how many of them it has merged
+        self._candidates: list[int] = []
+        # Ids of customers whose balance changed while a query was running, and how many run
+        self._changed: list[int] = []
+        self._queries = 0
+        # Incremented by every clear, so a query running meanwhile is not kept
+        self._generation = 0
+        self._lock = Lock()
+
+    def get_top_customers(self, country_code: str, now: datetime=None) -> list[LeaderboardEntry]:
+        """The customers of a country with the largest sums of balances, largest first"""
+        now = now or datetime.now()
+        with self._lock:
+            leaderboard = self._leaderboards.get(country_code)
+            if (leaderboard is None
+                    or now - leaderboard.loaded_at > self.refresh_interval
+                    or (not leaderboard.complete and len(leaderboard.entries) < self.shown)):
+                leaderboard = self._load(country_code, now)
+            elif leaderboard.merged_candidates < len(self._candidates):
+                self._merge_candidates(country_code, leaderboard)
+            return leaderboard.entries[:self.shown]
+
+    def _query_unlocked(self, query) -> tuple[list[LeaderboardEntry], set[int], bool]:
+        """Runs query, which returns entries, releasing the lock while it runs. Must be called
+        holding the lock. Returns the entries, the ids of the customers whose balance changed
+        meanwhile and whether the leaderboards were cleared meanwhile"""
+        started, generation = len(self._changed), self._generation
+        self._queries += 1
+        self._lock.release()
+        try:
+            entries = query()
+        finally:
+            self._lock.acquire()
+            changed = set(self._changed[started:])
+            self._queries -= 1
+            if not self._queries:
+                self._changed.clear()
+        return entries, changed, generation != self._generation
+
+    def _load(self, country_code: str, now: datetime) -> CountryLeaderboard:
+        merged_candidates = len(self._candidates)
+        entries, changed, cleared = self._query_unlocked(lambda: [
+            LeaderboardEntry(row.Customer, row.number_of_accounts, row.sum_of_accounts)
+            for row in self.customer_repository.get_top_customers_for_country(country_code, self.kept)])
+        leaderboard = CountryLeaderboard(entries, self.kept, now, merged_candidates)
+        if cleared:
+            return leaderboard
+
+        # The rows of customers whose balance changed during the query may or may not include
+        # the change, so they are looked up again as candidates
+        uncertain = [entry.Customer.id for entry in entries if entry.Customer.id in changed]
+        if uncertain:
+            leaderboard.entries = [entry for entry in entries if entry.Customer.id not in changed]
+            self._candidates += uncertain
+        self._drop(country_code)
+        self._leaderboards[country_code] = leaderboard
+        for entry in leaderboard.entries:
+            self._customer_countries[entry.Customer.id] = country_code
+        return leaderboard
+
+    def _drop(self, country_code: str) -> None:
+        leaderboard = self._leaderboards.pop(country_code, None)
+        if leaderboard:
+            for entry in leaderboard.entries:
+                self._customer_countries.pop(entry.Customer.id, None)
+
+    def _merge_candidates(self, country_code: str, leaderboard: CountryLeaderboard) -> None:
+        """Adds the candidates of the country that now belong on its leaderboard"""
+        candidate_ids = set(self._candidates[leaderboard.merged_candidates:]) - self._customer_countries.keys()
+        leaderboard.merged_candidates = len(self._candidates)
+        if not candidate_ids:
+            return
+
+        entries, changed, cleared = self._query_unlocked(lambda: [
+            LeaderboardEntry(row.Customer, row.number_of_accounts, row.sum_of_accounts)
+            for row in self.customer_repository.get_customer_totals_in_country(candidate_ids, country_code)])
+        if cleared or self._leaderboards.get(country_code) is not leaderboard:
+            return
+
+        for entry in entries:
+            if entry.Customer.id in self._customer_countries:
+                continue
+            if entry.Customer.id in changed:
+                self._candidates.append(entry.Customer.id)
+            elif (leaderboard.complete or not leaderboard.entries
+                    or entry.sum_of_accounts > leaderboard.entries[-1].sum_of_accounts):
+                leaderboard.entries.append(entry)
+                self._customer_countries[entry.Customer.id] = country_code
+        leaderboard.sort()
+        while len(leaderboard.entries) > self.kept:
+            self._customer_countries.pop(leaderboard.entries.pop().Customer.id)
+            leaderboard.complete = False
+
+    def balances_changed(self, changes: list[tuple[int, Decimal]]) -> None:
+        """Applies committed (customer_id, amount) changes of customers' sums of balances"""
+        with self._lock:
+            if self._queries:
+                self._changed += [customer_id for customer_id, _ in changes]
+            for customer_id, amount in changes:
+                country_code = self._customer_countries.get(customer_id)
+                if country_code is None:
+                    if amount > 0:
+                        self._candidates.append(customer_id)
+                    continue
+
+                leaderboard = self._leaderboards[country_code]
+                entry = next(entry for entry in leaderboard.entries if entry.Customer.id == customer_id)
+                entry.sum_of_accounts += amount
+                leaderboard.sort()
+                if amount < 0 and not leaderboard.complete and leaderboard.entries[-1] is entry:
+                    # Customers that are not kept may now have more
+                    leaderboard.entries.pop()
+                    del self._customer_countries[customer_id]
+
+            if len(self._candidates) > self.max_candidates:
+                self._clear()
+
+    def clear(self) -> None:
+        """Drops every leaderboard, so they are loaded again on their next read.
+        Call after editing customers, as their names or country may have changed"""
+        with self._lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        self._generation += 1
+        self._leaderboards.clear()
+        self._customer_countries.clear()
+        self._candidates.clear()
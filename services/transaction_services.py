@@ -1,18 +1,30 @@
-from decimal import Decimal
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
 from datetime import datetime, timedelta, date
+from sqlalchemy.exc import IntegrityError
 from repositories.transaction_repository import TransactionRepository
+from repositories.idempotency_repository import IdempotencyRepository, request_fingerprint
 from models import Account, Customer, Transaction
 from services.account_services import AccountService
+from services.fraud_services import FraudMonitor
+from services.idempotency_services import IdempotencyService
+from services.top_customers_services import TopCustomersService
 from constants.constants import TransactionTypes
 from constants.errors_messages import ErrorMessages
 
 class TransactionService():
     def __init__(self,
                  transaction_repository: TransactionRepository,
-                 account_service: AccountService
+                 account_service: AccountService,
+                 fraud_monitor: FraudMonitor=None,
+                 idempotency_service: IdempotencyService=None,
+                 top_customers_service: TopCustomersService=None
                  ) -> None:
         self.transaction_repository = transaction_repository
         self.account_service = account_service
+        self.fraud_monitor = fraud_monitor
+        self.idempotency_service = idempotency_service or IdempotencyService(IdempotencyRepository())
+        self.top_customers_service = top_customers_service
 
     def _calculate_new_balance(self,
                                account: Account,
@@ -29,10 +41,47 @@ class TransactionService():
                                      account_id: int,
                                      amount: Decimal,
                                      transaction_type_name: str,
-                                     to_account_id: int=None
+                                     to_account_id: int=None,
+                                     idempotency_key: str=None
                                      ) -> list[Transaction]:
         """Determines where to send transaction depending on transaction type,
-        must provide to_account if type is transfer"""
+        must provide to_account if type is transfer. A submission retried with the same
+        idempotency key returns the transactions the first one made instead of posting again,
+        a different submission with the key raises ValueError"""
+        if idempotency_key is None:
+            return self._initiate_transaction_process(account_id, amount, transaction_type_name,
+                                                      to_account_id)
+
+        self.idempotency_service.validate_key(idempotency_key)
+        fingerprint = request_fingerprint(transaction_type_name, account_id,
+                                          to_account_id if transaction_type_name == "transfer" else None,
+                                          amount)
+        transactions = self.idempotency_service.get_transactions(idempotency_key, fingerprint)
+        if transactions is not None:
+            return transactions
+
+        try:
+            transactions = self._initiate_transaction_process(account_id, amount, transaction_type_name,
+                                                              to_account_id, idempotency_key)
+        except IntegrityError:
+            # A concurrent submission with the same key committed first
+            self.transaction_repository.rollback()
+            transactions = self.idempotency_service.get_transactions(idempotency_key, fingerprint)
+            if transactions is None:
+                raise
+            return transactions
+
+        self.idempotency_service.remember(idempotency_key, fingerprint,
+                                          [transaction.id for transaction in transactions])
+        return transactions
+
+    def _initiate_transaction_process(self,
+                                      account_id: int,
+                                      amount: Decimal,
+                                      transaction_type_name: str,
+                                      to_account_id: int=None,
+                                      idempotency_key: str=None
+                                      ) -> list[Transaction]:
         from_account = self.account_service.get_account_from_id(account_id, raise_404=False)
         if not from_account:
             raise ValueError(ErrorMessages.UNKNOWN_ACCOUNT.value)
@@ -45,41 +94,200 @@ class TransactionService():
             if not to_account:
                 raise ValueError(ErrorMessages.UNKNOWN_ACCOUNT.value)
             
-            return self.process_transfer(from_account, to_account, amount)
+            return self.process_transfer(from_account, to_account, amount, idempotency_key)
         else:
             transaction_type = TransactionTypes.get_type_by_value(transaction_type_name)
-            return [self.process_transaction(from_account, amount, transaction_type)]
+            return [self.process_transaction(from_account, amount, transaction_type, idempotency_key)]
 
     def process_transaction(self,
                             target_account: Account,
                             amount: Decimal,
-                            transaction_type: TransactionTypes
+                            transaction_type: TransactionTypes,
+                            idempotency_key: str=None
                             ) -> Transaction:
-        """Checks amount for negatives/zero and against account balance, finally executing transaction"""
+        """Checks amount for negatives/zero and against account balance, finally executing transaction.
+        The balance is checked again after locking the account, so concurrent withdrawals cannot overdraw.
+        With group commit enabled the transaction is committed in a batch with concurrent ones,
+        the fraud monitor and leaderboards are skipped if the writer found it already made"""
         if amount < 0:
             raise ValueError(ErrorMessages.NEGATIVE_AMOUNT.value)
-        
+
         if transaction_type == TransactionTypes.WITHDRAW:
             if amount > target_account.balance:
                 raise ValueError(ErrorMessages.INSUFFICIENT_FUNDS.value)
-            
-        new_balance = self._calculate_new_balance(target_account, amount, transaction_type)      
-        return self.transaction_repository.execute_transaction(
-            target_account,
-            amount,
-            transaction_type,
-            new_balance)
+
+        customer_id = target_account.customer_id
+        if self.transaction_repository.group_commit_writer:
+            # The writer locks the account and checks the balance again itself
+            transaction, written = self.transaction_repository.execute_group_committed(
+                target_account,
+                amount,
+                transaction_type,
+                idempotency_key)
+            if not written:
+                return transaction
+        else:
+            target_account = self.transaction_repository.lock_accounts([target_account.id])[target_account.id]
+            if transaction_type == TransactionTypes.WITHDRAW and amount > target_account.balance:
+                self.transaction_repository.rollback()
+                raise ValueError(ErrorMessages.INSUFFICIENT_FUNDS.value)
+
+            new_balance = self._calculate_new_balance(target_account, amount, transaction_type)
+            transaction = self.transaction_repository.execute_transaction(
+                target_account,
+                amount,
+                transaction_type,
+                new_balance,
+                idempotency_key)
+
+        if self.fraud_monitor:
+            self.fraud_monitor.check_transaction(transaction, customer_id)
+        if self.top_customers_service:
+            self.top_customers_service.balances_changed(
+                [(customer_id, amount if transaction_type == TransactionTypes.DEPOSIT else -amount)])
+
+        return transaction
 
     def process_transfer(self,
                          from_account: Account,
                          to_account: Account,
-                         amount: Decimal
+                         amount: Decimal,
+                         idempotency_key: str=None
                          ) -> list[Transaction]:
-        """Initiates two transactions, withdraw from from_account and deposit into to_account"""
-        withdraw_transaction = self.process_transaction(from_account, amount, TransactionTypes.WITHDRAW)
-        deposit_transaction = self.process_transaction(to_account, amount, TransactionTypes.DEPOSIT)
+        """Withdraws from from_account and deposits into to_account atomically: both accounts are
+        locked, the balance is checked under the lock and both transactions are committed at once"""
+        if amount < 0:
+            raise ValueError(ErrorMessages.NEGATIVE_AMOUNT.value)
+
+        if amount > from_account.balance:
+            raise ValueError(ErrorMessages.INSUFFICIENT_FUNDS.value)
+
+        accounts = self.transaction_repository.lock_accounts([from_account.id, to_account.id])
+        from_account, to_account = accounts[from_account.id], accounts[to_account.id]
+        if amount > from_account.balance:
+            self.transaction_repository.rollback()
+            raise ValueError(ErrorMessages.INSUFFICIENT_FUNDS.value)
+
+        withdraw_transaction, deposit_transaction = self.transaction_repository.execute_transfer(
+            from_account,
+            to_account,
+            amount,
+            idempotency_key)
+
+        if self.fraud_monitor:
+            self.fraud_monitor.check_transaction(withdraw_transaction, from_account.customer_id)
+            self.fraud_monitor.check_transaction(deposit_transaction, to_account.customer_id)
+        if self.top_customers_service:
+            self.top_customers_service.balances_changed([(from_account.customer_id, -amount),
+                                                         (to_account.customer_id, amount)])
+
         return [withdraw_transaction, deposit_transaction]
 
+    def parse_transaction_item(self, item: dict) -> tuple[str, int, int|None, Decimal]:
+        """Returns type name, account id, to account id and amount of a submitted
+        {"type", "account_id", "amount", "to_account_id"} item,
+        raising ValueError if any of them is missing or invalid"""
+        if not isinstance(item, dict):
+            raise ValueError(ErrorMessages.INVALID_BATCH.value)
+
+        transaction_type_name = item.get("type")
+        if transaction_type_name not in [type.value for type in TransactionTypes] + ["transfer"]:
+            raise ValueError(ErrorMessages.UNKNOWN_TRANSACTION_TYPE.value)
+
+        account_id = item.get("account_id")
+        to_account_id = item.get("to_account_id") if transaction_type_name == "transfer" else None
+        for id in (account_id, to_account_id) if transaction_type_name == "transfer" else (account_id,):
+            if not isinstance(id, int) or isinstance(id, bool):
+                raise ValueError(ErrorMessages.ACCOUNT_ID_INT.value)
+        if account_id == to_account_id:
+            raise ValueError(ErrorMessages.SAME_ACCOUNT.value)
+
+        try:
+            amount = Decimal(str(item.get("amount")))
+        except InvalidOperation:
+            raise ValueError(ErrorMessages.INVALID_AMOUNT.value)
+        if not amount.is_finite():
+            raise ValueError(ErrorMessages.INVALID_AMOUNT.value)
+        if amount < 0:
+            raise ValueError(ErrorMessages.NEGATIVE_AMOUNT.value)
+        # Amounts are stored in cents, like the transaction form accepts them
+        try:
+            in_cents = amount == amount.quantize(Decimal("0.01"))
+        except InvalidOperation:
+            raise ValueError(ErrorMessages.INVALID_AMOUNT.value)
+        if not in_cents:
+            raise ValueError(ErrorMessages.TOO_MANY_DECIMALS.value)
+
+        return transaction_type_name, account_id, to_account_id, amount
+
+    def process_batch(self, items: list[dict]) -> list[dict]:
+        """Executes a batch of {"type", "account_id", "amount"} items, with a "to_account_id"
+        for transfers. Items are applied in order, each against the balances left by the ones
+        before it, and an item breaking a rule is rejected without affecting the others.
+        All accounts are locked with one query per thousand and the accepted transactions are
+        bulk inserted in a single commit, then checked by the fraud monitor one by one.
+        Returns an {"index", "status", "error" or "transactions"} result per item"""
+        results = [None] * len(items)
+        parsed_items = []
+        for index, item in enumerate(items):
+            try:
+                parsed_items.append((index, *self.parse_transaction_item(item)))
+            except ValueError as error:
+                results[index] = {"index": index, "status": "rejected", "error": str(error)}
+
+        accounts = self.transaction_repository.lock_accounts(
+            [account_id
+             for _, _, from_account_id, to_account_id, _ in parsed_items
+             for account_id in (from_account_id, to_account_id) if account_id is not None])
+
+        timestamp = datetime.now()
+        transactions = []
+        for index, transaction_type_name, account_id, to_account_id, amount in parsed_items:
+            account = accounts.get(account_id)
+            to_account = accounts.get(to_account_id)
+            if account is None or (to_account_id is not None and to_account is None):
+                error = ErrorMessages.UNKNOWN_ACCOUNT.value
+            elif transaction_type_name != TransactionTypes.DEPOSIT.value and amount > account.balance:
+                error = ErrorMessages.INSUFFICIENT_FUNDS.value
+            else:
+                error = None
+            if error:
+                results[index] = {"index": index, "status": "rejected", "error": error}
+                continue
+
+            if transaction_type_name == "transfer":
+                legs = [(account, TransactionTypes.WITHDRAW), (to_account, TransactionTypes.DEPOSIT)]
+            else:
+                legs = [(account, TransactionTypes.get_type_by_value(transaction_type_name))]
+
+            item_transactions = []
+            for leg_account, transaction_type in legs:
+                leg_account.balance = self._calculate_new_balance(leg_account, amount, transaction_type)
+                item_transactions.append({"type": transaction_type.value,
+                                          "timestamp": timestamp,
+                                          "amount": amount,
+                                          "new_balance": leg_account.balance,
+                                          "account_id": leg_account.id})
+            transactions += item_transactions
+            results[index] = {"index": index, "status": "accepted", "transactions": item_transactions}
+
+        # Read before the commit expires the accounts
+        customer_ids = {account_id: account.customer_id for account_id, account in accounts.items()}
+        balance_changes = defaultdict(Decimal)
+        for transaction in transactions:
+            balance_changes[customer_ids[transaction["account_id"]]] += (
+                transaction["amount"] if transaction["type"] == TransactionTypes.DEPOSIT.value
+                else -transaction["amount"])
+
+        ids = self.transaction_repository.execute_batch(transactions, accounts)
+        if self.fraud_monitor:
+            for id, transaction in zip(ids, transactions):
+                self.fraud_monitor.check_transaction(Transaction(id=id, **transaction),
+                                                     customer_ids[transaction["account_id"]])
+        if self.top_customers_service:
+            self.top_customers_service.balances_changed(list(balance_changes.items()))
+        return results
+
     def get_count_of_transactions(self, account_id: int) -> int:
         return self.transaction_repository.get_count_of_transactions(account_id)
     
@@ -90,6 +298,22 @@ class TransactionService():
                                         ) -> list[Transaction]:
         return self.transaction_repository.get_limited_offset_transactions(account_id, limit, offset)
     
+    def get_transactions_page(self,
+                              account_id: int,
+                              limit: int,
+                              cursor: tuple[datetime, int]=None
+                              ) -> tuple[list[Transaction], tuple[datetime, int]|None]:
+        """Returns a page of an account's transactions, newest first, after cursor and the
+        cursor of the next page, or None on the last page. One extra row is fetched to find
+        out if there is a next page, so no count is needed"""
+        transactions = self.transaction_repository.get_transactions_before_cursor(account_id,
+                                                                                  limit + 1,
+                                                                                  cursor)
+        if len(transactions) <= limit:
+            return transactions, None
+        transactions = transactions[:limit]
+        return transactions, (transactions[-1].timestamp, transactions[-1].id)
+
     def get_sum_transactions_of_customer(self,
                                        customer: Customer,
                                        time_period: timedelta
@@ -0,0 +1,561 @@
+from datetime import datetime, timedelta, date, time
+from decimal import Decimal
+import importlib.util
+import os
+import smtplib
+import tempfile
+import unittest
+from unittest import mock
+
+from flask_mail import Connection, Message, email_dispatched
+
+from app import create_app
+from config import TestConfig
+from sqlalchemy import event
+from models import (db, Country, Customer, Account, Transaction, TransactionFlag, AuditLock,
+                    CustomerHourlyTransactions)
+from constants.constants import TransactionTypes, AuditRules
+from services.audit_services import AuditService, AuditRepository
+from services.fraud_services import FraudMonitor, TransactionFlagRepository
+from services.transaction_services import TransactionService, TransactionRepository
+from services.account_services import AccountService, AccountRepository
+from services.customer_services import CustomerService, CustomerRepository
+from services.audit_report_services import AuditReportService
+from services.mail_services import MailDispatcher
+from services.audit_rules_engine import AuditRulesEngine, AuditRule, AmountThresholdRule, VelocityCountRule
+from repositories.transaction_aggregate_repository import TransactionAggregateRepository
+from extensions import mail
+
+
+class AuditTestCase(unittest.TestCase):
+    config = TestConfig
+
+    def setUp(self) -> None:
+        """ Set up a test database with one customer per audit scenario"""
+        self.app = create_app(self.config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.service = AuditService(AuditRepository())
+        self.audit_time = datetime.now().replace(hour=12)
+        self.yesterday = self.audit_time - timedelta(days=1)
+
+        db.session.add(Country(country_code="SE", name="Sweden", telephone_country_code="+46"))
+        self.large_yesterday = self.add_customer_with_account(1)
+        self.many_recent = self.add_customer_with_account(2)
+        self.below_limits = self.add_customer_with_account(3)
+        self.large_last_week = self.add_customer_with_account(4)
+        db.session.commit()
+
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        return super().tearDown()
+
+    def add_customer_with_account(self, customer_id: int) -> Account:
+        db.session.add(Customer(
+            id=customer_id, first_name="Test", last_name=f"Customer{customer_id}",
+            address="Street 1", city="Stockholm", postal_code="12345",
+            birthday=date(1980, 1, 1), national_id=f"{customer_id:012}",
+            telephone="0701234567", email="test@example.com", country="SE"))
+        account = Account(id=customer_id, account_type="Checking", created=date(2000, 1, 1),
+                          balance=Decimal(0), customer_id=customer_id)
+        db.session.add(account)
+        return account
+
+    def add_transaction(self, account: Account, amount: int, timestamp: datetime) -> Transaction:
+        transaction = Transaction(type=TransactionTypes.DEPOSIT.value, timestamp=timestamp,
+                                  amount=Decimal(amount), new_balance=Decimal(amount),
+                                  account_id=account.id)
+        db.session.add(transaction)
+        TransactionAggregateRepository().add_transaction(account.customer_id, timestamp,
+                                                         transaction.amount)
+        db.session.commit()
+        return transaction
+
+
+class TestAudit(AuditTestCase):
+    def test_1_single_transaction_over_limit_yesterday_is_flagged(self):
+        transaction = self.add_transaction(self.large_yesterday, 15001, self.yesterday)
+
+        flagged = self.service.audit_country("SE", self.audit_time)
+
+        self.assertEqual(flagged, {1: {"transactions": {transaction.id}, "accounts": {1}}})
+
+    def test_2_all_recent_transactions_flagged_when_sum_exceeds_limit(self):
+        transactions = [self.add_transaction(self.many_recent, 8000,
+                                             self.audit_time - timedelta(hours=hours))
+                        for hours in (1, 30, 60)]
+
+        flagged = self.service.audit_country("SE", self.audit_time)
+
+        self.assertEqual(flagged[2]["transactions"], {t.id for t in transactions})
+
+    def test_3_customers_below_limits_are_not_flagged(self):
+        self.add_transaction(self.below_limits, 15000, self.yesterday)
+        self.add_transaction(self.below_limits, 8000, self.audit_time - timedelta(hours=2))
+        self.add_transaction(self.large_last_week, 50000, self.audit_time - timedelta(days=7))
+
+        flagged = self.service.audit_country("SE", self.audit_time)
+
+        self.assertEqual(flagged, {})
+
+    def test_4_transaction_flagged_by_both_rules_is_only_reported_once(self):
+        transaction = self.add_transaction(self.large_yesterday, 24000, self.yesterday)
+
+        flagged = self.service.audit_country("SE", self.audit_time)
+
+        self.assertEqual(flagged, {1: {"transactions": {transaction.id}, "accounts": {1}}})
+
+    def test_5_incremental_audit_matches_full_audit_across_runs(self):
+        self.add_transaction(self.large_yesterday, 15001, self.yesterday)
+        self.add_transaction(self.many_recent, 8000, self.audit_time - timedelta(hours=70))
+        self.service.refresh_audit_window(self.audit_time - timedelta(hours=1))
+
+        self.add_transaction(self.many_recent, 16000, self.audit_time - timedelta(minutes=5))
+        self.add_transaction(self.below_limits, 100, self.audit_time - timedelta(minutes=4))
+        self.service.refresh_audit_window(self.audit_time)
+
+        full = self.service.audit_country("SE", self.audit_time)
+        incremental = self.service.audit_country_incremental("SE", self.audit_time)
+
+        self.assertEqual(self.service.compare_audit_results(full, incremental), [])
+        self.assertEqual(set(incremental), {1, 2})
+
+    def test_6_incremental_refresh_only_reads_new_transactions(self):
+        self.add_transaction(self.many_recent, 100, self.audit_time - timedelta(hours=5))
+        self.add_transaction(self.many_recent, 100, self.audit_time - timedelta(hours=4))
+        self.assertEqual(self.service.refresh_audit_window(self.audit_time), 2)
+
+        self.add_transaction(self.many_recent, 100, self.audit_time - timedelta(hours=3))
+        self.assertEqual(self.service.refresh_audit_window(self.audit_time), 1)
+        self.assertEqual(self.service.refresh_audit_window(self.audit_time), 0)
+
+    def test_7_findings_are_saved_per_run_and_filterable(self):
+        transaction = self.add_transaction(self.large_yesterday, 24000, self.yesterday)
+        run = self.service.start_run(self.audit_time)
+        findings = self.service.find_suspicious_transactions("SE", self.audit_time)
+
+        saved = self.service.save_findings(run, {"SE": findings})
+        page = self.service.get_paginated_findings({"run_id": run.id, "customer_id": 1,
+                                                    "country": ""}, 1, 50)
+
+        self.assertEqual(saved, 2)
+        self.assertEqual({(f.transaction_id, f.rule, f.country) for f in page.items},
+                         {(transaction.id, AuditRules.SINGLE_TRANSACTION.value, "SE"),
+                          (transaction.id, AuditRules.RECENT_TRANSACTIONS.value, "SE")})
+
+    def test_8_audit_lock_is_held_by_one_owner_until_released_or_expired(self):
+        self.assertTrue(self.service.acquire_lock("node-1"))
+        self.assertFalse(self.service.acquire_lock("node-2"))
+        self.assertTrue(self.service.acquire_lock("node-1"))
+
+        self.service.release_lock("node-1")
+        self.assertTrue(self.service.acquire_lock("node-2"))
+
+        AuditLock.query.one().expires = datetime.now() - timedelta(minutes=1)
+        db.session.commit()
+        self.assertTrue(self.service.acquire_lock("node-1"))
+
+    def test_9_finished_run_records_metrics_and_missed_nights_are_found(self):
+        self.add_transaction(self.large_yesterday, 15001, self.yesterday)
+        self.add_transaction(self.large_last_week, 100, self.audit_time - timedelta(days=7))
+        last_midnight = datetime.combine(self.audit_time.date(), time.min)
+        run = self.service.start_run(last_midnight - timedelta(days=3), "node-1")
+
+        self.service.finish_run(run, self.service.count_audited_transactions(self.audit_time), 2)
+        missed = self.service.get_missed_audit_times(time.min, self.audit_time)
+
+        self.assertEqual((run.rows_scanned, run.findings_count, run.node), (1, 2, "node-1"))
+        self.assertGreaterEqual(run.duration_seconds, 0)
+        self.assertEqual(missed, [last_midnight - timedelta(days=days) for days in (2, 1, 0)])
+
+    def test_10_transaction_committing_far_below_the_watermark_is_copied_once(self):
+        audit_time = datetime.now() + timedelta(minutes=1)
+        self.add_transaction(self.many_recent, 100, audit_time - timedelta(hours=5))
+        db.session.add(Transaction(id=5000, type=TransactionTypes.DEPOSIT.value,
+                                   timestamp=audit_time - timedelta(hours=4), amount=Decimal(100),
+                                   new_balance=Decimal(200), account_id=self.many_recent.id))
+        db.session.commit()
+        self.assertEqual(self.service.refresh_audit_window(audit_time), 2)
+
+        # Given its id and timestamp before the refresh, committed after it
+        db.session.add(Transaction(id=3, type=TransactionTypes.DEPOSIT.value,
+                                   timestamp=datetime.now() - timedelta(minutes=1), amount=Decimal(24000),
+                                   new_balance=Decimal(24200), account_id=self.many_recent.id))
+        db.session.commit()
+        self.assertEqual(self.service.refresh_audit_window(audit_time), 1)
+        self.assertEqual(self.service.refresh_audit_window(audit_time), 0)
+        self.assertEqual(self.service.audit_country_incremental("SE", audit_time)[2]["transactions"],
+                         {1, 3, 5000})
+
+    def test_11_window_follows_a_customer_moving_country(self):
+        self.add_transaction(self.large_yesterday, 15001, self.yesterday)
+        db.session.add(Country(country_code="NO", name="Norway", telephone_country_code="+47"))
+        db.session.commit()
+        self.service.refresh_audit_window(self.audit_time)
+
+        CustomerRepository().edit_customer(db.session.get(Customer, 1), {"country": "NO"})
+
+        self.assertEqual(self.service.audit_country_incremental("SE", self.audit_time), {})
+        self.assertEqual(self.service.audit_country_incremental("NO", self.audit_time),
+                         self.service.audit_country("NO", self.audit_time))
+        self.assertEqual(set(self.service.audit_country_incremental("NO", self.audit_time)), {1})
+
+class TestCustomerAggregates(AuditTestCase):
+    def test_1_windowed_sums_from_backfilled_aggregates_match_raw_transactions(self):
+        audit_time = self.audit_time.replace(minute=30, second=0, microsecond=0)
+        amounts = [(self.many_recent, 100, timedelta(hours=80, minutes=10)),
+                   (self.many_recent, 200, timedelta(hours=71, minutes=20)),
+                   (self.many_recent, 400, timedelta(hours=71, minutes=5)),
+                   (self.many_recent, 800, timedelta(hours=30)),
+                   (self.below_limits, 1600, timedelta(minutes=20)),
+                   (self.many_recent, 3200, timedelta(minutes=0))]
+        for account, amount, age in amounts:
+            db.session.add(Transaction(type=TransactionTypes.DEPOSIT.value,
+                                       timestamp=audit_time - age, amount=Decimal(amount),
+                                       new_balance=Decimal(amount), account_id=account.id))
+        db.session.commit()
+        repository = TransactionAggregateRepository()
+
+        self.assertEqual(repository.backfill(), 5)
+        for from_age, to_age in [(timedelta(hours=72, minutes=30), timedelta(0)),
+                                 (timedelta(hours=71, minutes=30), timedelta(minutes=10)),
+                                 (timedelta(hours=71, minutes=50), timedelta(hours=71, minutes=5)),
+                                 (timedelta(hours=71, minutes=10), timedelta(minutes=20))]:
+            sums = db.session.execute(repository.get_customer_sums(
+                audit_time - from_age, audit_time - to_age, country_code="SE")).all()
+            expected = {}
+            for account, amount, age in amounts:
+                if to_age <= age <= from_age:
+                    expected[account.customer_id] = expected.get(account.customer_id, 0) + amount
+            self.assertEqual({row.customer_id: row.amount_sum for row in sums}, expected)
+
+    def test_2_executed_transactions_update_hourly_aggregate(self):
+        transaction_service = TransactionService(TransactionRepository(),
+                                                 AccountService(AccountRepository()))
+        for amount in (100, 300, 200):
+            transaction_service.process_transaction(self.many_recent, Decimal(amount),
+                                                    TransactionTypes.DEPOSIT)
+
+        aggregate = CustomerHourlyTransactions.query.filter_by(customer_id=2).all()
+        total = transaction_service.get_sum_transactions_of_customer(self.customer(2),
+                                                                     timedelta(hours=1))
+
+        self.assertEqual(sum(row.transaction_count for row in aggregate), 3)
+        self.assertEqual(max(row.max_amount for row in aggregate), 300)
+        self.assertEqual(total, 600)
+
+    def customer(self, customer_id: int) -> Customer:
+        return db.session.get(Customer, customer_id)
+
+
+class TestAuditRulesEngine(AuditTestCase):
+    def test_1_default_rules_match_grouped_audit_queries(self):
+        self.add_transaction(self.large_yesterday, 24000, self.yesterday)
+        for hours in (1, 30, 60, 80):
+            self.add_transaction(self.many_recent, 8000, self.audit_time - timedelta(hours=hours))
+        self.add_transaction(self.below_limits, 15000, self.yesterday)
+        self.add_transaction(self.large_last_week, 50000, self.audit_time - timedelta(days=7))
+        engine = AuditRulesEngine(AuditRepository())
+
+        engine_findings = engine.find_suspicious_transactions("SE", self.audit_time)
+        query_findings = self.service.find_suspicious_transactions("SE", self.audit_time)
+
+        self.assertEqual(sorted(engine_findings), sorted(query_findings))
+
+    def test_2_velocity_rule_and_country_limits(self):
+        for minutes in (10, 20, 30):
+            self.add_transaction(self.many_recent, 10, self.audit_time - timedelta(minutes=minutes))
+        self.add_transaction(self.below_limits, 10, self.audit_time - timedelta(minutes=5))
+        self.add_transaction(self.large_yesterday, 600, self.yesterday)
+        engine = AuditRulesEngine(AuditRepository(), [
+            VelocityCountRule(AuditRules.VELOCITY, 2, timedelta(hours=1)),
+            AmountThresholdRule(AuditRules.SINGLE_TRANSACTION, 15000, country_limits={"SE": 500})
+        ])
+
+        findings = engine.find_suspicious_transactions("SE", self.audit_time)
+
+        self.assertEqual(sorted((customer_id, rule) for customer_id, _, _, rule in findings),
+                         [(1, AuditRules.SINGLE_TRANSACTION.value)]
+                         + [(2, AuditRules.VELOCITY.value)] * 3)
+
+    def test_3_rules_must_implement_evaluate(self):
+        with self.assertRaises(TypeError):
+            AuditRule(AuditRules.VELOCITY, 2)
+
+
+class TestFraudMonitor(AuditTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.fraud_monitor = FraudMonitor(TransactionFlagRepository())
+        self.transaction_service = TransactionService(TransactionRepository(),
+                                                      AccountService(AccountRepository()),
+                                                      self.fraud_monitor)
+
+    def deposit(self, account: Account, amount: int) -> Transaction:
+        return self.transaction_service.process_transaction(account, Decimal(amount),
+                                                            TransactionTypes.DEPOSIT)
+
+    def test_1_large_transaction_is_flagged_when_made(self):
+        transaction = self.deposit(self.large_yesterday, 15001)
+
+        flags = TransactionFlag.query.all()
+
+        self.assertEqual([(flag.transaction_id, flag.rule, flag.country) for flag in flags],
+                         [(transaction.id, AuditRules.SINGLE_TRANSACTION.value, "SE")])
+
+    def test_2_crossing_recent_limit_flags_whole_window_including_transactions_from_database(self):
+        earlier = self.add_transaction(self.many_recent, 10000, datetime.now() - timedelta(hours=10))
+        second = self.deposit(self.many_recent, 10000)
+        self.assertEqual(TransactionFlag.query.count(), 0)
+
+        third = self.deposit(self.many_recent, 5000)
+        fourth = self.deposit(self.many_recent, 1)
+
+        flagged_ids = {flag.transaction_id for flag in TransactionFlag.query.all()}
+        self.assertEqual(flagged_ids, {earlier.id, second.id, third.id, fourth.id})
+        self.assertEqual(TransactionFlag.query.count(), 4)
+
+    def test_3_flags_are_read_back_like_audit_findings(self):
+        transaction = self.deposit(self.large_yesterday, 16000)
+
+        flagged = self.fraud_monitor.get_flagged_transactions_for_country(
+            "SE", datetime.now() - timedelta(days=1), datetime.now() + timedelta(minutes=1))
+
+        self.assertEqual(flagged, [(1, 1, transaction.id, AuditRules.SINGLE_TRANSACTION.value)])
+
+    def test_4_windows_are_reloaded_when_stale_and_evicted_when_too_many(self):
+        self.fraud_monitor.max_windows = 2
+        self.deposit(self.many_recent, 10000)
+        # Made by another process, so not seen by the warm window
+        other = self.add_transaction(self.many_recent, 10000, datetime.now() - timedelta(minutes=1))
+        self.deposit(self.many_recent, 5000)
+        self.assertEqual(TransactionFlag.query.count(), 0)
+
+        self.fraud_monitor.reload_interval = 0
+        latest = self.deposit(self.many_recent, 1)
+        self.assertIn(other.id, {flag.transaction_id for flag in TransactionFlag.query.all()})
+        self.assertIn(latest.id, {flag.transaction_id for flag in TransactionFlag.query.all()})
+
+        self.deposit(self.below_limits, 1)
+        self.deposit(self.large_last_week, 1)
+        self.assertEqual(list(self.fraud_monitor._windows), [3, 4])
+
+    def test_5_batch_transactions_are_flagged_and_counted_once(self):
+        self.transaction_service.process_batch([
+            {"type": "deposit", "account_id": self.many_recent.id, "amount": "16000"},
+            {"type": "deposit", "account_id": self.many_recent.id, "amount": "8000"}])
+        first, second = Transaction.query.filter_by(account_id=self.many_recent.id).order_by(Transaction.id)
+
+        self.assertEqual({(flag.transaction_id, flag.rule) for flag in TransactionFlag.query.all()},
+                         {(first.id, AuditRules.SINGLE_TRANSACTION.value),
+                          (first.id, AuditRules.RECENT_TRANSACTIONS.value),
+                          (second.id, AuditRules.RECENT_TRANSACTIONS.value)})
+        self.assertEqual(self.fraud_monitor._windows[self.many_recent.customer_id].sum, 24000)
+
+    def test_6_windows_are_loaded_without_holding_the_lock(self):
+        load = self.fraud_monitor.flag_repository.get_recent_transactions_of_customer
+        lock_held = []
+        def loading(*args):
+            lock_held.append(self.fraud_monitor._lock.locked())
+            return load(*args)
+
+        with mock.patch.object(self.fraud_monitor.flag_repository, "get_recent_transactions_of_customer",
+                               side_effect=loading):
+            self.deposit(self.large_yesterday, 15001)
+            self.fraud_monitor.reload_interval = 0
+            self.deposit(self.large_yesterday, 1)
+
+        self.assertEqual(lock_held, [False, False])
+        self.assertEqual(self.fraud_monitor._windows[self.large_yesterday.customer_id].sum, 15002)
+
+    def test_7_flags_already_raised_by_another_process_do_not_drop_the_others(self):
+        transaction = self.add_transaction(self.large_yesterday, 16000, datetime.now())
+        flag = {"transaction_id": transaction.id, "account_id": self.large_yesterday.id,
+                "customer_id": 1, "country": "SE", "flagged": datetime.now()}
+        repository = TransactionFlagRepository()
+        repository.add_flags([{**flag, "rule": AuditRules.SINGLE_TRANSACTION.value}])
+
+        repository.add_flags([{**flag, "rule": AuditRules.SINGLE_TRANSACTION.value},
+                              {**flag, "rule": AuditRules.RECENT_TRANSACTIONS.value}])
+
+        self.assertEqual(sorted(flag.rule for flag in TransactionFlag.query.all()),
+                         sorted([AuditRules.SINGLE_TRANSACTION.value, AuditRules.RECENT_TRANSACTIONS.value]))
+
+
+class TestAuditReports(AuditTestCase):
+    def test_1_reports_for_all_countries_are_composed_with_one_customer_query(self):
+        report_service = AuditReportService(CustomerService(CustomerRepository(),
+                                                            AccountService(AccountRepository())))
+        flagged_customers_per_country = {
+            "Sweden": {2: {"transactions": {7, 5}, "accounts": {2}},
+                       1: {"transactions": {3}, "accounts": {1}}},
+            "Norway": {4: {"transactions": {9}, "accounts": {4}}}
+        }
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            reports = report_service.compose_reports(flagged_customers_per_country,
+                                                     "Flagged customers found: ", ["csv", "html"])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+
+        self.assertEqual(len(statements), 1)
+        self.assertIn("Customer2", reports["Sweden"]["body"])
+        filename, content_type, data = reports["Sweden"]["attachments"][0]
+        self.assertEqual((filename, content_type), ("Sweden.csv", "text/csv"))
+        self.assertEqual(data.decode().splitlines(),
+                         ["Id,Name,Account number(s),Transaction number(s)",
+                          "1,Test Customer1,1,3",
+                          '2,Test Customer2,2,"5, 7"'])
+        self.assertEqual(reports["Norway"]["attachments"][1][0], "Norway.html")
+
+
+class TestMailDispatcher(AuditTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.dispatcher = MailDispatcher(mail, retries=2, retry_delay=0)
+        self.messages = [Message(f"Report {number}", sender="bank@bank.com",
+                                 recipients=[f"country{number}@testbanken.se"], body="report")
+                         for number in range(3)]
+        self.delivered = []
+        self.record = lambda message, app: self.delivered.append(message.subject)
+        email_dispatched.connect(self.record)
+
+    def tearDown(self) -> None:
+        email_dispatched.disconnect(self.record)
+        self.dispatcher.shutdown()
+        return super().tearDown()
+
+    def test_1_batch_is_delivered_in_background_over_one_connection(self):
+        with mock.patch.object(mail, "connect", wraps=mail.connect) as connect:
+            report = self.dispatcher.dispatch(self.app, self.messages).result(timeout=10)
+
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(self.delivered, ["Report 0", "Report 1", "Report 2"])
+        self.assertEqual((report["sent"], report["failed"], report["attempts"]), (3, 0, 1))
+
+    def test_2_delivery_resumes_on_a_new_connection_after_failure(self):
+        send = Connection.send
+        failures = iter([smtplib.SMTPServerDisconnected("Connection lost")])
+        def send_failing_once(connection, message):
+            if message.subject == "Report 1":
+                error = next(failures, None)
+                if error:
+                    raise error
+            return send(connection, message)
+
+        with mock.patch.object(Connection, "send", send_failing_once):
+            report = self.dispatcher.deliver(self.messages)
+
+        self.assertEqual(self.delivered, ["Report 0", "Report 1", "Report 2"])
+        self.assertEqual((report["sent"], report["failed"], report["attempts"]), (3, 0, 2))
+
+    @unittest.skipUnless(importlib.util.find_spec("aiosmtpd"), "aiosmtpd is not installed")
+    def test_3_batch_is_delivered_to_local_smtp_server(self):
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.handlers import Sink
+
+        controller = Controller(Sink(), hostname="127.0.0.1", port=8025)
+        controller.start()
+        self.app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=8025, MAIL_SUPPRESS_SEND=False)
+        mail.init_app(self.app)
+        try:
+            report = self.dispatcher.dispatch(self.app, self.messages).result(timeout=10)
+        finally:
+            controller.stop()
+
+        self.assertEqual((report["sent"], report["failed"], report["attempts"]), (3, 0, 1))
+
+    def test_4_refused_message_is_skipped_without_retrying(self):
+        send = Connection.send
+        def refuse_report_1(connection, message):
+            if message.subject == "Report 1":
+                raise smtplib.SMTPRecipientsRefused({message.recipients[0]: (550, b"No such user")})
+            return send(connection, message)
+
+        with mock.patch.object(Connection, "send", refuse_report_1):
+            report = self.dispatcher.deliver(self.messages)
+
+        self.assertEqual(self.delivered, ["Report 0", "Report 2"])
+        self.assertEqual((report["sent"], report["failed"], report["attempts"]), (2, 1, 1))
+
+
+class TestAuditDaemon(AuditTestCase):
+    def test_1_audit_time_finished_by_another_node_is_not_audited_again(self):
+        import console_app
+
+        run = self.service.start_run(self.yesterday, "node-2")
+        self.service.finish_run(run)
+        with mock.patch.object(console_app, "run_audit", return_value={}) as run_audit, \
+             mock.patch.object(console_app, "mail_flagged_customers") as mail_flagged_customers:
+            console_app.run_locked_audits([self.yesterday, self.audit_time])
+
+        run_audit.assert_called_once_with(self.audit_time)
+        self.assertEqual(mail_flagged_customers.call_count, 1)
+
+    def test_2_failed_night_does_not_stop_the_daemon(self):
+        import console_app
+
+        class SteppedScheduler():
+            """Runs two queued audits right away instead of waiting for them"""
+            def __init__(self, *args) -> None:
+                self.queue = []
+            def enterabs(self, when, priority, action, argument):
+                self.queue.append((action, argument))
+            def run(self):
+                for _ in range(2):
+                    action, argument = self.queue.pop(0)
+                    action(*argument)
+
+        scheduler = SteppedScheduler()
+        with mock.patch.object(console_app.sched, "scheduler", return_value=scheduler), \
+             mock.patch.object(console_app, "run_locked_audits",
+                               side_effect=[None, RuntimeError("database gone"), None]) as run_locked_audits, \
+             mock.patch.object(console_app, "run_locked_maintenance",
+                               side_effect=RuntimeError("disk full")) as run_locked_maintenance, \
+             mock.patch.object(self.app.logger, "exception") as log_exception:
+            console_app.run_daemon(time(0, 0))
+
+        self.assertEqual(run_locked_audits.call_count, 3)
+        self.assertEqual(run_locked_maintenance.call_count, 2)
+        self.assertEqual(log_exception.call_count, 3)
+        self.assertEqual(len(scheduler.queue), 1)
+
+
+class TestParallelAudit(AuditTestCase):
+    """Worker processes cannot see an in-memory database, so these tests use a file,
+    a new one per test so concurrent runs do not share it"""
+    def setUp(self) -> None:
+        file_descriptor, self.database_path = tempfile.mkstemp(suffix=".db")
+        os.close(file_descriptor)
+        self.config = type("FileDatabaseConfig", (TestConfig,),
+                           {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.database_path})
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        os.remove(self.database_path)
+
+    def test_1_parallel_audit_matches_sequential_audit(self):
+        import console_app
+
+        self.add_transaction(self.large_yesterday, 15001, self.yesterday)
+        self.add_transaction(self.many_recent, 24000, self.audit_time - timedelta(hours=2))
+        db.session.add(Country(country_code="NO", name="Norway", telephone_country_code="+47"))
+        db.session.commit()
+
+        sequential = console_app.run_audit(self.audit_time, workers=1)
+        parallel = console_app.run_audit(self.audit_time, workers=2)
+
+        self.assertEqual(parallel, sequential)
+        self.assertEqual(set(parallel["Sweden"]), {1, 2})
+
+if __name__ == "__main__":
+    unittest.main()
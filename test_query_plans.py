@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+import re
+import unittest
+
+from sqlalchemy import event
+
+from app import create_app
+from config import TestConfig
+from models import db, Country
+from benchmarks.bench_utils import seed_synthetic_bank
+from repositories.account_repository import AccountRepository
+from repositories.balance_checkpoint_repository import BalanceCheckpointRepository
+from repositories.audit_repository import AuditRepository
+from repositories.country_stats_repository import CountryStatsRepository
+from repositories.customer_repository import CustomerRepository
+from repositories.transaction_flag_repository import TransactionFlagRepository
+from repositories.transaction_repository import TransactionRepository
+from repositories.statement_repository import StatementRepository
+from repositories.transaction_archive_repository import TransactionArchiveRepository
+
+# Tables that grow with the bank, reading all of one is a full table scan
+LARGE_TABLES = {"Customers", "Accounts", "Transactions", "ArchivedTransactions", "CustomerHourlyTransactions",
+                "TransactionFlags", "AuditWindowTransactions", "AuditFindings"}
+
+
+class TestQueryPlans(unittest.TestCase):
+    """Runs every repository query on the hot paths against a seeded database and explains it.
+    Queries that read whole tables on purpose, like the country stats recount and the aggregate
+    backfill, are not included"""
+    def setUp(self) -> None:
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        seed_synthetic_bank(50)
+        BalanceCheckpointRepository().create_checkpoints(datetime.now() - timedelta(days=2), 1, 200)
+
+        self.now = datetime.now()
+        self.country = db.session.get(Country, "SE")
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        return super().tearDown()
+
+    def capture_statements(self, query) -> list[tuple[str, tuple]]:
+        statements = []
+        def listener(connection, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                statements.append((statement, parameters))
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            query()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        return statements
+
+    def full_scans(self, statement: str, parameters) -> list[str]:
+        """Large tables the database plans to read in full for a statement"""
+        connection = db.session.connection()
+        if db.engine.dialect.name == "mysql":
+            plan = connection.exec_driver_sql("EXPLAIN " + statement, parameters).mappings()
+            return [row["table"] for row in plan if row["type"] == "ALL" and row["table"] in LARGE_TABLES]
+
+        plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+        scans = []
+        for row in plan:
+            # Covering index scans still read every row of the index
+            match = re.match(r"SCAN (?:TABLE )?(\w+)", row[-1])
+            if match and match.group(1) in LARGE_TABLES:
+                scans.append(match.group(1))
+        return scans
+
+    def test_1_repository_queries_do_not_scan_large_tables(self):
+        customer_repo = CustomerRepository()
+        transaction_repo = TransactionRepository()
+        audit_repo = AuditRepository()
+        flag_repo = TransactionFlagRepository()
+        customer = customer_repo.get_customer_from_id(1, raise_404=False)
+        week_ago = self.now - timedelta(days=7)
+        years_ago = self.now - timedelta(days=3 * 365)
+
+        queries = {
+            "customer from id": lambda: customer_repo.get_customer_from_id(1, raise_404=False),
+            "customer with accounts": lambda: customer_repo.get_customer_joined_accounts_country_or_404(1),
+            "customers from ids": lambda: customer_repo.get_customers_from_ids([1, 2, 3]),
+            "customer from national id": lambda: customer_repo.get_customer_from_national_id(customer.national_id),
+            "customers for country": lambda: customer_repo.get_all_customers_for_country(self.country),
+            "customer search": lambda: customer_repo.get_paginated_sorted_search_results(
+                {"last_name": "last5", "city": "city5"}, "first_name", "desc", 1, 50),
+            "customer search by first name": lambda: customer_repo.get_paginated_sorted_search_results(
+                {"first_name": "first5"}, "id", "asc", 1, 50),
+            "top customers": lambda: customer_repo.get_top_customers_for_country("SE", 20),
+            "customer totals in country": lambda: customer_repo.get_customer_totals_in_country([1, 2, 3], "SE"),
+            "account from id": lambda: AccountRepository().get_account_from_id(1),
+            "offset transactions": lambda: transaction_repo.get_limited_offset_transactions(1, 20, 0),
+            "count transactions": lambda: transaction_repo.get_count_of_transactions(1),
+            "cursor transactions": lambda: transaction_repo.get_transactions_before_cursor(1, 21, (self.now, 10)),
+            "customer sum": lambda: transaction_repo.get_sum_transactions_of_customer(customer, week_ago),
+            "summed transactions": lambda: transaction_repo.get_summed_transactions(customer, week_ago),
+            "transactions on date": lambda: transaction_repo.get_transactions_for_customer_on_date(customer,
+                                                                                                 self.now.date()),
+            "account export": lambda: list(transaction_repo.iter_transaction_partitions(account_id=1)),
+            "customer export": lambda: list(transaction_repo.iter_transaction_partitions(
+                customer_id=1, from_date=week_ago, to_date=self.now)),
+            "audit large transactions": lambda: audit_repo.get_transactions_exceeding_amount(
+                "SE", week_ago, self.now, 15000),
+            "audit recent sums": lambda: audit_repo.get_transactions_of_customers_exceeding_sum(
+                "SE", week_ago + timedelta(minutes=30), self.now, 23000),
+            "audit columns": lambda: audit_repo.get_transaction_columns("SE", week_ago, self.now),
+            "audit count": lambda: audit_repo.count_transactions(week_ago, self.now),
+            "audit new transactions": lambda: audit_repo.get_new_transactions(10, 20, week_ago),
+            "audit window large transactions": lambda: audit_repo.get_window_transactions_exceeding_amount(
+                "SE", week_ago, self.now, 15000),
+            "audit window recent sums": lambda: audit_repo.get_window_transactions_of_customers_exceeding_sum(
+                "SE", week_ago, self.now, 23000),
+            "audit findings of run": lambda: audit_repo.get_paginated_findings({"run_id": 1}, 1, 50),
+            "recent transactions of customer": lambda: flag_repo.get_recent_transactions_of_customer(1, week_ago),
+            "flags for country": lambda: flag_repo.get_flags_for_country("SE", week_ago, self.now),
+            "country stats": lambda: CountryStatsRepository().get_country_stats(),
+            "customer countries": lambda: CountryStatsRepository().get_customer_countries([1, 2, 3]),
+            "customer totals": lambda: CountryStatsRepository().get_customer_totals(1),
+            "balances as of": lambda: BalanceCheckpointRepository().get_balances_as_of([1, 2, 3], self.now),
+            "statement accounts": lambda: StatementRepository().get_accounts(1, 1000, self.now.date()),
+            "statement transactions": lambda: list(StatementRepository().iter_transactions(1, 1000, week_ago,
+                                                                                           self.now)),
+            "archived balances as of": lambda: BalanceCheckpointRepository().get_balances_as_of([1, 2, 3],
+                                                                                                 years_ago),
+            "archived statement transactions": lambda: list(StatementRepository().iter_transactions(
+                1, 1000, years_ago, years_ago + timedelta(days=30))),
+            "first transaction time": lambda: BalanceCheckpointRepository().get_first_transaction_time(),
+            "archive batch": lambda: TransactionArchiveRepository().archive_batch(years_ago, 100),
+        }
+
+        for name, query in queries.items():
+            for statement, parameters in self.capture_statements(query):
+                with self.subTest(query=name, statement=statement):
+                    self.assertEqual(self.full_scans(statement, parameters), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
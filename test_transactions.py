@@ -1,11 +1,34 @@
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+import json
+import os
+import tempfile
+from threading import Thread
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from app import create_app
+from config import TestConfig
+from flask_security.utils import hash_password
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql
+from werkzeug.exceptions import NotFound
+from models import (db, user_datastore, Country, Customer, Account, Transaction, ArchivedTransaction,
+                    TransactionFlag, CustomerHourlyTransactions, IdempotencyKey, AccountBalanceCheckpoint)
+from seed import seed_roles
 from constants.constants import TransactionTypes 
+from constants.errors_messages import ErrorMessages
 from services.transaction_services import TransactionService, TransactionRepository
 from services.account_services import AccountService, AccountRepository
+from services.balance_services import BalanceService, BalanceCheckpointRepository
+from services.statement_services import StatementService, StatementRepository
+from services.archive_services import TransactionArchiveService, TransactionArchiveRepository
+from services.country_services import CountryService, CountryRepository
+from services.customer_services import CustomerService, CustomerRepository
+from services.top_customers_services import TopCustomersService
+from services.user_services import UserService, UserRepository
+from repositories.query_cache import query_cache, LocalCacheBackend
 
 
 class TestTransactions(unittest.TestCase):
@@ -50,6 +73,902 @@ class TestTransactions(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.service.process_transfer(self.mock_account, mock_account_2, AMOUNT)
 
+
+class TransactionsDatabaseTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        """ Set up a test database with two accounts, the first holding 1000"""
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Country(country_code="SE", name="Sweden", telephone_country_code="+46"))
+        db.session.add(Customer(
+            id=1, first_name="Test", last_name="Customer", address="Street 1", city="Stockholm",
+            postal_code="12345", birthday=date(1980, 1, 1), national_id="198001011234",
+            telephone="0701234567", email="test@example.com", country="SE"))
+        for account_id, balance in ((1, 1000), (2, 0)):
+            db.session.add(Account(id=account_id, account_type="Checking", created=date(2000, 1, 1),
+                                   balance=Decimal(balance), customer_id=1))
+        db.session.commit()
+
+        self.service = TransactionService(TransactionRepository(), AccountService(AccountRepository()))
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        return super().tearDown()
+
+    def balances(self) -> tuple[Decimal, Decimal]:
+        db.session.expire_all()
+        return db.session.get(Account, 1).balance, db.session.get(Account, 2).balance
+
+
+class TestAtomicTransfers(TransactionsDatabaseTestCase):
+    def test_1_transfer_writes_both_legs_in_one_commit(self):
+        with patch.object(db.session, "commit", wraps=db.session.commit) as commit:
+            withdraw, deposit = self.service.process_transfer(db.session.get(Account, 1),
+                                                              db.session.get(Account, 2),
+                                                              Decimal(300))
+
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual((withdraw.new_balance, deposit.new_balance), (700, 300))
+        self.assertEqual(self.balances(), (700, 300))
+
+    def test_2_balance_is_checked_again_after_locking(self):
+        stale_account = db.session.get(Account, 1)
+        db.session.expunge(stale_account)
+        db.session.commit()
+        # Another withdrawal commits while this session still holds the old balance
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Account).where(Account.id==1).values(balance=Decimal(50)))
+
+        with self.assertRaises(ValueError):
+            self.service.process_transfer(stale_account, db.session.get(Account, 2), Decimal(100))
+
+        self.assertEqual(self.balances(), (50, 0))
+        self.assertEqual(Transaction.query.count(), 0)
+
+    @unittest.skipIf(TestConfig.SQLALCHEMY_DATABASE_URI.startswith("sqlite"),
+                     "sqlite ignores FOR UPDATE, set TEST_DATABASE_URI to a MySQL test database")
+    def test_3_concurrent_transfers_in_both_directions_never_overdraw(self):
+        THREADS = 16
+        TRANSFERS_PER_THREAD = 10
+        errors = []
+
+        def transfer_repeatedly(from_account_id: int, to_account_id: int):
+            with self.app.app_context():
+                for _ in range(TRANSFERS_PER_THREAD):
+                    try:
+                        self.service.process_transfer(db.session.get(Account, from_account_id),
+                                                      db.session.get(Account, to_account_id),
+                                                      Decimal(100))
+                    except ValueError:
+                        pass
+                    except Exception as error:
+                        errors.append(error)
+                    db.session.expire_all()
+                db.session.remove()
+
+        threads = [Thread(target=transfer_repeatedly, args=((1, 2) if number % 2 else (2, 1)))
+                   for number in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        first_balance, second_balance = self.balances()
+        self.assertEqual(errors, [])
+        self.assertEqual(first_balance + second_balance, 1000)
+        self.assertGreaterEqual(min(first_balance, second_balance), 0)
+        for account_id, balance in ((1, first_balance), (2, second_balance)):
+            last_transaction = (Transaction.query.filter_by(account_id=account_id)
+                                .order_by(Transaction.id.desc()).first())
+            if last_transaction:
+                self.assertEqual(last_transaction.new_balance, balance)
+
+    def test_4_accounts_are_locked_for_update_in_id_order(self):
+        for account_id in (3, 4, 5):
+            db.session.add(Account(id=account_id, account_type="Checking", created=date(2000, 1, 1),
+                                   balance=Decimal(0), customer_id=1))
+        db.session.commit()
+        # Compiled for MySQL, as sqlite leaves FOR UPDATE out
+        statements = []
+        def record(state):
+            statements.append(state.statement.compile(dialect=mysql.dialect()))
+
+        event.listen(db.session, "do_orm_execute", record)
+        try:
+            with patch("repositories.transaction_repository.LOCK_ACCOUNTS_CHUNK_SIZE", 2):
+                accounts = TransactionRepository().lock_accounts([5, 1, 4, 2, 3, 1])
+        finally:
+            event.remove(db.session, "do_orm_execute", record)
+
+        self.assertEqual(list(accounts), [1, 2, 3, 4, 5])
+        self.assertEqual([list(statement.params.values()) for statement in statements],
+                         [[[1, 2]], [[3, 4]], [[5]]])
+        for statement in statements:
+            self.assertRegex(str(statement), r"ORDER BY `Accounts`.id\s+FOR UPDATE")
+
+
+class TestTransactionBatch(TransactionsDatabaseTestCase):
+    def test_1_items_are_applied_in_order_and_invalid_items_rejected(self):
+        results = self.service.process_batch([
+            {"type": "withdraw", "account_id": 1, "amount": "600"},
+            {"type": "transfer", "account_id": 1, "to_account_id": 2, "amount": 500},
+            {"type": "transfer", "account_id": 1, "to_account_id": 2, "amount": "399.50"},
+            {"type": "deposit", "account_id": 3, "amount": "1"},
+            {"type": "refund", "account_id": 1, "amount": "1"},
+            {"type": "deposit", "account_id": 2, "amount": "-1"},
+            {"type": "deposit", "account_id": 2, "amount": "ten"},
+            {"type": "deposit", "account_id": 2, "amount": "0.004"},
+            {"type": "deposit", "account_id": 2, "amount": "1e30"}
+        ])
+
+        self.assertEqual([result["status"] for result in results],
+                         ["accepted", "rejected", "accepted"] + ["rejected"] * 6)
+        self.assertEqual([result.get("error") for result in results[3:]],
+                         [ErrorMessages.UNKNOWN_ACCOUNT.value,
+                          ErrorMessages.UNKNOWN_TRANSACTION_TYPE.value,
+                          ErrorMessages.NEGATIVE_AMOUNT.value,
+                          ErrorMessages.INVALID_AMOUNT.value,
+                          ErrorMessages.TOO_MANY_DECIMALS.value,
+                          ErrorMessages.INVALID_AMOUNT.value])
+        self.assertEqual(results[1]["error"], ErrorMessages.INSUFFICIENT_FUNDS.value)
+        self.assertEqual(self.balances(), (Decimal("0.50"), Decimal("399.50")))
+
+    def test_2_batch_endpoint_inserts_rows_and_aggregates(self):
+        seed_roles(db, user_datastore)
+        user_datastore.create_user(email="cashier@bank.se", password=hash_password("Hejsan123#"),
+                                   roles=["cashier"])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post("/login", data={"email": "cashier@bank.se", "password": "Hejsan123#"})
+
+        response = client.post("/api/transactions/batch", json={"transactions": [
+            {"type": "deposit", "account_id": 2, "amount": "25.25"} for _ in range(1000)]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json["accepted"], response.json["rejected"]), (1000, 0))
+        self.assertEqual(self.balances(), (1000, Decimal("25250.00")))
+        self.assertEqual(Transaction.query.count(), 1000)
+        self.assertEqual(sum(row.transaction_count for row in CustomerHourlyTransactions.query), 1000)
+        self.assertEqual(client.post("/api/transactions/batch", json={"transactions": "x"}).status_code,
+                         400)
+
+
+class TestGroupCommit(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.repository = self.service.transaction_repository
+        self.repository.enable_group_commit(self.app, max_batch_size=100, max_wait=0.2)
+        self.addCleanup(self.repository.disable_group_commit)
+
+    def test_1_concurrent_intents_are_written_in_one_commit_without_overdrawing(self):
+        with patch.object(db.session, "commit", wraps=db.session.commit) as commit:
+            futures = []
+            for _ in range(30):
+                futures.append(self.repository.group_commit_writer.submit(1, Decimal(100),
+                                                                          TransactionTypes.WITHDRAW))
+                futures.append(self.repository.group_commit_writer.submit(2, Decimal(1),
+                                                                          TransactionTypes.DEPOSIT))
+            errors = [future.exception(timeout=5) for future in futures]
+
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual([str(error) for error in errors if error],
+                         [ErrorMessages.INSUFFICIENT_FUNDS.value] * 20)
+        self.assertEqual(self.balances(), (0, 30))
+        withdrawals = [future.result()[0].new_balance for future in futures[0:20:2]]
+        self.assertEqual(withdrawals, [Decimal(900 - 100 * number) for number in range(10)])
+        self.assertEqual(sum(row.transaction_count for row in CustomerHourlyTransactions.query), 40)
+
+    def test_2_service_waits_for_the_commit(self):
+        account = db.session.get(Account, 1)
+
+        transaction = self.service.process_transaction(account, Decimal(250), TransactionTypes.WITHDRAW)
+
+        self.assertIsNotNone(transaction.id)
+        self.assertEqual(transaction.new_balance, 750)
+        self.assertEqual(account.balance, 750)
+        # Passes the check against the stale balance, the writer checks again under its lock
+        stale_account = Mock(id=1, balance=Decimal(1000), customer_id=1)
+        with self.assertRaises(ValueError):
+            self.service.process_transaction(stale_account, Decimal(751), TransactionTypes.WITHDRAW)
+        self.assertEqual(self.balances(), (750, 0))
+
+    def test_3_intents_repeating_a_key_get_the_first_transaction_unless_their_request_differs(self):
+        writer = self.repository.group_commit_writer
+        self.service.initiate_transaction_process(2, Decimal(5), "deposit", idempotency_key="stored")
+
+        futures = [writer.submit(1, Decimal(100), TransactionTypes.WITHDRAW, key)
+                   for key in ("new", "new", "stored", None)]
+        futures += [writer.submit(2, Decimal(5), TransactionTypes.DEPOSIT, "stored"),
+                    writer.submit(1, Decimal(1), TransactionTypes.WITHDRAW, "new")]
+        errors = [future.exception(timeout=5) for future in futures]
+        results = [None if error else future.result() for future, error in zip(futures, errors)]
+
+        self.assertEqual([str(error) for error in errors if error],
+                         [ErrorMessages.IDEMPOTENCY_KEY_REUSED.value] * 2)
+        self.assertEqual([written for _, written in filter(None, results)], [True, False, True, False])
+        self.assertEqual(results[0][0].id, results[1][0].id)
+        self.assertEqual(results[4][0].account_id, 2)
+        self.assertEqual(self.balances(), (800, 5))
+
+    def test_4_retry_resolved_by_the_writer_is_not_counted_again(self):
+        fraud_monitor, top_customers_service = Mock(), Mock()
+        service = TransactionService(self.repository, AccountService(AccountRepository()),
+                                     fraud_monitor, top_customers_service=top_customers_service)
+        account = db.session.get(Account, 2)
+
+        first = service.process_transaction(account, Decimal(10), TransactionTypes.DEPOSIT, "once")
+        retried = service.process_transaction(account, Decimal(10), TransactionTypes.DEPOSIT, "once")
+
+        self.assertEqual(first.id, retried.id)
+        self.assertEqual(fraud_monitor.check_transaction.call_count, 1)
+        self.assertEqual(top_customers_service.balances_changed.call_count, 1)
+        self.assertEqual(self.balances(), (1000, 10))
+
+    def test_5_stalled_writer_times_out_the_request(self):
+        writer = self.repository.group_commit_writer
+        writer.timeout = 0.05
+        with patch.object(writer, "_write", side_effect=lambda batch: time.sleep(0.5)):
+            with self.assertRaises(ValueError) as raised:
+                self.service.process_transaction(db.session.get(Account, 2), Decimal(10),
+                                                 TransactionTypes.DEPOSIT)
+
+        self.assertEqual(str(raised.exception), ErrorMessages.GROUP_COMMIT_TIMEOUT.value)
+
+
+class TestIdempotencyKeys(TransactionsDatabaseTestCase):
+    def test_1_retry_returns_stored_transactions_without_touching_accounts(self):
+        first = self.service.initiate_transaction_process(1, Decimal(300), "transfer", 2, "retry-1")
+        # A new service has an empty cache, so the key is read from the database
+        service = TransactionService(TransactionRepository(), AccountService(AccountRepository()))
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        retried = service.initiate_transaction_process(1, Decimal(300), "transfer", 2, "retry-1")
+        cached = service.initiate_transaction_process(1, Decimal(300), "transfer", 2, "retry-1")
+        event.remove(db.engine, "before_cursor_execute", listener)
+
+        self.assertEqual([transaction.id for transaction in retried], [transaction.id for transaction in first])
+        self.assertEqual([transaction.id for transaction in cached], [transaction.id for transaction in first])
+        self.assertFalse(any('"Accounts"' in statement for statement in statements))
+        self.assertFalse(any('"IdempotencyKeys"' in statement for statement in statements[2:]))
+        self.assertEqual(self.balances(), (700, 300))
+        self.assertEqual(Transaction.query.count(), 2)
+
+    def test_2_concurrent_duplicate_loses_on_the_unique_key(self):
+        self.service.initiate_transaction_process(1, Decimal(100), "withdraw", idempotency_key="race")
+        service = TransactionService(TransactionRepository(), AccountService(AccountRepository()))
+        lookup = service.idempotency_service.get_transactions
+        # The duplicate looks the key up before the first submission has committed
+        lookups = iter([None])
+        with patch.object(service.idempotency_service, "get_transactions",
+                          side_effect=lambda *args: next(lookups, None) or lookup(*args)):
+            transactions = service.initiate_transaction_process(1, Decimal(100), "withdraw",
+                                                                idempotency_key="race")
+
+        self.assertEqual(transactions[0].new_balance, 900)
+        self.assertEqual(self.balances(), (900, 0))
+        self.assertEqual(Transaction.query.count(), 1)
+
+    def test_3_api_retry_and_purge(self):
+        seed_roles(db, user_datastore)
+        user_datastore.create_user(email="cashier@bank.se", password=hash_password("Hejsan123#"),
+                                   roles=["cashier"])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post("/login", data={"email": "cashier@bank.se", "password": "Hejsan123#"})
+
+        responses = [client.post("/api/transactions", headers={"Idempotency-Key": "api-1"},
+                                 json={"type": "deposit", "account_id": 2, "amount": "10"})
+                     for _ in range(2)]
+        self.assertEqual(responses[0].json, responses[1].json)
+        self.assertEqual(self.balances(), (1000, 10))
+        self.assertEqual(client.post("/api/transactions", headers={"Idempotency-Key": "x" * 65},
+                                     json={"type": "deposit", "account_id": 2, "amount": "10"}
+                                     ).status_code, 400)
+        reused = client.post("/api/transactions", headers={"Idempotency-Key": "api-1"},
+                             json={"type": "deposit", "account_id": 2, "amount": "11"})
+        self.assertEqual((reused.status_code, reused.json["error"]),
+                         (422, ErrorMessages.IDEMPOTENCY_KEY_REUSED.value))
+        self.assertEqual(self.balances(), (1000, 10))
+
+        db.session.add(IdempotencyKey(key="old", created=datetime.now() - timedelta(days=2),
+                                      transaction_ids="1"))
+        db.session.commit()
+        self.assertEqual(self.service.idempotency_service.purge_expired_keys(), 1)
+        self.assertEqual([key.key for key in IdempotencyKey.query], ["api-1"])
+
+
+class TestBalanceCheckpoints(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        """Adds an account with a deposit or withdrawal every ten days through 2024"""
+        super().setUp()
+        db.session.add(Account(id=3, account_type="Savings", created=date(2023, 12, 31),
+                               balance=Decimal(0), customer_id=1))
+        balance = Decimal(0)
+        timestamp = datetime(2024, 1, 1, 9)
+        for number in range(36):
+            transaction_type = TransactionTypes.WITHDRAW if number % 3 == 2 else TransactionTypes.DEPOSIT
+            amount = Decimal(number * 10 + 5)
+            balance += -amount if transaction_type == TransactionTypes.WITHDRAW else amount
+            db.session.add(Transaction(type=transaction_type.value, timestamp=timestamp, amount=amount,
+                                       new_balance=balance, account_id=3))
+            timestamp += timedelta(days=10)
+        db.session.commit()
+        self.balance_service = BalanceService(BalanceCheckpointRepository())
+
+    def balance_from_history(self, on_date: date) -> Decimal:
+        last_transaction = (Transaction.query
+                            .filter(Transaction.account_id==3,
+                                    Transaction.timestamp < datetime.combine(on_date + timedelta(days=1),
+                                                                             datetime.min.time()))
+                            .order_by(Transaction.timestamp.desc()).first())
+        return last_transaction.new_balance if last_transaction else Decimal(0)
+
+    def test_1_backfill_creates_monthly_checkpoints_once(self):
+        created = self.balance_service.create_missing_checkpoints(now=datetime(2025, 1, 15),
+                                                                  chunk_size=2)
+
+        # Every account gets a checkpoint at each month start from February 2024 to January 2025
+        self.assertEqual(created, 3 * 12)
+        self.assertEqual(self.balance_service.create_missing_checkpoints(now=datetime(2025, 1, 15)), 0)
+        checkpoints = (AccountBalanceCheckpoint.query.filter_by(account_id=3)
+                       .order_by(AccountBalanceCheckpoint.as_of).all())
+        self.assertEqual([checkpoint.as_of for checkpoint in checkpoints],
+                         [datetime(2024 + month // 12, month % 12 + 1, 1) for month in range(1, 13)])
+        for checkpoint in checkpoints:
+            self.assertEqual(checkpoint.balance,
+                             self.balance_from_history(checkpoint.as_of.date() - timedelta(days=1)))
+
+    def test_2_balances_on_dates_match_the_transaction_history(self):
+        self.balance_service.create_missing_checkpoints(now=datetime(2024, 7, 1))
+
+        for on_date in [date(2023, 12, 31), date(2024, 1, 1), date(2024, 3, 31), date(2024, 6, 30),
+                        date(2024, 7, 1), date(2024, 11, 20), date(2025, 3, 1)]:
+            with self.subTest(on_date=on_date):
+                self.assertEqual(self.balance_service.get_balance_on_date(3, on_date),
+                                 self.balance_from_history(on_date))
+        self.assertEqual(self.balance_service.get_balances_on_date([2, 3, 99], date(2024, 2, 29)),
+                         {2: 0, 3: self.balance_from_history(date(2024, 2, 29))})
+
+        # Only transactions after the latest checkpoint are summed
+        AccountBalanceCheckpoint.query.filter_by(account_id=3, as_of=datetime(2024, 6, 1)).update(
+            {"balance": AccountBalanceCheckpoint.balance + 1000})
+        db.session.commit()
+        self.assertEqual(self.balance_service.get_balance_on_date(3, date(2024, 6, 15)),
+                         self.balance_from_history(date(2024, 6, 15)) + 1000)
+
+    def test_3_balances_api(self):
+        seed_roles(db, user_datastore)
+        user_datastore.create_user(email="cashier@bank.se", password=hash_password("Hejsan123#"),
+                                   roles=["cashier"])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post("/login", data={"email": "cashier@bank.se", "password": "Hejsan123#"})
+
+        response = client.get("/api/balances?date=2024-05-31&account_id=3&account_id=2")
+
+        self.assertEqual(response.json["balances"],
+                         [{"account_id": 2, "balance": "0.00"},
+                          {"account_id": 3, "balance": str(self.balance_from_history(date(2024, 5, 31)))}])
+        self.assertEqual(client.get("/api/balances?date=31/05&account_id=3").status_code, 400)
+
+
+class TestStatements(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        """Adds a deposit to accounts 1 and 2 on each of the first days of April to June 2024,
+        and a withdrawal from account 1 on the 15th, an account opened in May without
+        transactions and one opened in June"""
+        super().setUp()
+        db.session.add(Account(id=3, account_type="Savings", created=date(2024, 6, 10),
+                               balance=Decimal(0), customer_id=1))
+        db.session.add(Account(id=4, account_type="Savings", created=date(2024, 5, 20),
+                               balance=Decimal(0), customer_id=1))
+        balances = {1: Decimal(0), 2: Decimal(0)}
+        for month in (4, 5, 6):
+            for account_id in (1, 2):
+                for day in (1, 2, 3):
+                    balances[account_id] += 100 * account_id
+                    db.session.add(Transaction(type=TransactionTypes.DEPOSIT.value,
+                                               timestamp=datetime(2024, month, day, 10),
+                                               amount=Decimal(100 * account_id),
+                                               new_balance=balances[account_id], account_id=account_id))
+            balances[1] -= 50
+            db.session.add(Transaction(type=TransactionTypes.WITHDRAW.value,
+                                       timestamp=datetime(2024, month, 15, 10), amount=Decimal(50),
+                                       new_balance=balances[1], account_id=1))
+        db.session.commit()
+        self.statement_service = StatementService(StatementRepository(), BalanceCheckpointRepository())
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        return super().tearDown()
+
+    def read_statements(self) -> list[dict]:
+        statements = []
+        for root, _, filenames in os.walk(self.directory.name):
+            for filename in sorted(filenames):
+                with open(os.path.join(root, filename), encoding="utf-8") as file:
+                    statements += [json.loads(line) for line in file]
+        return statements
+
+    def test_1_statements_hold_balances_totals_and_lines_of_the_month(self):
+        with_checkpoints = []
+        for create_checkpoints in (False, True):
+            if create_checkpoints:
+                BalanceService(BalanceCheckpointRepository()).create_missing_checkpoints(datetime(2024, 7, 1))
+            with_checkpoints.append(list(self.statement_service.iter_statements(datetime(2024, 5, 1), 1, 4)))
+
+        statements = with_checkpoints[0]
+        self.assertEqual(with_checkpoints[1], statements)
+        # The account opened in June has no May statement
+        self.assertEqual([statement["account_id"] for statement in statements], [1, 2, 4])
+        first, second, opened_in_may = statements
+        self.assertEqual((first["period_start"], first["period_end"]), ("2024-05-01", "2024-05-31"))
+        self.assertEqual((first["opening_balance"], first["total_deposits"], first["total_withdrawals"],
+                          first["closing_balance"]), ("250.00", "300.00", "50.00", "500.00"))
+        self.assertEqual([line["timestamp"] for line in first["transactions"]],
+                         ["2024-05-01T10:00:00", "2024-05-02T10:00:00", "2024-05-03T10:00:00",
+                          "2024-05-15T10:00:00"])
+        self.assertEqual(first["transactions"][-1]["new_balance"], first["closing_balance"])
+        self.assertEqual((second["opening_balance"], second["closing_balance"]), ("600.00", "1200.00"))
+        self.assertEqual((Decimal(opened_in_may["closing_balance"]), opened_in_may["transactions"]),
+                         (0, []))
+
+    def test_2_job_is_resumed_per_partition(self):
+        import console_app
+
+        report = console_app.run_statements(datetime(2024, 6, 1), self.directory.name, partition_size=2)
+        self.assertEqual((report["partitions"], report["skipped"], report["statements"]), (2, 0, 4))
+        statements = self.read_statements()
+        self.assertEqual([statement["account_id"] for statement in statements], [1, 2, 3, 4])
+
+        # A run stopped before writing the second partition leaves no file for it
+        os.remove(self.statement_service.get_partition_path(self.directory.name, datetime(2024, 6, 1), 3, 4))
+        report = console_app.run_statements(datetime(2024, 6, 1), self.directory.name, partition_size=2)
+        self.assertEqual((report["partitions"], report["skipped"], report["statements"]), (2, 1, 2))
+        self.assertEqual(self.read_statements(), statements)
+
+        with self.assertRaises(ValueError):
+            console_app.run_statements(datetime.now(), self.directory.name)
+
+
+class TestTransactionArchive(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        """Adds a deposit to account 1 every ten days for the last four years"""
+        super().setUp()
+        self.now = datetime.now().replace(microsecond=0)
+        balance = Decimal(0)
+        for day in range(4 * 365, 0, -10):
+            balance += 10
+            db.session.add(Transaction(type=TransactionTypes.DEPOSIT.value, timestamp=self.now - timedelta(days=day),
+                                       amount=Decimal(10), new_balance=balance, account_id=1))
+        db.session.commit()
+        self.repository = TransactionRepository()
+        self.balance_service = BalanceService(BalanceCheckpointRepository())
+        self.archive_service = TransactionArchiveService(TransactionArchiveRepository(),
+                                                         BalanceCheckpointRepository())
+
+    def reads(self) -> dict:
+        """Reads every transaction, balance and statement of account 1 in all the ways the repositories can"""
+        db.session.expunge_all()
+        cursor_pages, cursor = [], None
+        while True:
+            page = self.repository.get_transactions_before_cursor(1, 25, cursor)
+            cursor_pages.append([transaction.id for transaction in page])
+            if len(page) < 25:
+                break
+            cursor = (page[-1].timestamp, page[-1].id)
+        statement_month = self.now - timedelta(days=3 * 365)
+        return {
+            "offset pages": [[transaction.id for transaction in
+                              self.repository.get_limited_offset_transactions(1, 25, offset)]
+                             for offset in range(0, 175, 25)],
+            "cursor pages": cursor_pages,
+            "count": self.repository.get_count_of_transactions(1),
+            "export": [row for partition in self.repository.iter_transaction_partitions(customer_id=1)
+                       for row in partition],
+            "balances": [self.balance_service.get_balance_on_date(1, (self.now - timedelta(days=days)).date())
+                         for days in range(4 * 365 + 30, 0, -45)],
+            "statement": list(StatementService(StatementRepository(), BalanceCheckpointRepository())
+                              .iter_statements(statement_month, 1, 2)),
+            "first transaction": BalanceCheckpointRepository().get_first_transaction_time(),
+        }
+
+    def test_1_archived_transactions_are_read_transparently(self):
+        # Nothing is archived before the balance checkpoints that recent balances start from exist
+        self.assertEqual(self.archive_service.archive_cold_transactions(self.now), 0)
+        self.balance_service.create_missing_checkpoints(self.now)
+        before = self.reads()
+
+        archived = self.archive_service.archive_cold_transactions(self.now, batch_size=7)
+
+        cutoff = self.archive_service.get_archive_cutoff(self.now)
+        self.assertLessEqual(cutoff, self.now - timedelta(days=2 * 365))
+        self.assertEqual(archived, ArchivedTransaction.query.count())
+        self.assertEqual(archived, len([day for day in range(4 * 365, 0, -10)
+                                        if self.now - timedelta(days=day) < cutoff]))
+        self.assertEqual(Transaction.query.filter(Transaction.timestamp < cutoff).count(), 0)
+        self.assertEqual(self.archive_service.archive_cold_transactions(self.now), 0)
+        after = self.reads()
+        for name in before:
+            with self.subTest(read=name):
+                self.assertEqual(after[name], before[name])
+
+    def test_2_recent_reads_skip_the_archive_and_flagged_transactions_stay(self):
+        self.balance_service.create_missing_checkpoints(self.now)
+        flagged = Transaction.query.order_by(Transaction.timestamp).first()
+        db.session.add(TransactionFlag(transaction_id=flagged.id, account_id=1, customer_id=1, country="SE",
+                                       rule="single_transaction", flagged=flagged.timestamp))
+        db.session.commit()
+        self.archive_service.archive_cold_transactions(self.now)
+        self.assertIsNotNone(db.session.get(Transaction, flagged.id))
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            self.repository.get_transactions_before_cursor(1, 25)
+            self.repository.get_limited_offset_transactions(1, 25, 0)
+            self.repository.get_summed_transactions(db.session.get(Customer, 1), self.now - timedelta(days=3))
+            list(self.repository.iter_transaction_partitions(account_id=1, from_date=self.now - timedelta(days=30)))
+            self.balance_service.get_balance_on_date(1, self.now.date())
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertFalse([statement for statement in statements if "ArchivedTransactions" in statement])
+
+
+class TestCountryStats(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        """Builds the stats of the fixture accounts, which were added directly"""
+        super().setUp()
+        db.session.add(Country(country_code="NO", name="Norway", telephone_country_code="+47"))
+        db.session.commit()
+        self.country_service = CountryService(CountryRepository())
+        self.country_service.country_stats_repository.rebuild()
+        self.customer_service = CustomerService(CustomerRepository(), AccountService(AccountRepository()))
+
+    def stats(self) -> dict:
+        return {row.name: (row.number_of_customers, row.number_of_accounts, row.sum_of_accounts)
+                for row in self.country_service.get_country_stats()}
+
+    def test_1_writes_keep_the_stats_current(self):
+        self.assertEqual(self.stats(), {"Sweden": (1, 2, Decimal(1000))})
+
+        customer = self.customer_service.create_customer_and_new_account({
+            "first_name": "Ny", "last_name": "Kund", "address": "Gate 1", "city": "Oslo",
+            "postal_code": "0150", "birthday": date(1990, 1, 1), "national_id": "01019012345",
+            "telephone": "40000000", "email": "ny@example.com", "country": "NO"})
+        new_account = customer.accounts[0]
+        self.service.process_transaction(new_account, Decimal(300), TransactionTypes.DEPOSIT)
+        self.service.process_transfer(db.session.get(Account, 1), new_account, Decimal("99.50"))
+        self.service.process_batch([{"type": "withdraw", "account_id": 1, "amount": "0.50"},
+                                    {"type": "deposit", "account_id": new_account.id, "amount": "1"}])
+        self.assertEqual(self.stats(), {"Sweden": (1, 2, Decimal(900)), "Norway": (1, 1, Decimal("400.50"))})
+
+        self.customer_service.customer_edited(customer, {"country": "SE"})
+        self.assertEqual(self.stats(), {"Sweden": (2, 3, Decimal("1300.50"))})
+        self.assertEqual(self.country_service.calculate_global_stats(self.country_service.get_country_stats()),
+                         {"number_of_customers": 2, "number_of_accounts": 3, "sum_of_accounts": Decimal("1300.50")})
+        self.assertEqual(self.country_service.reconcile_country_stats(), {})
+
+    def test_2_reconcile_reports_drift_and_rebuilds(self):
+        db.session.get(Account, 2).balance = Decimal(5)
+        db.session.commit()
+
+        self.assertEqual(self.country_service.reconcile_country_stats(),
+                         {"SE": {"stored": (1, 2, Decimal(1000)), "counted": (1, 2, Decimal(1005))}})
+        self.assertEqual(self.stats(), {"Sweden": (1, 2, Decimal(1005))})
+        self.assertEqual(self.country_service.reconcile_country_stats(), {})
+
+
+class TestCountryRegistry(TransactionsDatabaseTestCase):
+    def test_1_countries_are_read_once_and_again_after_they_change(self):
+        repository = CountryRepository()
+        service = CountryService(repository)
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            for _ in range(3):
+                sweden = service.get_country_or_404("sWEDEN")
+                choices = service.get_form_country_choices()
+                by_code = repository.get_country_from_code("SE")
+            with self.assertRaises(NotFound):
+                service.get_country_or_404("Atlantis")
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual((sweden.country_code, sweden.name, sweden.telephone_country_code), ("SE", "Sweden", "+46"))
+        self.assertIs(by_code, sweden)
+        self.assertEqual(choices, [("SE", "Sweden")])
+
+        # Rolled back changes keep the loaded countries, committed ones reload them
+        db.session.add(Country(country_code="DK", name="Denmark", telephone_country_code="+45"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertIs(repository.get_country_from_code("SE"), sweden)
+        db.session.add(Country(country_code="NO", name="Norway", telephone_country_code="+47"))
+        db.session.commit()
+        self.assertEqual(sorted(service.get_form_country_choices()), [("NO", "Norway"), ("SE", "Sweden")])
+        self.assertIsNone(repository.get_country_from_code("DK"))
+
+
+class TestCustomerSearch(TransactionsDatabaseTestCase):
+    def search(self, **query_criteria) -> list[int]:
+        return [customer.id for customer in CustomerRepository().get_paginated_sorted_search_results(
+            query_criteria, "id", "asc", 1, 50)]
+
+    def test_1_search_columns_follow_creates_and_edits(self):
+        customer_service = CustomerService(CustomerRepository(), AccountService(AccountRepository()))
+        customer = customer_service.create_customer_and_new_account({
+            "first_name": "Åsa", "last_name": "ÖBERG", "address": "Gatan 1", "city": "Malmö",
+            "postal_code": "21120", "birthday": date(1990, 1, 1), "national_id": "199001011234",
+            "telephone": "0707654321", "email": "asa@example.com", "country": "SE"})
+        self.assertEqual((customer.first_name_search, customer.last_name_search, customer.city_search),
+                         ("åsa", "öberg", "malmö"))
+        self.assertEqual(self.search(first_name="åsa", city="malmö"), [customer.id])
+        self.assertEqual(self.search(city="stockholm"), [1])
+
+        customer_service.customer_edited(customer, {"last_name": "Ek", "city": "STOCKHOLM"})
+        db.session.expire_all()
+        self.assertEqual(self.search(last_name="öberg"), [])
+        self.assertEqual(self.search(last_name="ek"), [customer.id])
+        self.assertEqual(self.search(city="stockholm"), [1, customer.id])
+
+
+class TestQueryCache(TransactionsDatabaseTestCase):
+    def read_customer(self) -> tuple[list, list[Decimal], str]:
+        """Reads customer 1 with its accounts and country like a new request, returning the
+        statements it took, the balances and the country name"""
+        db.session.remove()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            customer = CustomerRepository().get_customer_joined_accounts_country_or_404(1)
+            balances = [account.balance for account in customer.accounts]
+            country_name = customer.country_details.name
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        return statements, balances, country_name
+
+    def test_1_customer_reads_are_cached_until_a_transaction_commits(self):
+        self.app.config["QUERY_CACHE_BACKEND"] = "shared"
+        query_cache.init_app(self.app)
+
+        statements, balances, country_name = self.read_customer()
+        self.assertTrue(statements)
+        self.assertEqual(self.read_customer(), ([], balances, country_name))
+
+        # A rolled back write invalidates nothing
+        with self.assertRaises(ValueError):
+            self.service.process_transaction(db.session.get(Account, 1), Decimal(2000),
+                                             TransactionTypes.WITHDRAW)
+        self.assertEqual(self.read_customer()[0], [])
+
+        self.service.process_transaction(db.session.get(Account, 2), Decimal(5), TransactionTypes.DEPOSIT)
+        statements, new_balances, _ = self.read_customer()
+        self.assertTrue(statements)
+        self.assertEqual(new_balances, [balances[0], balances[1] + 5])
+        self.assertEqual(query_cache.get_stats()["queries"],
+                         {"CustomerRepository.get_customer_joined_accounts_country_or_404":
+                          {"hits": 2, "misses": 2}})
+
+    def test_2_local_backend_evicts_least_recently_used_and_expired_values(self):
+        backend = LocalCacheBackend(max_entries=2)
+        backend.set("a", b"1")
+        backend.set("b", b"2", ttl=0.01)
+        backend.get("a")
+        backend.set("c", b"3")
+        self.assertEqual([backend.get(key) for key in ("a", "b", "c")], [b"1", None, b"3"])
+        backend.set("d", b"4", ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(backend.get("d"))
+
+    def test_3_user_updates_invalidate_user_lists_and_stats_are_served(self):
+        seed_roles(db, user_datastore)
+        user_datastore.create_user(email="admin@bank.se", password=hash_password("Hejsan123#"), roles=["admin"])
+        db.session.commit()
+        user_service = UserService(UserRepository())
+        self.assertEqual(len(user_service.get_all_users()), 1)
+        user_service.create_and_register_user("cashier@bank.se", "Hejsan123#", "cashier")
+        self.assertEqual(len(user_service.get_all_users()), 2)
+        self.assertEqual(len(user_service.get_all_users()), 2)
+
+        client = self.app.test_client()
+        client.post("/login", data={"email": "admin@bank.se", "password": "Hejsan123#"})
+        response = client.get("/api/query-cache")
+        self.assertEqual(response.json["queries"]["UserRepository.get_all_users"], {"hits": 1, "misses": 2})
+
+    def test_4_local_backend_does_not_cache_balances(self):
+        query_cache.init_app(self.app)
+
+        statements, balances, _ = self.read_customer()
+        # Another process changes a balance, which this process's cache would not hear of
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Account).where(Account.id == 2).values(balance=Decimal(7)))
+        statements_again, balances_again, _ = self.read_customer()
+
+        self.assertTrue(statements and statements_again)
+        self.assertEqual(balances_again, [balances[0], Decimal(7)])
+        self.assertEqual(query_cache.get_stats()["queries"], {})
+
+    def test_5_cached_methods_take_keyword_arguments(self):
+        self.app.config["QUERY_CACHE_BACKEND"] = "shared"
+        query_cache.init_app(self.app)
+        lookup = CustomerRepository().get_customer_joined_accounts_country_or_404
+
+        self.assertEqual([lookup(customer_id=1).id for _ in range(2)], [1, 1])
+        self.assertEqual(query_cache.get_stats()["queries"],
+                         {"CustomerRepository.get_customer_joined_accounts_country_or_404":
+                          {"hits": 1, "misses": 1}})
+
+
+class TestTopCustomers(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        """Adds customers 2 to 5 in Sweden with one account each, holding 100 to 400"""
+        super().setUp()
+        for customer_id in range(2, 6):
+            db.session.add(Customer(
+                id=customer_id, first_name="Test", last_name=f"Customer {customer_id}", address="Street 1",
+                city="Stockholm", postal_code="12345", birthday=date(1980, 1, 1),
+                national_id=f"19800101{customer_id:04}", telephone="0701234567",
+                email=f"test{customer_id}@example.com", country="SE"))
+            db.session.add(Account(id=customer_id + 1, account_type="Checking", created=date(2000, 1, 1),
+                                   balance=Decimal(100 * (customer_id - 1)), customer_id=customer_id))
+        db.session.commit()
+        self.customer_repository = CustomerRepository()
+        self.top_customers = TopCustomersService(self.customer_repository, shown=2, kept=3)
+        self.service = TransactionService(TransactionRepository(), AccountService(AccountRepository()),
+                                          top_customers_service=self.top_customers)
+
+    def top(self) -> list[tuple[int, Decimal]]:
+        return [(entry.Customer.id, entry.sum_of_accounts) for entry in self.top_customers.get_top_customers("SE")]
+
+    def queried_top(self) -> list[tuple[int, Decimal]]:
+        return [(row.Customer.id, row.sum_of_accounts)
+                for row in self.customer_repository.get_top_customers_for_country("SE", 2)]
+
+    def test_1_leaderboard_follows_transactions_without_reading_accounts(self):
+        self.assertEqual(self.top(), [(1, Decimal(1000)), (5, Decimal(400))])
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        steps = [
+            # Customer 3 is not kept and becomes a candidate
+            lambda: self.service.process_transaction(db.session.get(Account, 4), Decimal(850), TransactionTypes.DEPOSIT),
+            lambda: self.service.process_transaction(db.session.get(Account, 1), Decimal(950), TransactionTypes.WITHDRAW),
+            lambda: self.service.process_transfer(db.session.get(Account, 6), db.session.get(Account, 2), Decimal(5)),
+            lambda: self.service.process_batch([{"type": "withdraw", "account_id": 4, "amount": "900"},
+                                                {"type": "deposit", "account_id": 5, "amount": "1"}]),
+        ]
+        for step in steps:
+            step()
+            event.listen(db.engine, "before_cursor_execute", listener)
+            top = self.top()
+            event.remove(db.engine, "before_cursor_execute", listener)
+            self.assertEqual(top, self.queried_top())
+
+        # Only the reads after a candidate grew and after the leaderboard ran short query
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(self.top(), [(5, Decimal(395)), (4, Decimal(301))])
+
+    def test_2_leaderboards_are_reloaded_after_the_refresh_interval_or_clear(self):
+        self.top_customers.get_top_customers("SE")
+        db.session.get(Account, 3).balance = Decimal(5000)
+        db.session.commit()
+
+        self.assertEqual(self.top()[0], (1, Decimal(1000)))
+        self.assertEqual(self.top_customers.get_top_customers("SE", datetime.now() + timedelta(minutes=6))[0]
+                         .Customer.id, 2)
+        db.session.get(Account, 3).balance = Decimal(0)
+        db.session.commit()
+        self.top_customers.clear()
+        self.assertEqual(self.top(), self.queried_top())
+
+    def test_3_transactions_are_not_held_up_or_lost_while_a_leaderboard_loads(self):
+        load = self.customer_repository.get_top_customers_for_country
+        def load_while_a_deposit_commits(*args):
+            rows = load(*args)
+            with db.engine.begin() as connection:
+                connection.execute(db.update(Account).where(Account.id == 6).values(balance=Decimal(1400)))
+            deposit = Thread(target=self.top_customers.balances_changed, args=([(5, Decimal(1000))],))
+            deposit.start()
+            deposit.join(timeout=5)
+            self.assertFalse(deposit.is_alive())
+            return rows
+
+        with patch.object(self.customer_repository, "get_top_customers_for_country",
+                          side_effect=load_while_a_deposit_commits):
+            self.top_customers.get_top_customers("SE")
+
+        self.assertEqual(self.top(), [(5, Decimal(1400)), (1, Decimal(1000))])
+
+
+class TestTransactionExport(TransactionsDatabaseTestCase):
+    def setUp(self) -> None:
+        """Adds 1500 transactions to each account, one a day from 2020, and logs in a cashier"""
+        super().setUp()
+        start = datetime(2020, 1, 1, 12)
+        db.session.execute(db.insert(Transaction), [
+            {"type": TransactionTypes.DEPOSIT.value, "timestamp": start + timedelta(days=day),
+             "amount": Decimal("1.50"), "new_balance": Decimal("1.50") * (day + 1), "account_id": account_id}
+            for account_id in (1, 2) for day in range(1500)])
+        seed_roles(db, user_datastore)
+        user_datastore.create_user(email="cashier@bank.se", password=hash_password("Hejsan123#"),
+                                   roles=["cashier"])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post("/login", data={"email": "cashier@bank.se", "password": "Hejsan123#"})
+
+    def test_1_customer_csv_export_streams_every_transaction(self):
+        response = self.client.get("/api/customers/1/export?format=csv")
+
+        self.assertTrue(response.is_streamed)
+        chunks = list(response.response)
+        lines = b"".join(chunks).decode().splitlines()
+        # The header is sent before the query runs, then a chunk per partition of rows
+        self.assertEqual(chunks[0].decode().strip(), "id,type,timestamp,amount,new_balance,account_id")
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(len(lines), 1 + 3000)
+        self.assertEqual(lines[1].split(",")[-1], "1")
+        self.assertEqual(lines[-1].split(",")[-1], "2")
+
+    def test_2_account_ndjson_export_with_date_range(self):
+        response = self.client.get("/api/accounts/2/export?format=ndjson&from=2021-01-01&to=2021-01-31")
+
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(len(rows), 31)
+        self.assertEqual({row["account_id"] for row in rows}, {2})
+        self.assertEqual((rows[0]["timestamp"], rows[-1]["timestamp"]),
+                         ("2021-01-01T12:00:00", "2021-01-31T12:00:00"))
+        self.assertEqual(self.client.get("/api/accounts/2/export?format=xml").status_code, 400)
+        self.assertEqual(self.client.get("/api/accounts/99/export").status_code, 404)
+
+
+class TestTransactionsPaging(TransactionsDatabaseTestCase):
+    def test_1_cursor_pages_cover_every_transaction_once_without_counting(self):
+        timestamp = datetime(2024, 1, 1, 12)
+        for number in range(45):
+            # Every third transaction shares its timestamp with the one before
+            if number % 3:
+                timestamp += timedelta(minutes=1)
+            db.session.add(Transaction(type=TransactionTypes.DEPOSIT.value, timestamp=timestamp,
+                                       amount=Decimal(1), new_balance=Decimal(number), account_id=1))
+        db.session.commit()
+        client = self.app.test_client()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+
+        pages = [client.get("/api/accounts/1?limit=20").json]
+        while pages[-1]["has_more"]:
+            pages.append(client.get(pages[-1]["next"]).json)
+        event.remove(db.engine, "before_cursor_execute", listener)
+
+        ids = [transaction["id"] for page in pages for transaction in page["transactions"]]
+        self.assertEqual([len(page["transactions"]) for page in pages], [20, 20, 5])
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(set(ids)), 45)
+        self.assertFalse(any("count(" in statement.lower() for statement in statements))
+        self.assertIsNone(pages[-1]["next"])
+
+    def test_2_offset_paging_and_bad_cursor(self):
+        client = self.app.test_client()
+
+        self.assertEqual(client.get("/api/accounts/1?offset=0&limit=5").json["offset"], 0)
+        self.assertEqual(client.get("/api/accounts/1?cursor=not-a-cursor").status_code, 400)
+
+
 if __name__ == "__main__":
     app = create_app()
     with app.app_context():
@@ -1,3 +1,5 @@
+import base64
+from datetime import datetime
 from babel.numbers import format_currency
 
 def string_to_bool(string) -> bool:
@@ -12,4 +14,16 @@ def format_money(value, currency="SEK"):
 def get_first_error_message(form_errors: dict):
     """Returns the first error message from form.errors"""
     for error_messages in form_errors.values():
-        return error_messages[0]
\ No newline at end of file
+        return error_messages[0]
+
+def encode_cursor(timestamp: datetime, id: int) -> str:
+    """Encodes the position of a row ordered by (timestamp, id) as an opaque url-safe string"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decodes a cursor made by encode_cursor, raising ValueError if it is not one"""
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
@@ -1,10 +1,20 @@
-from .api_models import UserApiModel, CustomerApiModel, TransactionsApiModel
+from .api_models import UserApiModel, CustomerApiModel, TransactionsApiModel, AuditFindingApiModel
 from models import Account
-from flask import Blueprint, jsonify, request, url_for
+from extensions import fraud_monitor, idempotency_service, top_customers_service
+from flask import Blueprint, Response, jsonify, request, url_for, stream_with_context
+from flask_security import roles_accepted
 from services.user_services import UserService, UserRepository
 from services.customer_services import CustomerService, CustomerRepository
 from services.transaction_services import TransactionService, TransactionRepository
 from services.account_services import AccountService, AccountRepository
+from services.audit_services import AuditService, AuditRepository
+from services.balance_services import BalanceService, BalanceCheckpointRepository
+from services.export_services import TransactionExportService
+from repositories.query_cache import query_cache
+from constants.constants import BusinessConstants
+from constants.errors_messages import ErrorMessages
+from utils import encode_cursor, decode_cursor
+from datetime import date
 
 api_blueprint = Blueprint("api", __name__, url_prefix="/api")
 
@@ -18,7 +28,16 @@ customer_repo = CustomerRepository()
 customer_service = CustomerService(customer_repo, account_service)
 
 transaction_repo = TransactionRepository()
-transaction_service = TransactionService(transaction_repo, account_service)
+transaction_service = TransactionService(transaction_repo, account_service, fraud_monitor, idempotency_service,
+                                         top_customers_service)
+
+audit_repo = AuditRepository()
+audit_service = AuditService(audit_repo)
+
+balance_checkpoint_repo = BalanceCheckpointRepository()
+balance_service = BalanceService(balance_checkpoint_repo)
+
+export_service = TransactionExportService(transaction_repo)
 
 @api_blueprint.route("/user/<int:user_id>")
 def user_api(user_id):
@@ -38,8 +57,46 @@ def customer_api(customer_id):
 
 @api_blueprint.route("/accounts/<int:account_id>")
 def transactions_api(account_id):
+    """Pages through an account's transactions with the cursor of the next url,
+    or with offset and limit if an offset is given"""
     account: Account = account_service.get_account_from_id(account_id, raise_404=True)
 
+    if "offset" in request.args:
+        return transactions_offset_api(account)
+
+    limit = max(request.args.get("limit", 20, int), 1)
+    try:
+        cursor = decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError:
+        return jsonify({"error": ErrorMessages.INVALID_CURSOR.value}), 400
+
+    account_transactions, next_cursor = transaction_service.get_transactions_page(account_id,
+                                                                                  limit,
+                                                                                  cursor)
+    if next_cursor:
+        next_cursor = encode_cursor(*next_cursor)
+        next_url = url_for('api.transactions_api',
+                           account_id=account_id,
+                           cursor=next_cursor,
+                           limit=limit,
+                           _external=True)
+    else:
+        next_url = None
+
+    transactions_dict = [TransactionsApiModel(transaction).to_dict() for transaction in account_transactions]
+
+    return jsonify({"transactions": transactions_dict,
+                    "balance": account.balance,
+                    "has_more": next_cursor is not None,
+                    "next": next_url,
+                    "next_cursor": next_cursor,
+                    "limit": limit,
+                    "account_id": account.id})
+
+def transactions_offset_api(account: Account):
+    """The offset and limit paging transactions_api used before cursors, kept for old clients"""
+    account_id = account.id
+
     # Make sure offset and limit are not negative
     offset = max(request.args.get("offset", 0, int), 0)
     limit = max(request.args.get("limit", 20, int), 1)
@@ -67,3 +124,143 @@ def transactions_api(account_id):
                     "offset": offset,
                     "limit": limit,
                      "account_id": account.id })
+
+@api_blueprint.route("/accounts/<int:account_id>/export")
+@roles_accepted("cashier", "admin")
+def account_export_api(account_id):
+    """Streams an account's transactions, /api/accounts/1/export?format=csv&from=2024-01-01&to=2024-12-31"""
+    account_service.get_account_from_id(account_id, raise_404=True)
+    return transactions_export_response(f"account-{account_id}", account_id=account_id)
+
+@api_blueprint.route("/customers/<int:customer_id>/export")
+@roles_accepted("cashier", "admin")
+def customer_export_api(customer_id):
+    """Streams the transactions of all of a customer's accounts, with the same parameters"""
+    customer_service.get_customer_from_id(customer_id, raise_404=True)
+    return transactions_export_response(f"customer-{customer_id}", customer_id=customer_id)
+
+def transactions_export_response(filename: str, **owner):
+    export_format = request.args.get("format", "csv")
+    try:
+        mimetype = export_service.get_mimetype(export_format)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    try:
+        from_date, to_date = (date.fromisoformat(request.args[name]) if request.args.get(name) else None
+                              for name in ("from", "to"))
+    except ValueError:
+        return jsonify({"error": ErrorMessages.INVALID_DATE.value}), 400
+
+    chunks = export_service.iter_export(export_format, from_date=from_date, to_date=to_date, **owner)
+    # stream_with_context keeps the database session open until the last chunk is sent
+    return Response(stream_with_context(chunks),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}.{export_format}"})
+
+@api_blueprint.route("/transactions", methods=["POST"])
+@roles_accepted("cashier", "admin")
+def transaction_api():
+    """Makes one transaction. A client that sends an Idempotency-Key header, unique per
+    transaction, can retry after a timeout and gets the first attempt's transactions back"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": ErrorMessages.INVALID_TRANSACTION.value}), 400
+
+    try:
+        transaction_type_name, account_id, to_account_id, amount = (
+            transaction_service.parse_transaction_item(payload))
+        transactions = transaction_service.initiate_transaction_process(
+            account_id,
+            amount,
+            transaction_type_name,
+            to_account_id,
+            request.headers.get("Idempotency-Key"))
+    except ValueError as error:
+        if str(error) == ErrorMessages.IDEMPOTENCY_KEY_REUSED.value:
+            return jsonify({"error": str(error)}), 422
+        if str(error) == ErrorMessages.GROUP_COMMIT_TIMEOUT.value:
+            return jsonify({"error": str(error)}), 503
+        return jsonify({"error": str(error)}), 400
+
+    return jsonify({"transactions": [TransactionsApiModel(transaction).to_dict()
+                                     for transaction in transactions]})
+
+@api_blueprint.route("/transactions/batch", methods=["POST"])
+@roles_accepted("cashier", "admin")
+def transactions_batch_api():
+    payload = request.get_json(silent=True)
+    items = payload.get("transactions") if isinstance(payload, dict) else None
+
+    if not isinstance(items, list):
+        return jsonify({"error": ErrorMessages.INVALID_BATCH.value}), 400
+    if len(items) > BusinessConstants.MAX_TRANSACTION_BATCH_SIZE:
+        return jsonify({"error": ErrorMessages.BATCH_TOO_LARGE.value,
+                        "max_batch_size": BusinessConstants.MAX_TRANSACTION_BATCH_SIZE}), 413
+
+    results = transaction_service.process_batch(items)
+    accepted_count = sum(1 for result in results if result["status"] == "accepted")
+
+    return jsonify({"results": results,
+                    "accepted": accepted_count,
+                    "rejected": len(results) - accepted_count})
+
+@api_blueprint.route("/balances")
+@roles_accepted("cashier", "admin")
+def balances_api():
+    """Balances at the end of a date, /api/balances?date=2024-01-31&account_id=1&account_id=2"""
+    try:
+        on_date = date.fromisoformat(request.args.get("date", ""))
+    except ValueError:
+        return jsonify({"error": ErrorMessages.INVALID_DATE.value}), 400
+
+    account_ids = request.args.getlist("account_id", int)
+    if not account_ids:
+        return jsonify({"error": ErrorMessages.INVALID_ACCOUNT_IDS.value}), 400
+    if len(account_ids) > BusinessConstants.MAX_BALANCE_LOOKUP_ACCOUNTS:
+        return jsonify({"error": ErrorMessages.TOO_MANY_ACCOUNTS.value,
+                        "max_accounts": BusinessConstants.MAX_BALANCE_LOOKUP_ACCOUNTS}), 413
+
+    balances = balance_service.get_balances_on_date(account_ids, on_date)
+
+    return jsonify({"date": on_date.isoformat(),
+                    "balances": [{"account_id": account_id, "balance": balance}
+                                 for account_id, balance in sorted(balances.items())]})
+
+@api_blueprint.route("/query-cache")
+@roles_accepted("admin")
+def query_cache_api():
+    """Hits and misses of each cached repository query, for tuning the cache"""
+    return jsonify(query_cache.get_stats())
+
+@api_blueprint.route("/audit/findings")
+@roles_accepted("cashier", "admin")
+def audit_findings_api():
+    # Make sure page and per_page are within bounds
+    page = max(request.args.get("page", 1, int), 1)
+    per_page = min(max(request.args.get("per_page", 50, int), 1), 500)
+
+    filters = {
+        "run_id": request.args.get("run_id", None, int),
+        "country": request.args.get("country", "").upper(),
+        "customer_id": request.args.get("customer_id", None, int)
+    }
+
+    findings = audit_service.get_paginated_findings(filters, page, per_page)
+
+    if findings.has_next:
+        next_url = url_for('api.audit_findings_api',
+                           page=page + 1,
+                           per_page=per_page,
+                           _external=True,
+                           **{name: value for name, value in filters.items() if value})
+    else:
+        next_url = None
+
+    findings_dict = [AuditFindingApiModel(finding).to_dict() for finding in findings]
+
+    return jsonify({"findings": findings_dict,
+                    "total": findings.total,
+                    "has_more": findings.has_next,
+                    "next": next_url,
+                    "page": page,
+                    "per_page": per_page})
@@ -1,4 +1,4 @@
-from models import Customer, Transaction, User
+from models import Customer, Transaction, User, AuditFinding
 
 class TransactionsApiModel:
     def __init__(self, transaction: Transaction) -> None:
@@ -79,4 +79,25 @@ class UserApiModel:
             "is_active": self.is_active,
             "role": self.role.name
         }
-  
\ No newline at end of file
+
+class AuditFindingApiModel:
+    def __init__(self, finding: AuditFinding) -> None:
+        self.id = finding.id
+        self.run_id = finding.run_id
+        self.customer_id = finding.customer_id
+        self.account_id = finding.account_id
+        self.transaction_id = finding.transaction_id
+        self.country = finding.country
+        self.rule = finding.rule
+
+    def to_dict(self):
+        """ Converts api model instance into a dictionary """
+        return {
+            "id": self.id,
+            "run_id": self.run_id,
+            "customer_id": self.customer_id,
+            "account_id": self.account_id,
+            "transaction_id": self.transaction_id,
+            "country": self.country,
+            "rule": self.rule
+        }
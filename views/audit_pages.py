@@ -0,0 +1,36 @@
+from flask import render_template, Blueprint, request
+from flask_security import roles_accepted
+
+from forms import AuditFindingsForm
+from services.audit_services import AuditService, AuditRepository
+
+
+audit_repo = AuditRepository()
+audit_service = AuditService(audit_repo)
+
+audit_blueprint = Blueprint("audit", __name__)
+
+@audit_blueprint.route("/audit-findings")
+@roles_accepted("cashier", "admin")
+def audit_findings():
+    form = AuditFindingsForm(request.args)
+    RESULTS_PER_PAGE = 50
+    page = request.args.get("page", 1, int)
+
+    filters = {}
+    if form.validate():
+        filters = {
+            "run_id": form.run_id.data,
+            "country": (form.country.data or "").upper(),
+            "customer_id": form.customer_id.data
+        }
+
+    findings = audit_service.get_paginated_findings(filters, page, RESULTS_PER_PAGE)
+
+    return render_template(
+        "audit/findings.html",
+        active_page="audit_findings",
+        form=form,
+        findings=findings,
+        query_params={name: value for name, value in filters.items() if value},
+        page=page)
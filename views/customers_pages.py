@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, redirect, flash, url_for
 from flask_security import login_required, roles_accepted
 
 from forms import RegisterCustomerForm
+from extensions import top_customers_service
 
 from services.country_services import CountryService, CountryRepository
 from services.transaction_services import TransactionService, TransactionRepository
@@ -42,7 +43,7 @@ def index():
 def country_page(country_name):
     country = country_service.get_country_or_404(country_name)
 
-    country_customer = customer_service.get_top_10_customers_for_country(country.name)
+    country_customer = top_customers_service.get_top_customers(country.country_code)
     
     return render_template(
         "customers/country_page.html",
@@ -113,6 +114,7 @@ def process_customer_edits():
             if fieldname in form.user_defined_fields}
 
         if customer_service.customer_edited(customer, customer_details):
+            top_customers_service.clear()
             flash("Customer details updated!")
         else:
             flash("No changes to customer made!")
@@ -1,4 +1,5 @@
 from datetime import date
+from uuid import uuid4
 from flask import render_template, flash, Blueprint, request
 
 from forms import TransactionForm
@@ -8,6 +9,7 @@ from repositories.customer_repository import CustomerRepository
 from repositories.account_repository import AccountRepository
 from constants.constants import TransactionTypes
 from utils import get_first_error_message
+from extensions import fraud_monitor, idempotency_service, top_customers_service
 
 from services.customer_services import CustomerService, CustomerRepository
 from services.account_services import AccountService, AccountRepository
@@ -21,10 +23,20 @@ customer_repo = CustomerRepository()
 customer_service = CustomerService(customer_repo, account_service)
 
 transaction_repo = TransactionRepository()
-transaction_service = TransactionService(transaction_repo, account_service)
+transaction_service = TransactionService(transaction_repo, account_service, fraud_monitor, idempotency_service,
+                                         top_customers_service)
 
 transactions_blueprint = Blueprint("transactions", __name__)
 
+@transactions_blueprint.record_once
+def enable_group_commit(state):
+    """Starts the group commit writer when the app is configured with TRANSACTION_GROUP_COMMIT"""
+    if state.app.config.get("TRANSACTION_GROUP_COMMIT"):
+        transaction_repo.enable_group_commit(state.app,
+                                             state.app.config["TRANSACTION_GROUP_COMMIT_MAX_BATCH_SIZE"],
+                                             state.app.config["TRANSACTION_GROUP_COMMIT_MAX_WAIT"],
+                                             state.app.config["TRANSACTION_GROUP_COMMIT_TIMEOUT"])
+
 @transactions_blueprint.route("/transactions", methods=["GET", "POST"])
 def transactions():
     form = TransactionForm()
@@ -42,7 +54,8 @@ def transactions():
                 account_id,
                 amount,
                 transaction_type_name,
-                to_account)
+                to_account,
+                form.idempotency_key.data or None)
         except (ValueError, KeyError) as error:
             flash(error)
         else:
@@ -52,6 +65,10 @@ def transactions():
                                    result=result)
     elif request.method == "POST":
         flash(get_first_error_message(form.errors))
+
+    # A form posted again, by a retry or the back button, keeps its key and is not posted twice
+    if not form.idempotency_key.data:
+        form.idempotency_key.data = uuid4().hex
     return render_template("transactions/transactions.html",
                            active_page="transactions",
                            form=form,